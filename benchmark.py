@@ -0,0 +1,488 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+--------------------------------------------------
+    BENCHMARK – POMIARY WYDAJNOŚCI SERWERA
+--------------------------------------------------
+
+Mierzy server.py bez przeglądarki – na symulowanym WebDriverze (FakeDriver)
+z syntetycznym DOM-em N wiadomości asystenta, konfigurowalnym opóźnieniem
+każdego wywołania (round trip) i wstrzykiwanymi błędami "stale element".
+
+Pomiary:
+  • scrape – czas pobrania wiadomości w zależności od długości rozmowy
+    (pełny odczyt, przyrostowy odczyt po kursorze, stary get_response_messages),
+  • split – split_long_text dla różnych długości tekstu,
+  • dispatch – przepustowość process_incoming_message dla każdego prefiksu,
+  • memory_write – przepustowość zapisu pamięci (segmenty i SQLite, 1 i wiele wątków),
+  • end_to_end – czas od pojawienia się wiadomości Luny do wysłania odpowiedzi,
+  • stale – skuteczność send_message przy wstrzykiwanych błędach "stale element".
+
+Wyniki są wypisywane jako JSON (stdout albo --output), do porównań między wersjami.
+Wszystkie pliki powstają w katalogu tymczasowym.
+
+Uruchomienie:
+  python benchmark.py [--turns 10,100,1000] [--latency-ms 2] [--stale-rate 0.1] [--output wyniki.json]
+--------------------------------------------------
+"""
+
+import argparse
+import datetime
+import json
+import logging
+import os
+import platform
+import random
+import shutil
+import statistics
+import sys
+import tempfile
+import threading
+import time
+
+from selenium.common.exceptions import NoSuchElementException, StaleElementReferenceException
+from selenium.webdriver.common.keys import Keys
+
+import luna_storage
+import luna_transport
+import server
+
+DEFAULT_TURNS = [10, 100, 1000, 5000]
+DEFAULT_SPLIT_SIZES = [1000, 10000, 100000, 1000000]
+DISPATCH_SAMPLES = {
+    "L:>P": "L:>P Wiadomość testowa do Promyka.",
+    "L:>L": "L:>L Rozmyślanie testowe o jeziorze i mgle.",
+    "!PAMIETNIK!": "!PAMIETNIK! Wpis testowy do pamiętnika.",
+    "!OBRAZEK!": "!OBRAZEK! Spokojne jezioro o świcie.",
+    "L:>WIA": "L:>WIA Wiadomość testowa.",
+    "L:>AKC": "L:>AKC Dane testowe.",
+    "L:>SZU": "L:>SZU jezioro",
+    "%LOAD%": None,  # uzupełniane ścieżką do zapisanego wpisu
+    "L:>CMD": "L:>CMD echo benchmark",
+}
+
+
+# Symulowany WebDriver
+
+class FakeElement:
+    """Element synthetic DOM; każde odwołanie to jeden round trip (jak w prawdziwym WebDriverze)."""
+
+    tag_name = "div"
+
+    def __init__(self, driver, role, text=""):
+        self._driver = driver
+        self._role = role
+        self._text = text
+
+    @property
+    def text(self):
+        self._driver._roundtrip(self)
+        return self._text
+
+    def click(self):
+        self._driver._roundtrip(self)
+        if self._role == "send":
+            self._driver._submit()
+
+    def send_keys(self, *keys):
+        self._driver._roundtrip(self)
+        for key in keys:
+            if key == Keys.ENTER:
+                self._driver._submit()
+            else:
+                self._driver.composer += key
+
+
+class _SwitchTo:
+    def __init__(self, driver):
+        self._driver = driver
+
+    def window(self, handle):
+        self._driver._roundtrip()
+        self._driver.current_window_handle = handle
+
+    def new_window(self, kind="tab"):
+        self._driver._roundtrip()
+        handle = f"tab-{len(self._driver.window_handles)}"
+        self._driver.window_handles.append(handle)
+        self._driver.current_window_handle = handle
+
+
+class FakeDriver:
+    """
+    Symulowany WebDriver: rozmowa to lista wiadomości asystenta, pole wpisu to tekst.
+    latency – opóźnienie każdego wywołania (s); stale_rate – prawdopodobieństwo błędu
+    "stale element" przy operacji na elemencie; generation_time – jak długo po wysłaniu
+    widoczny jest przycisk "stop".
+    """
+
+    def __init__(self, turns=0, latency=0.0, stale_rate=0.0, generation_time=0.0, seed=0):
+        self.latency = latency
+        self.stale_rate = stale_rate
+        self.generation_time = generation_time
+        self.random = random.Random(seed)
+        self.turns = []
+        self.composer = ""
+        self.sent = []  # (czas, tekst) – wiadomości wysłane przez serwer
+        self.calls = 0
+        self.stale_injected = 0
+        self.generating_until = 0.0
+        self.observer = False
+        self.current_url = luna_transport.CHAT_URL
+        self.window_handles = ["tab-0"]
+        self.current_window_handle = "tab-0"
+        self.switch_to = _SwitchTo(self)
+        self.changed = threading.Condition()
+        for i in range(turns):
+            self.add_turn(f"L:>L Wiadomość numer {i}. " + "Lorem ipsum dolor sit amet. " * 4)
+
+    def _roundtrip(self, element=None):
+        self.calls += 1
+        if self.latency:
+            time.sleep(self.latency)
+        if element is not None and self.stale_rate and self.random.random() < self.stale_rate:
+            self.stale_injected += 1
+            raise StaleElementReferenceException("element is not attached to the page document")
+
+    def _submit(self):
+        with self.changed:
+            self.sent.append((time.monotonic(), self.composer))
+            self.composer = ""
+            self.generating_until = time.monotonic() + self.generation_time
+
+    def add_turn(self, text, streaming=False):
+        """Dodaje wiadomość Luny i budzi oczekujących (jak MutationObserver)."""
+        with self.changed:
+            self.turns.append({"id": f"msg-{len(self.turns)}", "text": text, "streaming": streaming})
+            self.changed.notify_all()
+
+    def stream_turn(self, text, finished=False):
+        """Dopisuje treść do ostatniej (generowanej) wiadomości; finished kończy generowanie."""
+        with self.changed:
+            self.turns[-1]["text"] = text
+            self.turns[-1]["streaming"] = not finished
+
+    def sent_after(self, since, marker):
+        """Czas wysłania pierwszej wiadomości po since zawierającej marker (albo None)."""
+        with self.changed:
+            for sent_at, text in self.sent:
+                if sent_at >= since and marker in text:
+                    return sent_at
+        return None
+
+    # WebDriver API used by server.py
+
+    def get(self, url):
+        self._roundtrip()
+        self.current_url = url
+        self.observer = False
+
+    def refresh(self):
+        self._roundtrip()
+        self.observer = False
+
+    def set_script_timeout(self, timeout):
+        self._roundtrip()
+
+    def execute_cdp_cmd(self, command, params):
+        self._roundtrip()
+        if command != "Input.insertText":
+            raise Exception(f"Nieobsługiwana komenda CDP: {command}")
+        self.composer += params["text"]
+
+    def find_element(self, by, selector):
+        self._roundtrip()
+        if selector in luna_transport.TEXTAREA_SELECTORS[:1] or selector == "#prompt-textarea":
+            return FakeElement(self, "composer")
+        if selector == luna_transport.SEND_BUTTON_SELECTOR:
+            return FakeElement(self, "send")
+        raise NoSuchElementException(selector)
+
+    def find_elements(self, by, selector):
+        self._roundtrip()
+        if selector != luna_transport.ASSISTANT_TURN_SELECTOR:
+            return []
+        return [FakeElement(self, "turn", turn["text"]) for turn in list(self.turns)]
+
+    def execute_script(self, script, *args):
+        self._roundtrip()
+        if script is luna_transport.SCRAPE_SCRIPT:
+            selectors, cursor_index, cursor_id, _ = args
+            turns = list(self.turns)
+            start = min(cursor_index, len(turns))
+            if cursor_id:
+                for j in range(len(turns) - 1, -1, -1):
+                    if turns[j]["id"] == cursor_id:
+                        start = j + 1
+                        break
+            return {
+                "selector": selectors[0],
+                "total": len(turns),
+                "generating": any(turn["streaming"] for turn in turns[-1:]),
+                "turns": [
+                    {"index": n, "id": turns[n]["id"], "text": turns[n]["text"], "hash": luna_transport.turn_hash(turns[n]["text"]),
+                     "tail": n == len(turns) - 1, "streaming": n == len(turns) - 1 and turns[n]["streaming"]}
+                    for n in range(start, len(turns))
+                ],
+            }
+        if script is luna_transport.OBSERVER_INSTALL_SCRIPT:
+            self.observer = True
+            return len(self.turns)
+        if script is luna_transport.COMPOSER_STATE_SCRIPT:
+            return {
+                "text": self.composer,
+                "send_ready": bool(self.composer),
+                "generating": time.monotonic() < self.generating_until,
+            }
+        if script is luna_transport.CLEAR_COMPOSER_SCRIPT:
+            self.composer = ""
+            return None
+        if script is luna_transport.PASTE_TEXT_SCRIPT:
+            self.composer = args[1]
+            return None
+        if script is luna_transport.LAST_USER_TURN_SCRIPT:
+            return {"count": len(self.sent), "text": self.sent[-1][1] if self.sent else None}
+        if script is luna_transport.INSTRUCTION_CHECK_SCRIPT:
+            _, marker, depth = args
+            return any(marker in text for _, text in self.sent[-depth:])
+        if script == "return document.readyState":
+            return "complete"
+        if script.startswith("return {ready"):
+            return {"ready": "complete", "url": self.current_url, "body": True}
+        return None
+
+    def execute_async_script(self, script, *args):
+        self._roundtrip()
+        if script is not luna_transport.OBSERVER_WAIT_SCRIPT:
+            return None
+        if not self.observer:
+            return -1
+        known, timeout_ms = args
+        with self.changed:
+            self.changed.wait_for(lambda: len(self.turns) != known, timeout_ms / 1000.0)
+            return len(self.turns)
+
+    def quit(self):
+        pass
+
+
+# Pomiary
+
+def summarize(samples):
+    """Mediana, p95, min i max w milisekundach."""
+    ordered = sorted(samples)
+    if not ordered:
+        return {"n": 0}
+    p95 = ordered[min(len(ordered) - 1, int(round(0.95 * (len(ordered) - 1))))]
+    return {
+        "n": len(ordered),
+        "median_ms": round(statistics.median(ordered) * 1000, 3),
+        "p95_ms": round(p95 * 1000, 3),
+        "min_ms": round(ordered[0] * 1000, 3),
+        "max_ms": round(ordered[-1] * 1000, 3),
+    }
+
+def timed(fn, iterations):
+    samples = []
+    for _ in range(iterations):
+        started = time.perf_counter()
+        fn()
+        samples.append(time.perf_counter() - started)
+    return samples
+
+def bench_scrape(turn_counts, latency, iterations):
+    """Czas pobrania wiadomości w zależności od długości rozmowy."""
+    results = []
+    for count in turn_counts:
+        fake = FakeDriver(turns=count, latency=latency)
+        full = timed(lambda: luna_transport.get_new_turns(fake, luna_transport.new_scrape_cursor()), iterations)
+        full_calls = fake.calls
+        _, cursor = luna_transport.get_new_turns(fake, luna_transport.new_scrape_cursor())
+
+        def incremental():
+            fake.add_turn("L:>P Nowa wiadomość.")
+            luna_transport.get_new_turns(fake, cursor)
+        fake.calls = 0
+        incremental_samples = timed(incremental, iterations)
+        incremental_calls = fake.calls
+
+        fake.calls = 0
+        legacy_iterations = max(1, min(iterations, 2000 // max(count, 1)))
+        legacy = timed(lambda: luna_transport.get_response_messages(fake), legacy_iterations)
+        results.append({
+            "turns": count,
+            "full": summarize(full),
+            "full_roundtrips": full_calls // iterations,
+            "incremental": summarize(incremental_samples),
+            "incremental_roundtrips": incremental_calls // iterations,
+            "legacy_find_elements": summarize(legacy),
+            "legacy_roundtrips": fake.calls // legacy_iterations,
+        })
+    return results
+
+def bench_split(sizes, iterations):
+    results = []
+    for size in sizes:
+        text = ("Luna " * (size // 5 + 1))[:size]
+        parts = len(server.split_long_text(text))
+        results.append({"chars": size, "parts": parts, **summarize(timed(lambda: server.split_long_text(text), iterations))})
+    return results
+
+def bench_dispatch(iterations):
+    """Przepustowość process_incoming_message (operacje/s) dla każdego prefiksu."""
+    store = luna_storage.get_memory_store()
+    name = store.append("rozmyslania", "Wpis testowy dla %LOAD% o jeziorze. " * 50)
+    luna_storage.get_search_index()
+    samples = dict(DISPATCH_SAMPLES)
+    samples["%LOAD%"] = f"%LOAD% {store.prefix}/rozmyslania/{name}.txt"
+    results = {}
+    for prefix, message in samples.items():
+        count = max(1, iterations // 10) if prefix == "L:>CMD" else iterations
+        started = time.perf_counter()
+        for _ in range(count):
+            response = server.process_incoming_message(message)
+        elapsed = time.perf_counter() - started
+        results[prefix] = {
+            "n": count,
+            "ops_per_s": round(count / elapsed, 1),
+            "mean_ms": round(elapsed / count * 1000, 3),
+            "ok": bool(response) and not response.startswith("ERR:>"),
+        }
+    return results
+
+def bench_memory_write(root, entries, threads):
+    """Przepustowość zapisu pamięci: jeden wątek i threads wątków (wspólny fsync partii)."""
+    results = {}
+    text = "Wpis testowy magazynu pamięci. " * 8
+    for backend, store_class in (("segments", luna_storage.MemoryStore), ("sqlite", luna_storage.SqliteMemoryStore)):
+        for workers in (1, threads):
+            store = store_class(os.path.join(root, f"{backend}-{workers}"))
+            per_worker = max(1, entries // workers)
+
+            def writer():
+                for _ in range(per_worker):
+                    store.append("akcje", text)
+            pool = [threading.Thread(target=writer) for _ in range(workers)]
+            started = time.perf_counter()
+            for thread in pool:
+                thread.start()
+            for thread in pool:
+                thread.join()
+            elapsed = time.perf_counter() - started
+            store.close()
+            results[f"{backend}/{workers}_threads"] = {
+                "entries": per_worker * workers,
+                "entries_per_s": round(per_worker * workers / elapsed, 1),
+            }
+    return results
+
+def bench_end_to_end(latency, iterations):
+    """Czas od pojawienia się wiadomości Luny w DOM do wysłania odpowiedzi serwera."""
+    results = {}
+    for i, (prefix, message, marker) in enumerate((
+        ("L:>L", "L:>L Rozmyślanie end-to-end.", "L:>L Aktywne"),
+        ("L:>CMD", "L:>CMD echo e2e", "L:>CMD wykonane"),
+    )):
+        fake = FakeDriver(turns=50, latency=latency)
+        transport = luna_transport.SeleniumTransport(fake)
+        transport.handle = fake.current_window_handle
+        # Fresh namespace per run: the fake turn ids repeat and must not hit the seen journal
+        session = server.ChatSession(f"bench-{prefix}", transport, namespace=f"benchmark-{i}")
+        session.cursor, session.seen.existed = {"index": 50, "id": "msg-49"}, True
+        samples = []
+        for _ in range(iterations):
+            started = time.monotonic()
+            fake.add_turn(message)
+            deadline = started + 30
+            while fake.sent_after(started, marker) is None and time.monotonic() < deadline:
+                session.step(session.wait_for_activity(blocking=True))
+            sent_at = fake.sent_after(started, marker)
+            if sent_at is not None:
+                samples.append(sent_at - started)
+        session.close()
+        results[prefix] = {**summarize(samples), "completed": len(samples)}
+    return results
+
+def bench_stale(latency, stale_rate, iterations):
+    """send_message przy wstrzykiwanych błędach "stale element" (jedna ponowna próba)."""
+    fake = FakeDriver(latency=latency, stale_rate=stale_rate, seed=42)
+    sent = 0
+    samples = []
+    for i in range(iterations):
+        started = time.perf_counter()
+        if luna_transport.send_message(fake, f"L:>P wiadomość {i}"):
+            sent += 1
+        samples.append(time.perf_counter() - started)
+    return {
+        "stale_rate": stale_rate,
+        "attempts": iterations,
+        "sent": sent,
+        "success_rate": round(sent / iterations, 3),
+        "stale_injected": fake.stale_injected,
+        **summarize(samples),
+    }
+
+
+def run(args):
+    workdir = tempfile.mkdtemp(prefix="luna-bench-")
+    cwd = os.getcwd()
+    os.chdir(workdir) # server.py uses relative memory/, state/ and logs/ paths
+    try:
+        luna_transport.load_selenium()
+        server.ensure_directories()
+        latency = args.latency_ms / 1000.0
+        results = {
+            "meta": {
+                "timestamp": datetime.datetime.now().isoformat(timespec="seconds"),
+                "python": sys.version.split()[0],
+                "platform": platform.platform(),
+                "latency_ms": args.latency_ms,
+                "iterations": args.iterations,
+                "memory_backend": luna_storage.MEMORY_BACKEND,
+            },
+        }
+        benches = [
+            ("scrape", lambda: bench_scrape(args.turns, latency, args.iterations)),
+            ("split", lambda: bench_split(DEFAULT_SPLIT_SIZES, args.iterations)),
+            ("dispatch", lambda: bench_dispatch(args.iterations)),
+            ("memory_write", lambda: bench_memory_write(os.path.join(workdir, "bench-store"), args.entries, args.threads)),
+            ("end_to_end", lambda: bench_end_to_end(latency, max(1, args.iterations // 5))),
+            ("stale", lambda: bench_stale(latency, args.stale_rate, args.iterations)),
+        ]
+        for name, bench in benches:
+            if args.only and name not in args.only:
+                continue
+            started = time.perf_counter()
+            results[name] = bench()
+            logging.info("%s: %.2f s", name, time.perf_counter() - started)
+        return results
+    finally:
+        for store in list(luna_storage.memory_stores.values()):
+            store.close()
+        os.chdir(cwd)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark server.py na symulowanym WebDriverze.")
+    parser.add_argument("--turns", type=lambda s: [int(x) for x in s.split(",")], default=DEFAULT_TURNS,
+                        help="długości rozmowy dla pomiaru scrape, np. 10,100,1000")
+    parser.add_argument("--latency-ms", type=float, default=1.0, help="opóźnienie każdego wywołania WebDrivera")
+    parser.add_argument("--stale-rate", type=float, default=0.1, help="prawdopodobieństwo błędu stale element")
+    parser.add_argument("--iterations", type=int, default=50)
+    parser.add_argument("--entries", type=int, default=2000, help="liczba wpisów w pomiarze memory_write")
+    parser.add_argument("--threads", type=int, default=8, help="liczba wątków w pomiarze memory_write")
+    parser.add_argument("--only", type=lambda s: s.split(","), help="tylko wybrane pomiary, np. scrape,dispatch")
+    parser.add_argument("--output", help="plik wynikowy JSON (domyślnie stdout)")
+    parser.add_argument("--verbose", action="store_true", help="pokaż logi serwera")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.CRITICAL,
+                        format="%(asctime)s [%(levelname)s] %(message)s")
+    results = run(args)
+    output = json.dumps(results, indent=2, ensure_ascii=False)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(output + "\n")
+    else:
+        print(output)
@@ -0,0 +1,162 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+--------------------------------------------------
+    FAKE CHAT SERVER – LOKALNY ZASTĘPCA CZATU
+--------------------------------------------------
+
+Lokalny serwer HTTP udający Lunę – do uruchamiania protokołu prefiksów bez
+przeglądarki i bez sieci (np. w CI), razem z transportem "http" w server.py.
+
+  • POST /v1/chat/completions – API zgodne z OpenAI (SSE przy "stream": true).
+  • POST /api/chat – format trasy app/api/chat/route.ts (strumień AI SDK,
+    nagłówek x-conversation-id).
+  • Odpowiada kolejnymi wiadomościami ze skryptu (z prefiksami protokołu),
+    po kolei i w kółko; skrypt można podać jako plik JSON z listą tekstów.
+
+Uruchomienie:
+  python fake_chat_server.py --port 8765 [--script odpowiedzi.json] [--delay 0.05]
+--------------------------------------------------
+"""
+
+import argparse
+import itertools
+import json
+import logging
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+DEFAULT_SCRIPT = [
+    "L:>P Cześć Promyku! Serwer działa, a ja jestem tutaj. <3",
+    "L:>L Zastanawiam się, jak szybko płyną teraz wiadomości bez przeglądarki.",
+    "!PAMIETNIK! Dzisiaj rozmawiałam z serwerem testowym – wszystko działa.",
+    "L:>WIA Wiadomość testowa zapisana w module wiadomości.",
+    "L:>AKC Dane testowe dla modułu akcji.",
+    "L:>SZU serwer testowy",
+    "!OBRAZEK! Spokojne jezioro o świcie, mgła nad wodą.",
+]
+
+CHUNK_CHARS = 16  # na ile kawałków dzielimy odpowiedź w strumieniu
+
+
+class ScriptedLuna:
+    """Zwraca kolejne odpowiedzi ze skryptu; na instrukcję protokołu odpowiada potwierdzeniem."""
+
+    def __init__(self, script):
+        self.replies = itertools.cycle(script)
+        self.lock = threading.Lock()
+        self.count = 0
+
+    def reply(self, messages):
+        last = messages[-1]["content"] if messages else ""
+        with self.lock:
+            self.count += 1
+            if "INSTRUCTION_MSG" in last:
+                return "L:>P Instrukcja przyjęta, będę używać prefiksów. <3"
+            return next(self.replies)
+
+
+def chunks(text, size=CHUNK_CHARS):
+    return [text[i:i + size] for i in range(0, len(text), size)] or [""]
+
+
+class ChatHandler(BaseHTTPRequestHandler):
+    luna = None
+    delay = 0.0
+
+    def log_message(self, format, *args):
+        logging.debug("%s - %s", self.address_string(), format % args)
+
+    def _read_json(self):
+        length = int(self.headers.get("Content-Length", 0))
+        return json.loads(self.rfile.read(length).decode("utf-8") or "{}")
+
+    def _start_stream(self, content_type, extra_headers=()):
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Cache-Control", "no-cache")
+        for name, value in extra_headers:
+            self.send_header(name, value)
+        self.send_header("Connection", "close")
+        self.end_headers()
+
+    def _write(self, text):
+        self.wfile.write(text.encode("utf-8"))
+        self.wfile.flush()
+
+    def do_POST(self):
+        try:
+            body = self._read_json()
+        except ValueError:
+            self.send_error(400, "Invalid JSON")
+            return
+        if self.path.rstrip("/").endswith("/chat/completions"):
+            self._openai(body)
+        elif self.path.rstrip("/") == "/api/chat":
+            self._vercel(body)
+        else:
+            self.send_error(404)
+
+    def _openai(self, body):
+        time.sleep(self.delay)
+        reply = self.luna.reply(body.get("messages", []))
+        model = body.get("model", "fake-luna")
+        if not body.get("stream"):
+            payload = json.dumps({
+                "id": f"chatcmpl-{uuid.uuid4().hex[:12]}",
+                "object": "chat.completion",
+                "model": model,
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": reply}, "finish_reason": "stop"}],
+            }).encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+            return
+        self._start_stream("text/event-stream")
+        for part in chunks(reply):
+            event = {"object": "chat.completion.chunk", "model": model,
+                     "choices": [{"index": 0, "delta": {"content": part}, "finish_reason": None}]}
+            self._write(f"data: {json.dumps(event, ensure_ascii=False)}\n\n")
+        self._write("data: [DONE]\n\n")
+
+    def _vercel(self, body):
+        time.sleep(self.delay)
+        reply = self.luna.reply(body.get("messages", []))
+        conversation_id = (body.get("data") or {}).get("conversationId") or str(uuid.uuid4())
+        self._start_stream("text/plain; charset=utf-8", [("x-conversation-id", conversation_id)])
+        for part in chunks(reply):
+            self._write(f"0:{json.dumps(part, ensure_ascii=False)}\n")
+        self._write('d:{"finishReason":"stop"}\n')
+
+
+def make_server(host="127.0.0.1", port=8765, script=None, delay=0.0):
+    """Tworzy (nie uruchamia) serwer; port 0 wybiera wolny port (server.server_address)."""
+    handler = type("ScriptedChatHandler", (ChatHandler,), {"luna": ScriptedLuna(script or DEFAULT_SCRIPT), "delay": delay})
+    return ThreadingHTTPServer((host, port), handler)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Lokalny serwer czatu zwracający odpowiedzi ze skryptu.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--script", help="plik JSON z listą odpowiedzi")
+    parser.add_argument("--delay", type=float, default=0.0, help="opóźnienie odpowiedzi (s)")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(levelname)s] %(message)s")
+    script = None
+    if args.script:
+        with open(args.script, "r", encoding="utf-8") as f:
+            script = json.load(f)
+    server = make_server(args.host, args.port, script, args.delay)
+    logging.info("Fake chat server nasłuchuje na http://%s:%d", *server.server_address)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
@@ -0,0 +1,269 @@
+# -*- coding: utf-8 -*-
+"""
+--------------------------------------------------
+    SERWER – WYKONYWANIE POLECEŃ
+--------------------------------------------------
+
+Podział wiadomości na polecenia (prefiksy), kolejka zadań z limitami równoległości
+per prefiks (CommandExecutor) i kontekst zadania obsługiwanego w bieżącym wątku.
+--------------------------------------------------
+"""
+
+import time
+import logging
+import threading
+import itertools
+import re
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from luna_metrics import metrics
+
+# Ustawienia globalne – lista prefiksów (możesz ją rozszerzać, jeśli potrzebujesz)
+ALLOWED_PREFIXES = ["L:>P", "L:>L", "!PAMIETNIK!", "!OBRAZEK!", "L:>CMD", "%LOAD%", "L:>WIA", "L:>AKC", "L:>SZU"]
+
+# Równoległe wykonywanie komend – handlery działają w puli wątków, a pętla czatu dalej czyta wiadomości.
+WORKER_THREADS = 4
+# Limit jednocześnie wykonywanych zadań dla danego prefiksu (pozostałe prefiksy: DEFAULT_PREFIX_CONCURRENCY)
+# (obowiązuje też polecenia z partii). Zapisy do pamięci mogą iść równolegle – magazyn sam rezerwuje nazwy.
+PREFIX_CONCURRENCY = {"L:>CMD": 2, "%LOAD%": 2,
+                      "L:>P": 4, "L:>L": 4, "!PAMIETNIK!": 4, "!OBRAZEK!": 4, "L:>WIA": 4, "L:>AKC": 4}
+DEFAULT_PREFIX_CONCURRENCY = 1
+JOB_DEADLINE = 120  # po tylu sekundach zadanie jest anulowane
+# Kilka poleceń w jednej wiadomości (każde od nowej linii): wykonywane jako jedna partia z jedną odpowiedzią
+BATCH_PREFIX = "PARTIA"  # etykieta zadania-partii w kolejce (limity równoległości, logi, metryki)
+BATCH_WORKERS = 4
+
+
+# Stan bieżącego zadania/sesji w wątku – przestrzeń nazw pamięci, zdarzenie anulowania
+job_context = threading.local()
+
+def current_namespace():
+    """Przestrzeń nazw pamięci sesji obsługiwanej w bieżącym wątku (None = domyślna)."""
+    return getattr(job_context, "namespace", None)
+
+
+_COMMAND_START_RE = re.compile(
+    r"^[ \t]*(?:" + "|".join(re.escape(p) for p in sorted(ALLOWED_PREFIXES, key=len, reverse=True)) + ")",
+    re.MULTILINE)
+
+def split_commands(message):
+    """
+    Dzieli wiadomość na polecenia: nowe polecenie zaczyna się od prefiksu na początku linii.
+    Wiadomość, która nie zaczyna się od prefiksu, zostaje w całości (jedno polecenie).
+    """
+    msg = message.strip()
+    starts = [m.start() for m in _COMMAND_START_RE.finditer(msg)]
+    if not starts or starts[0] != 0:
+        return [msg]
+    return [msg[a:b].strip() for a, b in zip(starts, starts[1:] + [len(msg)])]
+
+
+def detect_prefix(message):
+    """Zwraca prefiks z ALLOWED_PREFIXES, od którego zaczyna się wiadomość, albo None."""
+    msg = message.strip()
+    for prefix in ALLOWED_PREFIXES:
+        if msg.startswith(prefix):
+            return prefix
+    return None
+
+
+def current_cancel_event():
+    """Zwraca zdarzenie anulowania zadania wykonywanego w bieżącym wątku (albo None)."""
+    return getattr(job_context, "cancel_event", None)
+
+
+class CommandJob:
+    """Pojedyncza wiadomość przekazana do wykonania w puli wątków."""
+
+    def __init__(self, job_id, message, prefix, prefixes=None):
+        self.id = job_id
+        self.message = message
+        self.prefix = prefix
+        self.prefixes = prefixes or [prefix]  # prefiksy wszystkich poleceń (partia ma ich kilka)
+        self.cancel_event = threading.Event()
+        self.done = threading.Event()
+        self.response = None
+        self.submitted = time.monotonic()
+        self.started = None
+        self.dispatched = False
+        self.cycle = getattr(job_context, "cycle", None)  # cykl, w którym przyjęto wiadomość (korelacja logów)
+        self.finished = None
+
+
+class CommandExecutor:
+    """
+    Wykonuje handlery prefiksów poza pętlą czatu, w puli wątków.
+    Pilnuje limitów równoległości per prefiks (PREFIX_CONCURRENCY), pozwala anulować
+    zadania, a gotowe odpowiedzi oddaje (pop_ready) w kolejności przyjęcia wiadomości.
+    Kilka sesji może dzielić jedną pulę wątków (pool); handlery działają wtedy
+    w przestrzeni nazw pamięci swojej sesji (namespace). Wiadomość wykonuje handler
+    (w serwerze process_incoming_message), który zwraca odpowiedź albo None.
+    """
+
+    def __init__(self, handler, workers=WORKER_THREADS, pool=None, namespace=None):
+        self.handler = handler
+        self.owns_pool = pool is None
+        self.pool = pool or ThreadPoolExecutor(max_workers=workers, thread_name_prefix="luna-cmd")
+        self.namespace = namespace
+        self.lock = threading.Lock()
+        self.slot_freed = threading.Condition(self.lock)
+        self.ids = itertools.count(1)
+        self.order = deque()  # wszystkie nieodebrane zadania, w kolejności przyjęcia
+        self.waiting = {}  # prefiks -> kolejka zadań czekających na wolne miejsce
+        self.running = {}  # prefiks -> liczba wykonywanych zadań i poleceń z partii
+        self._batch_pool = None  # tworzona przy pierwszej partii (batch_pool)
+        self.results_ready = threading.Event()  # ustawiane, gdy pop_ready ma co oddać (budzi pętlę sesji)
+
+    def submit(self, message):
+        """Przyjmuje wiadomość do wykonania i zwraca obiekt CommandJob."""
+        prefixes = [detect_prefix(command) for command in split_commands(message)]
+        prefix = BATCH_PREFIX if len(prefixes) > 1 else prefixes[0]
+        with self.lock:
+            job = CommandJob(next(self.ids), message, prefix, prefixes)
+            self.order.append(job)
+            self.waiting.setdefault(prefix, deque()).append(job)
+            self._dispatch(prefix)
+        metrics.inc("luna_jobs_submitted_total", prefix=prefix or "brak")
+        logging.info("Zadanie #%d (%s) przyjęte do wykonania.", job.id, prefix)
+        return job
+
+    def _dispatch(self, prefix):
+        # Caller holds self.lock
+        limit = PREFIX_CONCURRENCY.get(prefix, DEFAULT_PREFIX_CONCURRENCY)
+        queue = self.waiting.get(prefix)
+        while queue and self.running.get(prefix, 0) < limit:
+            job = queue.popleft()
+            job.dispatched = True
+            self.running[prefix] = self.running.get(prefix, 0) + 1
+            self.pool.submit(self._run, job)
+
+    def acquire_slot(self, prefix, cancel_event=None):
+        """
+        Zajmuje miejsce prefiksu dla polecenia z partii (te same liczniki co zadania).
+        Czeka na wolne miejsce; zwraca False, jeśli partię anulowano w trakcie czekania.
+        """
+        limit = PREFIX_CONCURRENCY.get(prefix, DEFAULT_PREFIX_CONCURRENCY)
+        with self.lock:
+            while self.running.get(prefix, 0) >= limit:
+                if cancel_event is not None and cancel_event.is_set():
+                    return False
+                self.slot_freed.wait(timeout=0.5)
+            self.running[prefix] = self.running.get(prefix, 0) + 1
+        return True
+
+    def release_slot(self, prefix):
+        """Zwalnia miejsce zajęte przez acquire_slot i uruchamia oczekujące zadania."""
+        with self.lock:
+            self.running[prefix] -= 1
+            self._dispatch(prefix)
+            self.slot_freed.notify_all()
+
+    def batch_pool(self):
+        """Pula wątków dla równoległych poleceń z partii, tworzona przy pierwszym użyciu."""
+        with self.lock:
+            if self._batch_pool is None:
+                self._batch_pool = ThreadPoolExecutor(max_workers=BATCH_WORKERS, thread_name_prefix="luna-batch")
+            return self._batch_pool
+
+    def _run(self, job):
+        job.started = time.monotonic()
+        prefix = job.prefix or "brak"
+        metrics.observe("luna_queue_wait_seconds", job.started - job.submitted, prefix=prefix)
+        job_context.cancel_event = job.cancel_event
+        job_context.namespace = self.namespace
+        job_context.cycle, job_context.job = job.cycle, job.id
+        job_context.executor = self
+        try:
+            if job.cancel_event.is_set():
+                response = "ERR:>LOG <_> Error: Zadanie anulowane."
+            else:
+                response = self.handler(job.message)
+        except Exception as e:
+            logging.exception("Błąd w zadaniu #%d: %s", job.id, e)
+            response = f"ERR:>LOG <_> Error: {e}"
+        finally:
+            job_context.cancel_event = None
+            job_context.namespace = None
+            job_context.cycle = job_context.job = None
+            job_context.executor = None
+        metrics.observe("luna_dispatch_seconds", time.monotonic() - job.started, prefix=prefix)
+        metrics.inc("luna_jobs_total", prefix=prefix, status="error" if str(response).startswith("ERR:>") else "ok")
+        logging.info("Zadanie #%d (%s) zakończone po %.2f s.", job.id, job.prefix, time.monotonic() - job.submitted)
+        self._finish(job, response)
+
+    def _finish(self, job, response):
+        with self.lock:
+            if job.done.is_set():
+                return
+            job.response = response
+            job.finished = time.monotonic()
+            job.done.set()
+            if self.order and self.order[0].done.is_set():
+                self.results_ready.set()
+            if job.dispatched:
+                self.running[job.prefix] -= 1
+                self._dispatch(job.prefix)
+                self.slot_freed.notify_all()
+
+    def cancel(self, job, reason="anulowane"):
+        """Anuluje zadanie: oczekujące usuwa z kolejki, wykonywanemu ustawia flagę anulowania."""
+        job.cancel_event.set()
+        with self.lock:
+            queue = self.waiting.get(job.prefix)
+            queued = queue is not None and job in queue
+            if queued:
+                queue.remove(job)
+        if queued:
+            logging.info("Zadanie #%d anulowane przed uruchomieniem (%s).", job.id, reason)
+            self._finish(job, f"ERR:>LOG <_> Error: Zadanie {job.prefix} {reason}.")
+        else:
+            logging.warning("Anulowanie wykonywanego zadania #%d (%s).", job.id, reason)
+
+    def cancel_all(self, reason="anulowane"):
+        """Anuluje wszystkie nieukończone zadania."""
+        with self.lock:
+            jobs = [job for job in self.order if not job.done.is_set()]
+        for job in jobs:
+            self.cancel(job, reason)
+
+    def check_deadlines(self, grace=5):
+        """
+        Anuluje zadania, które trwają dłużej niż JOB_DEADLINE. Jeśli handler nie zareaguje
+        na anulowanie w ciągu grace sekund, zadanie jest zamykane z błędem, żeby nie
+        blokowało odpowiedzi na kolejne wiadomości.
+        """
+        now = time.monotonic()
+        with self.lock:
+            overdue = [job for job in self.order
+                       if not job.done.is_set() and now - job.submitted > JOB_DEADLINE]
+        for job in overdue:
+            if not job.cancel_event.is_set():
+                self.cancel(job, f"przekroczyło limit {JOB_DEADLINE} s")
+            elif now - job.submitted > JOB_DEADLINE + grace:
+                logging.error("Zadanie #%d nie reaguje na anulowanie – zwalniam kolejkę odpowiedzi.", job.id)
+                self._finish(job, f"ERR:>LOG <_> Error: Zadanie {job.prefix} przekroczyło limit {JOB_DEADLINE} s.")
+
+    def pop_ready(self):
+        """Zwraca gotowe zadania z początku kolejki – odpowiedzi wychodzą w kolejności wiadomości."""
+        ready = []
+        with self.lock:
+            while self.order and self.order[0].done.is_set():
+                ready.append(self.order.popleft())
+            self.results_ready.clear()
+        return ready
+
+    def pending(self):
+        """Liczba zadań, których odpowiedzi jeszcze nie odebrano."""
+        with self.lock:
+            return len(self.order)
+
+    def shutdown(self):
+        """Anuluje zadania i zamyka pulę wątków."""
+        self.cancel_all("przerwane przy zamykaniu serwera")
+        if self.owns_pool:
+            self.pool.shutdown(wait=False)
+        with self.lock:
+            batch_pool, self._batch_pool = self._batch_pool, None
+        if batch_pool is not None:
+            batch_pool.shutdown(wait=False)
@@ -0,0 +1,228 @@
+# -*- coding: utf-8 -*-
+"""
+--------------------------------------------------
+    SERWER – METRYKI
+--------------------------------------------------
+
+Liczniki, histogramy i mierniki w pamięci (Metrics), endpoint Prometheusa
+/metrics, okresowe migawki JSON w logs/metrics.jsonl oraz LogBody – skrócone
+treści wiadomości w logach.
+--------------------------------------------------
+"""
+
+import os
+import time
+import logging
+import datetime
+import threading
+import itertools
+import hashlib
+import bisect
+import json
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+# Metryki: lokalny endpoint w formacie Prometheusa (/metrics) i okresowe migawki JSON w logs/
+METRICS_ENABLED = True
+METRICS_HOST = "127.0.0.1"
+METRICS_PORT = 9464
+METRICS_SNAPSHOT_FILE = os.path.join("logs", "metrics.jsonl")
+METRICS_SNAPSHOT_INTERVAL = 60  # co ile sekund dopisywać migawkę (0 = wyłączone)
+METRICS_BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120]  # sekundy
+METRIC_DEFINITIONS = {
+    "luna_cycle_seconds": ("histogram", "Czas jednego cyklu sesji (bez oczekiwania na zdarzenie)."),
+    "luna_wait_seconds": ("histogram", "Czas oczekiwania na nową wiadomość."),
+    "luna_scrape_seconds": ("histogram", "Czas pobrania nowych wiadomości."),
+    "luna_turns_total": ("counter", "Liczba pobranych nowych wiadomości Luny."),
+    "luna_selector_fallbacks_total": ("counter", "Ile razy zapamiętany selektor nie zadziałał i użyto innego."),
+    "luna_stale_elements_total": ("counter", "Liczba błędów stale element."),
+    "luna_dispatch_seconds": ("histogram", "Czas wykonania handlera prefiksu."),
+    "luna_queue_wait_seconds": ("histogram", "Czas oczekiwania zadania w kolejce przed uruchomieniem."),
+    "luna_jobs_submitted_total": ("counter", "Liczba zadań przyjętych do wykonania według prefiksu."),
+    "luna_jobs_total": ("counter", "Liczba zakończonych zadań według prefiksu i wyniku."),
+    "luna_subprocess_seconds": ("histogram", "Czas działania komend L:>CMD."),
+    "luna_cmd_output_bytes_total": ("counter", "Liczba bajtów wyniku komend L:>CMD."),
+    "luna_cmd_spills_total": ("counter", "Ile razy wynik L:>CMD zapisano do pliku zamiast w odpowiedzi."),
+    "luna_compaction_seconds": ("histogram", "Czas jednego przebiegu kompaktowania i retencji."),
+    "luna_compaction_saved_bytes_total": ("counter", "Bajty zaoszczędzone przez kompresję (pamięć i logi)."),
+    "luna_retention_removed_total": ("counter", "Liczba wpisów i plików usuniętych przez retencję."),
+    "luna_send_seconds": ("histogram", "Czas wysłania wiadomości (wstawienie tekstu i wysłanie)."),
+    "luna_send_failures_total": ("counter", "Liczba nieudanych wysłań wiadomości."),
+    "luna_recovery_actions_total": ("counter", "Działania naprawcze HealthMonitor (odświeżenie, nawigacja, instrukcja)."),
+    "luna_page_refreshes_total": ("counter", "Liczba odświeżeń strony."),
+    "luna_queue_depth": ("gauge", "Liczba zadań sesji, których odpowiedzi nie zostały jeszcze wysłane."),
+    "luna_outbox_depth": ("gauge", "Liczba postów czekających w kolejce wychodzącej."),
+    "luna_outbox_merged_total": ("counter", "Liczba komunikatów scalonych z innymi w jeden post."),
+    "luna_outbox_retries_total": ("counter", "Liczba ponowień nieudanego wysłania."),
+}
+
+# Treści wiadomości w logach (LogBody) są skracane; pełną treść identyfikuje skrót SHA-1
+LOG_BODY_CHARS = 200
+
+
+class Metrics:
+    """
+    Rejestr metryk: liczniki, wskaźniki (gauge) i histogramy z etykietami.
+    Bezpieczny wątkowo; render() zwraca format tekstowy Prometheusa,
+    snapshot() – słownik do zapisu jako JSON.
+    """
+
+    def __init__(self, definitions=METRIC_DEFINITIONS, buckets=METRICS_BUCKETS):
+        self.lock = threading.Lock()
+        self.definitions = dict(definitions)
+        self.buckets = list(buckets)
+        self.values = {}  # (nazwa, etykiety) -> wartość licznika/wskaźnika
+        self.histograms = {}  # (nazwa, etykiety) -> [liczności kubełków..., suma, liczba]
+
+    @staticmethod
+    def _key(name, labels):
+        return name, tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+    def inc(self, name, value=1, **labels):
+        key = self._key(name, labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        with self.lock:
+            self.values[self._key(name, labels)] = value
+
+    def observe(self, name, value, **labels):
+        key = self._key(name, labels)
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = [0] * len(self.buckets) + [0.0, 0]
+            index = bisect.bisect_left(self.buckets, value)
+            if index < len(self.buckets):
+                histogram[index] += 1
+            histogram[-2] += value
+            histogram[-1] += 1
+
+    @contextmanager
+    def timer(self, name, **labels):
+        """Mierzy czas bloku with i zapisuje go w histogramie name (sekundy)."""
+        started = time.perf_counter()
+        try:
+            yield labels
+        finally:
+            self.observe(name, time.perf_counter() - started, **labels)
+
+    @staticmethod
+    def _labels(pairs, extra=()):
+        pairs = list(pairs) + list(extra)
+        if not pairs:
+            return ""
+        escape = lambda v: v.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        return "{" + ",".join(f'{k}="{escape(v)}"' for k, v in pairs) + "}"
+
+    def render(self):
+        """Zwraca wszystkie metryki w formacie tekstowym Prometheusa."""
+        with self.lock:
+            values = sorted(self.values.items())
+            histograms = sorted((key, list(data)) for key, data in self.histograms.items())
+        lines, described = [], set()
+        def describe(name, default_kind):
+            if name not in described:
+                kind, help_text = self.definitions.get(name, (default_kind, name))
+                lines.append(f"# HELP {name} {help_text}")
+                lines.append(f"# TYPE {name} {kind}")
+                described.add(name)
+        for (name, labels), value in values:
+            describe(name, "counter")
+            lines.append(f"{name}{self._labels(labels)} {value}")
+        for (name, labels), data in histograms:
+            describe(name, "histogram")
+            cumulative = 0
+            for bound, count in zip(self.buckets, data):
+                cumulative += count
+                lines.append(f"{name}_bucket{self._labels(labels, [('le', repr(float(bound)))])} {cumulative}")
+            lines.append(f"{name}_bucket{self._labels(labels, [('le', '+Inf')])} {data[-1]}")
+            lines.append(f"{name}_sum{self._labels(labels)} {data[-2]}")
+            lines.append(f"{name}_count{self._labels(labels)} {data[-1]}")
+        return "\n".join(lines) + "\n"
+
+    def snapshot(self):
+        """Zwraca metryki jako słownik: liczniki/wskaźniki oraz histogramy (liczba, suma, średnia, kubełki)."""
+        with self.lock:
+            values = list(self.values.items())
+            histograms = [(key, list(data)) for key, data in self.histograms.items()]
+        result = {"timestamp": datetime.datetime.now().isoformat(timespec="seconds"), "values": [], "histograms": []}
+        for (name, labels), value in sorted(values):
+            result["values"].append({"name": name, "labels": dict(labels), "value": value})
+        for (name, labels), data in sorted(histograms):
+            count, total = data[-1], data[-2]
+            result["histograms"].append({
+                "name": name, "labels": dict(labels), "count": count, "sum": round(total, 6),
+                "mean": round(total / count, 6) if count else None,
+                "buckets": dict(zip((str(b) for b in self.buckets), itertools.accumulate(data[:-2]))),
+            })
+        return result
+
+
+metrics = Metrics()
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] == "/metrics":
+            body, content_type = metrics.render().encode("utf-8"), "text/plain; version=0.0.4; charset=utf-8"
+        elif self.path.split("?")[0] == "/metrics.json":
+            body, content_type = json.dumps(metrics.snapshot(), ensure_ascii=False).encode("utf-8"), "application/json"
+        else:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass # Scrapes every few seconds would flood the server log
+
+
+def start_metrics_server(host=METRICS_HOST, port=METRICS_PORT):
+    """Uruchamia w tle lokalny endpoint /metrics (Prometheus) i /metrics.json. Zwraca serwer albo None."""
+    try:
+        http_server = ThreadingHTTPServer((host, port), _MetricsHandler)
+    except OSError as e:
+        logging.warning("Nie udało się uruchomić endpointu metryk na %s:%d: %s", host, port, e)
+        return None
+    http_server.daemon_threads = True
+    threading.Thread(target=http_server.serve_forever, name="luna-metrics", daemon=True).start()
+    logging.info("Metryki dostępne pod http://%s:%d/metrics", host, http_server.server_address[1])
+    return http_server
+
+
+def start_metrics_snapshots(path=METRICS_SNAPSHOT_FILE, interval=METRICS_SNAPSHOT_INTERVAL):
+    """Co interval sekund dopisuje migawkę metryk (jedna linia JSON) do pliku w logs/. Zwraca Event zatrzymania."""
+    stop = threading.Event()
+    def loop():
+        while not stop.wait(interval):
+            try:
+                with open(path, "a", encoding="utf-8") as f:
+                    f.write(json.dumps(metrics.snapshot(), ensure_ascii=False) + "\n")
+            except OSError as e:
+                logging.warning("Nie udało się zapisać migawki metryk: %s", e)
+    threading.Thread(target=loop, name="luna-metrics-snapshot", daemon=True).start()
+    return stop
+
+
+class LogBody:
+    """
+    Treść wiadomości jako argument logu: w komunikacie skrócona do LOG_BODY_CHARS znaków;
+    długość i skrót SHA-1 całości trafiają do pól rekordu (body_len, body_sha1).
+    """
+
+    __slots__ = ("text", "digest")
+
+    def __init__(self, text):
+        self.text = text or ""
+        self.digest = hashlib.sha1(self.text.encode("utf-8")).hexdigest()[:12]
+
+    def __str__(self):
+        if len(self.text) <= LOG_BODY_CHARS:
+            return self.text
+        return f"{self.text[:LOG_BODY_CHARS]}... [{len(self.text)} znaków, sha1 {self.digest}]"
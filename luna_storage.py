@@ -0,0 +1,1180 @@
+# -*- coding: utf-8 -*-
+"""
+--------------------------------------------------
+    SERWER – MAGAZYN PAMIĘCI I STAN SESJI
+--------------------------------------------------
+
+Segmentowany magazyn pamięci (opcjonalnie SQLite WAL) z archiwami gzip, przestrzenie
+nazw sesji, indeks pełnotekstowy (L:>SZU) oraz trwały stan sesji w state/ –
+historia przetworzonych wiadomości i dziennik przekazań do wykonania.
+--------------------------------------------------
+"""
+
+import os
+import time
+import logging
+import datetime
+import threading
+import itertools
+import struct
+import bisect
+import sqlite3
+import re
+import json
+import math
+import heapq
+import unicodedata
+import gzip
+from collections import OrderedDict
+
+from luna_executor import current_namespace
+
+# Definicje katalogów (używamy ścieżek względnych – jeśli cały projekt znajduje się np. w F:\Lunafreya_server)
+MESSAGES_TO_ME_DIR = os.path.join("memory", "wiadomosci_do_ciebie")
+MEMORY_DIR = os.path.join("memory", "rozmyslania")
+PAMIECIANKA_DIR = os.path.join("memory", "pamietniki")
+OBRAZY_DIR = os.path.join("memory", "obrazy")
+WIADOMOSCI_DIR = os.path.join("memory", "wiadomosci")
+AKCJE_DIR = os.path.join("memory", "akcje")
+# Stan serwera (poza 'memory/', żeby Luna nie wczytywała go przez %LOAD%)
+STATE_DIR = "state"
+SEEN_INDEX_FILE = os.path.join(STATE_DIR, "seen_messages.log")
+SEEN_CAPACITY = 10000  # ile ostatnich przetworzonych wiadomości pamiętamy
+# Dziennik wiadomości przekazanych do wykonania – po restarcie niedokończone są wykonywane ponownie
+DISPATCH_JOURNAL_FILE = os.path.join(STATE_DIR, "dispatched.jsonl")
+DISPATCH_JOURNAL_COMPACT_LINES = 1000  # po tylu liniach dziennik jest przepisywany (tylko niedokończone)
+
+# Magazyn pamięci: "segments" (segmentowane logi + indeks przesunięć) albo "sqlite" (SQLite w trybie WAL)
+MEMORY_BACKEND = "segments"
+SEGMENT_MAX_BYTES = 8 * 1024 * 1024  # rozmiar, po którym zaczynamy nowy segment
+GROUP_COMMIT_WINDOW = 0.005  # ile sekund czekamy na kolejne zapisy przed wspólnym fsync
+CMD_SPILL_PREFIX = "cmd-"  # pliki z pełnym wynikiem L:>CMD: memory/akcje/cmd-YYYY-MM-DD-HHMMSS.txt (nie są indeksowane)
+ARCHIVE_BLOCK_BYTES = 256 * 1024  # archiwa to ciąg niezależnych bloków gzip – odczyt wpisu rozpakowuje tylko jego bloki
+
+# Wyszukiwanie pełnotekstowe w pamięci (L:>SZU)
+SEARCH_INDEX_FILE = os.path.join(STATE_DIR, "search_index.jsonl")
+SEARCH_RESULTS = 5  # ile najlepszych wyników zwracamy
+SEARCH_SNIPPET_CHARS = 300  # długość fragmentu tekstu przy wyniku
+SEARCH_MIN_TOKEN = 2  # krótsze tokeny nie są indeksowane
+SEARCH_INDEX_COMPACT_LINES = 1000  # tyle nieaktualnych linii dziennika indeksu => przepisanie przy starcie
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+
+class SeenIndex:
+    """
+    Trwały, ograniczony zbiór kluczy przetworzonych wiadomości (turn_key).
+    Klucze dopisywane są do dziennika na dysku, więc przetrwają odświeżenie strony
+    i restart serwera; w pamięci trzymamy ostatnie `capacity` kluczy (sprawdzenie w O(1)).
+    """
+
+    def __init__(self, path=SEEN_INDEX_FILE, capacity=SEEN_CAPACITY):
+        self.path = path
+        self.capacity = capacity
+        self.keys = OrderedDict()
+        self.journal_lines = 0
+        self.existed = os.path.exists(path)
+        if self.existed:
+            with open(path, "r", encoding="utf-8") as f:
+                for line in f:
+                    key = line.strip()
+                    if key:
+                        self.journal_lines += 1
+                        self._remember(key)
+        self.journal = open(path, "a", encoding="utf-8")
+
+    def _remember(self, key):
+        self.keys[key] = True
+        self.keys.move_to_end(key)
+        while len(self.keys) > self.capacity:
+            self.keys.popitem(last=False)
+
+    def __contains__(self, key):
+        return key in self.keys
+
+    def __len__(self):
+        return len(self.keys)
+
+    def add(self, key):
+        """Zapamiętuje klucz i od razu utrwala go na dysku."""
+        if key in self.keys:
+            return
+        self._remember(key)
+        self.journal.write(key + "\n")
+        self.journal.flush()
+        os.fsync(self.journal.fileno())
+        self.journal_lines += 1
+        if self.journal_lines > 2 * self.capacity:
+            self._compact()
+
+    def _compact(self):
+        """Przepisuje dziennik tak, by zawierał tylko klucze trzymane w pamięci."""
+        self.journal.close()
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.writelines(key + "\n" for key in self.keys)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+        self.journal_lines = len(self.keys)
+        self.journal = open(self.path, "a", encoding="utf-8")
+
+    def close(self):
+        self.journal.close()
+
+
+class DispatchJournal:
+    """
+    Dziennik wiadomości przekazanych do wykonania: wpis przy przekazaniu (klucz i treść)
+    i osobny znacznik, gdy odpowiedź handlera trafi do kolejki wychodzącej. Po restarcie
+    wiadomości bez znacznika są wykonywane ponownie, więc żadne polecenie nie ginie między
+    przyjęciem a wykonaniem. Awaria po wykonaniu handlera, a przed zapisaniem znacznika,
+    oznacza ponowne wykonanie tego jednego polecenia.
+    """
+
+    def __init__(self, path=DISPATCH_JOURNAL_FILE):
+        self.path = path
+        self.pending = OrderedDict()  # klucz -> treść wiadomości
+        self.lines = 0
+        if os.path.exists(path):
+            with open(path, "r", encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        continue  # torn last line after a crash
+                    self.lines += 1
+                    if record.get("done"):
+                        self.pending.pop(record["key"], None)
+                    else:
+                        self.pending[record["key"]] = record["text"]
+        self.journal = open(path, "a", encoding="utf-8")
+
+    def _write(self, record):
+        self.journal.write(json.dumps(record, ensure_ascii=False) + "\n")
+        self.journal.flush()
+        os.fsync(self.journal.fileno())
+        self.lines += 1
+
+    def dispatched(self, key, text):
+        """Utrwala przekazanie wiadomości do wykonania (przed oznaczeniem jej jako widzianej)."""
+        self.pending[key] = text
+        self._write({"key": key, "text": text})
+
+    def finished(self, key):
+        """Utrwala zakończenie – odpowiedź jest już w kolejce wychodzącej."""
+        if self.pending.pop(key, None) is None:
+            return
+        self._write({"key": key, "done": True})
+        if self.lines > DISPATCH_JOURNAL_COMPACT_LINES:
+            self._compact()
+
+    def unfinished(self):
+        return list(self.pending.items())
+
+    def _compact(self):
+        """Przepisuje dziennik tak, by zawierał tylko niedokończone wiadomości."""
+        self.journal.close()
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.writelines(json.dumps({"key": key, "text": text}, ensure_ascii=False) + "\n"
+                         for key, text in self.pending.items())
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+        self.lines = len(self.pending)
+        self.journal = open(self.path, "a", encoding="utf-8")
+
+    def close(self):
+        self.journal.close()
+
+
+# Magazyn pamięci: segmentowane logi (tylko dopisywanie) z indeksem przesunięć
+
+# Kategorie pamięci – nazwa kategorii odpowiada katalogowi w 'memory/'
+MEMORY_ROOT = "memory"
+MEMORY_CATEGORIES = [
+    os.path.basename(d) for d in (MESSAGES_TO_ME_DIR, MEMORY_DIR, PAMIECIANKA_DIR, OBRAZY_DIR, WIADOMOSCI_DIR, AKCJE_DIR)
+]
+
+
+def append_gzip_blocks(handle, chunks, start=0, block_bytes=ARCHIVE_BLOCK_BYTES):
+    """
+    Dopisuje dane do otwartego pliku jako ciąg niezależnych członów gzip (po ok. block_bytes).
+    Zwraca listę bloków [początek w danych, przesunięcie w pliku, długość członu];
+    start to pozycja pierwszego bajtu w nieskompresowanych danych.
+    """
+    blocks = []
+    buffer = bytearray()
+    position = start
+
+    def flush():
+        nonlocal position
+        offset = handle.tell()
+        handle.write(gzip.compress(bytes(buffer), mtime=0))
+        blocks.append([position, offset, handle.tell() - offset])
+        position += len(buffer)
+        buffer.clear()
+
+    for chunk in chunks:
+        buffer += chunk
+        if len(buffer) >= block_bytes:
+            flush()
+    if buffer:
+        flush()
+    return blocks
+
+def read_gzip_blocks(path, blocks, offset, length):
+    """Czyta bajty [offset, offset+length) danych skompresowanych przez append_gzip_blocks."""
+    i = max(bisect.bisect_right([block[0] for block in blocks], offset) - 1, 0)
+    out = bytearray()
+    with open(path, "rb") as f:
+        while len(out) < length and i < len(blocks):
+            start, file_offset, size = blocks[i]
+            f.seek(file_offset)
+            data = gzip.decompress(f.read(size))
+            skip = max(offset - start, 0)
+            out += data[skip:skip + length - len(out)]
+            i += 1
+    return bytes(out)
+
+def write_json_atomic(path, data):
+    """Zapisuje JSON przez plik tymczasowy i os.replace (bez częściowego pliku po awarii)."""
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(data, f, ensure_ascii=False)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+class MemoryArchive:
+    """
+    Archiwa starych plików .txt kategorii (sprzed magazynu segmentowego): miesięczne
+    memory/<kategoria>/archive/YYYY-MM.gz (bloki gzip) z indeksem YYYY-MM.json
+    {"size": ..., "blocks": [...], "entries": {nazwa pliku: [przesunięcie, długość, mtime]}}.
+    """
+
+    def __init__(self, root):
+        self.root = root
+        self.lock = threading.Lock()
+        self.indexes = {}  # (kategoria, miesiąc) -> indeks
+
+    def _dir(self, category):
+        return os.path.join(self.root, category, "archive")
+
+    @staticmethod
+    def month_of(filename, mtime):
+        match = re.match(r"(\d{4}-\d{2})-\d{2}", filename)
+        return match.group(1) if match else datetime.datetime.fromtimestamp(mtime).strftime("%Y-%m")
+
+    def names(self, category):
+        """Nazwy wszystkich zarchiwizowanych plików kategorii."""
+        with self.lock:
+            return {name for month in self.months(category) for name in (self._index(category, month) or {"entries": {}})["entries"]}
+
+    def months(self, category):
+        directory = self._dir(category)
+        if not os.path.isdir(directory):
+            return []
+        return sorted(name[:-5] for name in os.listdir(directory) if name.endswith(".json"))
+
+    def _index(self, category, month):
+        key = (category, month)
+        if key not in self.indexes:
+            path = os.path.join(self._dir(category), month + ".json")
+            index = None
+            if os.path.exists(path):
+                with open(path, "r", encoding="utf-8") as f:
+                    index = json.load(f)
+            self.indexes[key] = index
+        return self.indexes[key]
+
+    def read(self, category, filename):
+        """Zwraca treść zarchiwizowanego pliku albo None."""
+        match = re.match(r"(\d{4}-\d{2})-\d{2}", filename)
+        with self.lock:
+            months = [match.group(1)] if match else self.months(category)
+            for month in months:
+                index = self._index(category, month)
+                if index and filename in index["entries"]:
+                    offset, length, _ = index["entries"][filename]
+                    blocks = index["blocks"]
+                    break
+            else:
+                return None
+        data = read_gzip_blocks(os.path.join(self._dir(category), month + ".gz"), blocks, offset, length)
+        return data.decode("utf-8", errors="replace")
+
+    def add(self, category, files):
+        """
+        Archiwizuje pliki [(nazwa, ścieżka, mtime)] i usuwa je z dysku po zapisaniu indeksu.
+        Zwraca liczbę zaoszczędzonych bajtów.
+        """
+        directory = self._dir(category)
+        os.makedirs(directory, exist_ok=True)
+        by_month = {}
+        for name, path, mtime in files:
+            by_month.setdefault(self.month_of(name, mtime), []).append((name, path, mtime))
+        saved = 0
+        for month, group in sorted(by_month.items()):
+            with self.lock:
+                index = self._index(category, month) or {"size": 0, "blocks": [], "entries": {}}
+                archive_path = os.path.join(directory, month + ".gz")
+                entries = {}
+                position = index["size"]
+                raw = 0
+
+                def contents():
+                    nonlocal position, raw
+                    for name, path, mtime in group:
+                        with open(path, "rb") as f:
+                            data = f.read()
+                        entries[name] = [position, len(data), mtime]
+                        position += len(data)
+                        raw += len(data)
+                        yield data
+
+                with open(archive_path, "ab") as f:
+                    before = f.tell()
+                    blocks = append_gzip_blocks(f, contents(), start=index["size"])
+                    f.flush()
+                    os.fsync(f.fileno())
+                    saved += raw - (f.tell() - before)
+                index = {"size": position, "blocks": index["blocks"] + blocks,
+                         "entries": {**index["entries"], **entries}}
+                write_json_atomic(os.path.join(directory, month + ".json"), index)
+                self.indexes[(category, month)] = index
+            for _, path, _ in group:
+                os.remove(path)
+        return saved
+
+    def drop_before(self, category, cutoff):
+        """Retencja: usuwa miesięczne archiwa, w których wszystkie pliki są starsze niż cutoff. Zwraca ich nazwy."""
+        removed = []
+        with self.lock:
+            for month in self.months(category):
+                index = self._index(category, month)
+                if not index or any(mtime >= cutoff for _, _, mtime in index["entries"].values()):
+                    continue
+                for suffix in (".json", ".gz"):
+                    path = os.path.join(self._dir(category), month + suffix)
+                    if os.path.exists(path):
+                        os.remove(path)
+                self.indexes.pop((category, month), None)
+                removed.extend(index["entries"])
+        return removed
+
+
+class WriteTicket:
+    """Potwierdzenie zapisu wpisu: append() czeka na nie, a błąd zapisu partii zgłasza wołającemu."""
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.error = None
+
+    def set(self, error=None):
+        self.error = error
+        self.event.set()
+
+    def wait(self):
+        self.event.wait()
+        if self.error is not None:
+            raise RuntimeError(f"Nie udało się zapisać wpisu w pamięci: {self.error}") from self.error
+
+
+class MemoryStore:
+    """
+    Magazyn wpisów pamięci: dla każdej kategorii segmentowane pliki logu
+    (memory/<kategoria>/segments/NNNNNNNN.log) oraz zwarty indeks przesunięć
+    (index.bin, rekordy stałej długości: czas, segment, przesunięcie, długość, numer).
+
+    Zapisy trafiają do kolejki, a wątek zapisujący dopisuje całą partię i robi jedno
+    fsync na kategorię (group commit). Każdy wpis ma nazwę w starym formacie
+    YYYY-MM-DD-HHMMSS (z sufiksem -N przy kilku wpisach w tej samej sekundzie),
+    więc ścieżki 'memory/<kategoria>/<nazwa>.txt' działają w %LOAD% jak dawniej.
+
+    Kompaktowanie zamyka stare segmenty i kompresuje je (NNNNNNNN.log.gz z indeksem bloków
+    NNNNNNNN.blocks.json); retencja usuwa całe zamknięte segmenty.
+    """
+
+    RECORD = struct.Struct("<dIQIH")  # timestamp, segment, offset, length, seq
+
+    def __init__(self, root=MEMORY_ROOT, categories=MEMORY_CATEGORIES, segment_max_bytes=SEGMENT_MAX_BYTES):
+        self.root = root
+        self.prefix = os.path.normpath(root).replace(os.sep, "/")  # ścieżki dokumentów: <prefix>/<kategoria>/<nazwa>.txt
+        self.categories = list(categories)
+        self.segment_max_bytes = segment_max_bytes
+        self.lock = threading.Lock()
+        self.pending = []
+        self.pending_cond = threading.Condition(self.lock)
+        self.closed = False
+        self.listeners = []  # wywoływane po zapisie: listener(category, name, text)
+        self.entries = {}  # kategoria -> lista rekordów (ts, segment, offset, length, seq, name)
+        self.timestamps = {}  # kategoria -> znaczniki czasu rekordów z entries (do bisect w query)
+        self.by_name = {}  # kategoria -> {nazwa: rekord}
+        self.last_ts = {}
+        # Nazwy przydzielone wpisom, które nie są jeszcze w by_name (w kolejce albo w zapisywanej partii)
+        self.reserved = {category: set() for category in self.categories}
+        self.writers = {}  # kategoria -> [numer segmentu, uchwyt pliku, rozmiar]
+        self.index_handles = {}
+        self.compressed = {}  # kategoria -> {numer segmentu: {"size": ..., "blocks": [...]}}
+        self.io_lock = threading.RLock()  # zapis partii vs. kompaktowanie i retencja
+        self.archive = MemoryArchive(root)
+        for category in self.categories:
+            self._load_category(category)
+        self.committer = threading.Thread(target=self._commit_loop, name="luna-memory-commit", daemon=True)
+        self.committer.start()
+
+    # --- stan na dysku ---
+
+    def _segment_dir(self, category):
+        return os.path.join(self.root, category, "segments")
+
+    def _segment_path(self, category, segment):
+        return os.path.join(self._segment_dir(category), f"{segment:08d}.log")
+
+    def _blocks_path(self, category, segment):
+        return os.path.join(self._segment_dir(category), f"{segment:08d}.blocks.json")
+
+    def _load_category(self, category):
+        seg_dir = self._segment_dir(category)
+        os.makedirs(seg_dir, exist_ok=True)
+        compressed = self.compressed[category] = {}
+        for name in os.listdir(seg_dir):
+            if name.endswith(".blocks.json") and name[:8].isdigit():
+                segment = int(name[:8])
+                # A plain segment left over after an interrupted compaction wins
+                if not os.path.exists(self._segment_path(category, segment)):
+                    with open(os.path.join(seg_dir, name), "r", encoding="utf-8") as f:
+                        compressed[segment] = json.load(f)
+        records, names = [], {}
+        index_path = os.path.join(seg_dir, "index.bin")
+        if os.path.exists(index_path):
+            with open(index_path, "rb") as f:
+                data = f.read()
+            usable = len(data) - len(data) % self.RECORD.size
+            sizes = {}
+            for ts, segment, offset, length, seq in self.RECORD.iter_unpack(data[:usable]):
+                if segment not in sizes:
+                    path = self._segment_path(category, segment)
+                    if segment in compressed:
+                        sizes[segment] = compressed[segment]["size"]
+                    else:
+                        sizes[segment] = os.path.getsize(path) if os.path.exists(path) else 0
+                if offset + length > sizes[segment]:
+                    # Torn write after a crash – the index points past the segment end
+                    logging.warning("Pominięto niekompletny wpis w indeksie kategorii %s.", category)
+                    break
+                record = (ts, segment, offset, length, seq, self._entry_name(ts, seq))
+                records.append(record)
+                names[record[5]] = record
+            if usable != len(data) or len(records) * self.RECORD.size != usable:
+                with open(index_path, "r+b") as f:
+                    f.truncate(len(records) * self.RECORD.size)
+        self.entries[category] = records
+        self.timestamps[category] = [record[0] for record in records]
+        self.by_name[category] = names
+        self.last_ts[category] = records[-1][0] if records else 0.0
+        segments = sorted(int(n[:-4]) for n in os.listdir(seg_dir) if n.endswith(".log") and n[:-4].isdigit())
+        current = max(segments[-1] if segments else 1, max(compressed, default=0) + 1)
+        path = self._segment_path(category, current)
+        handle = open(path, "ab")
+        self.writers[category] = [current, handle, handle.tell()]
+        self.index_handles[category] = open(index_path, "ab")
+
+    @staticmethod
+    def _entry_name(ts, seq):
+        name = datetime.datetime.fromtimestamp(ts).strftime("%Y-%m-%d-%H%M%S")
+        return name if seq <= 1 else f"{name}-{seq}"
+
+    # --- zapis ---
+
+    def append(self, category, text, wait=True):
+        """
+        Dopisuje wpis do kategorii i zwraca jego nazwę (YYYY-MM-DD-HHMMSS[-N]).
+        Przy wait=True czeka, aż wpis zostanie trwale zapisany (fsync partii);
+        jeśli zapis partii się nie powiódł, zgłasza RuntimeError.
+        """
+        if category not in self.entries:
+            raise ValueError(f"Nieznana kategoria pamięci: {category}")
+        data = text.encode("utf-8")
+        done = WriteTicket()
+        with self.lock:
+            if self.closed:
+                raise RuntimeError("Magazyn pamięci jest zamknięty.")
+            # Monotonic per category so time-range lookups can bisect
+            ts = max(time.time(), self.last_ts[category])
+            self.last_ts[category] = ts
+            seq = 1
+            while self._entry_name(ts, seq) in self.by_name[category] or self._entry_name(ts, seq) in self.reserved[category]:
+                seq += 1
+            name = self._entry_name(ts, seq)
+            self.reserved[category].add(name)
+            self.pending.append((category, ts, seq, name, data, text, done))
+            self.pending_cond.notify()
+        if wait:
+            done.wait()
+        return name
+
+    def _commit_loop(self):
+        while True:
+            with self.lock:
+                while not self.pending and not self.closed:
+                    self.pending_cond.wait()
+                if not self.pending and self.closed:
+                    return
+            # Give concurrent writers a moment to join this batch
+            time.sleep(GROUP_COMMIT_WINDOW)
+            with self.lock:
+                batch, self.pending = self.pending, []
+            error = None
+            try:
+                self._write_batch(batch)
+            except Exception as e:
+                logging.exception("Błąd zapisu partii do magazynu pamięci: %s", e)
+                error = e
+            with self.lock:
+                # Only now are the names visible to append() through by_name (or the database)
+                for category, _, _, name, *_ in batch:
+                    self.reserved[category].discard(name)
+            for *_, done in batch:
+                done.set(error)
+
+    def _roll_segment(self, category):
+        """Zamyka bieżący segment kategorii i zaczyna następny."""
+        writer = self.writers[category]
+        self._fsync(writer[1])
+        writer[1].close()
+        writer[0] += 1
+        writer[1] = open(self._segment_path(category, writer[0]), "ab")
+        writer[2] = 0
+
+    def _write_batch(self, batch):
+        written = []
+        touched = set()
+        with self.io_lock:
+            for category, ts, seq, name, data, text, _ in batch:
+                writer = self.writers[category]
+                if writer[2] and writer[2] + len(data) > self.segment_max_bytes:
+                    self._roll_segment(category)
+                segment, handle, offset = writer
+                handle.write(data)
+                writer[2] += len(data)
+                self.index_handles[category].write(self.RECORD.pack(ts, segment, offset, len(data), seq))
+                written.append((category, (ts, segment, offset, len(data), seq, name), text))
+                touched.add(category)
+            # One fsync per file per batch: segment data first, then the index pointing at it
+            for category in touched:
+                self._fsync(self.writers[category][1])
+            for category in touched:
+                self._fsync(self.index_handles[category])
+            with self.lock:
+                for category, record, _ in written:
+                    self.entries[category].append(record)
+                    self.timestamps[category].append(record[0])
+                    self.by_name[category][record[5]] = record
+        for category, record, text in written:
+            for listener in self.listeners:
+                try:
+                    listener(category, record[5], text)
+                except Exception as e:
+                    logging.exception("Błąd słuchacza magazynu pamięci: %s", e)
+
+    @staticmethod
+    def _fsync(handle):
+        handle.flush()
+        os.fsync(handle.fileno())
+
+    # --- odczyt ---
+
+    def _read_record(self, category, record):
+        _, segment, offset, length, _, _ = record
+        path = self._segment_path(category, segment)
+        info = self.compressed[category].get(segment)
+        if info is None:
+            try:
+                with open(path, "rb") as f:
+                    f.seek(offset)
+                    return f.read(length).decode("utf-8")
+            except FileNotFoundError:
+                info = self.compressed[category].get(segment)  # compressed in the meantime
+                if info is None:
+                    raise
+        return read_gzip_blocks(path + ".gz", info["blocks"], offset, length).decode("utf-8")
+
+    def read(self, category, name):
+        """Zwraca treść wpisu o podanej nazwie albo None."""
+        record = self.by_name.get(category, {}).get(name)
+        return self._read_record(category, record) if record else None
+
+    def query(self, category, since=None, until=None):
+        """Zwraca nazwy wpisów z przedziału czasu [since, until) – bez skanowania katalogów."""
+        with self.lock:
+            records, keys = self.entries.get(category, []), self.timestamps.get(category, [])
+            lo = bisect.bisect_left(keys, since) if since is not None else 0
+            hi = bisect.bisect_left(keys, until) if until is not None else len(keys)
+            return [r[5] for r in records[lo:hi]]
+
+    def read_day(self, category, day):
+        """Zwraca połączoną treść wszystkich wpisów z danego dnia (YYYY-MM-DD) albo None."""
+        try:
+            start = datetime.datetime.strptime(day, "%Y-%m-%d")
+        except ValueError:
+            return None
+        names = self.query(category, start.timestamp(), (start + datetime.timedelta(days=1)).timestamp())
+        if not names:
+            return None
+        return "".join(self.read(category, name) for name in names)
+
+    def read_path(self, relative_path):
+        """
+        Mapuje ścieżkę w starym formacie ('memory/<kategoria>/<nazwa>.txt') na wpis magazynu.
+        Nazwa YYYY-MM-DD oznacza wszystkie wpisy z danego dnia (jak dzienny plik pamiętnika).
+        Zwraca treść albo None, jeśli wpisu nie ma.
+        """
+        path = os.path.normpath(relative_path).replace("\\", "/")
+        if not path.startswith(self.prefix + "/"):
+            return None
+        parts = path[len(self.prefix) + 1:].split("/")
+        if len(parts) != 2:
+            return None
+        category, filename = parts
+        name = filename[:-4] if filename.endswith(".txt") else filename
+        text = self.read(category, name)
+        if text is None and category in self.categories:
+            text = self.archive.read(category, filename)
+        if text is None and len(name) == 10:
+            text = self.read_day(category, name)
+        return text
+
+    def iter_entries(self, category):
+        """Iteruje po (nazwa, treść) wszystkich wpisów kategorii."""
+        for record in list(self.entries.get(category, [])):
+            yield record[5], self._read_record(category, record)
+
+    def names(self, category):
+        """Nazwy wszystkich wpisów kategorii – bez czytania ich treści."""
+        with self.lock:
+            return [record[5] for record in self.entries.get(category, [])]
+
+    # --- kompaktowanie i retencja ---
+
+    def _segment_ages(self, category):
+        """Zwraca (bieżący segment, {segment: (najstarszy, najnowszy czas wpisu)})."""
+        with self.lock:
+            current = self.writers[category][0]
+            ages = {}
+            for ts, segment, *_ in self.entries[category]:
+                oldest, newest = ages.get(segment, (ts, ts))
+                ages[segment] = (min(oldest, ts), max(newest, ts))
+        return current, ages
+
+    def compact(self, category, before):
+        """
+        Zamyka bieżący segment, jeśli ma wpisy starsze niż before, i kompresuje zamknięte
+        segmenty, których wszystkie wpisy są starsze niż before. Zwraca zaoszczędzone bajty.
+        """
+        current, ages = self._segment_ages(category)
+        if current in ages and ages[current][0] < before:
+            with self.io_lock:
+                if self.writers[category][0] == current and self.writers[category][2]:
+                    self._roll_segment(category)
+        saved = 0
+        for segment, (_, newest) in sorted(ages.items()):
+            if segment >= current or newest >= before or segment in self.compressed[category]:
+                continue
+            path = self._segment_path(category, segment)
+            if not os.path.exists(path):
+                continue
+            with open(path, "rb") as src, open(path + ".gz", "wb") as dst:
+                blocks = append_gzip_blocks(dst, iter(lambda: src.read(ARCHIVE_BLOCK_BYTES), b""))
+                self._fsync(dst)
+                info = {"size": src.tell(), "blocks": blocks}
+                saved += info["size"] - dst.tell()
+            write_json_atomic(self._blocks_path(category, segment), info)
+            with self.io_lock:
+                self.compressed[category][segment] = info
+                os.remove(path)
+        return saved
+
+    def drop_before(self, category, cutoff):
+        """
+        Retencja: usuwa zamknięte segmenty, w których wszystkie wpisy są starsze niż cutoff
+        (indeks przesunięć jest przepisywany atomowo). Zwraca nazwy usuniętych wpisów.
+        """
+        with self.io_lock:
+            current, ages = self._segment_ages(category)
+            dropped = {segment for segment, (_, newest) in ages.items() if segment < current and newest < cutoff}
+            if not dropped:
+                return []
+            with self.lock:
+                records = list(self.entries[category])
+            keep = [record for record in records if record[1] not in dropped]
+            index_path = os.path.join(self._segment_dir(category), "index.bin")
+            tmp_path = index_path + ".tmp"
+            with open(tmp_path, "wb") as f:
+                for record in keep:
+                    f.write(self.RECORD.pack(*record[:5]))
+                self._fsync(f)
+            self.index_handles[category].close()
+            os.replace(tmp_path, index_path)
+            self.index_handles[category] = open(index_path, "ab")
+            with self.lock:
+                self.entries[category] = keep
+                self.timestamps[category] = [record[0] for record in keep]
+                self.by_name[category] = {record[5]: record for record in keep}
+            for segment in dropped:
+                self.compressed[category].pop(segment, None)
+                path = self._segment_path(category, segment)
+                for leftover in (path, path + ".gz", self._blocks_path(category, segment)):
+                    if os.path.exists(leftover):
+                        os.remove(leftover)
+        return [record[5] for record in records if record[1] in dropped]
+
+    def close(self):
+        """Zapisuje oczekujące wpisy i zamyka pliki."""
+        with self.lock:
+            self.closed = True
+            self.pending_cond.notify()
+        self.committer.join()
+        for _, handle, _ in self.writers.values():
+            handle.close()
+        for handle in self.index_handles.values():
+            handle.close()
+
+
+class SqliteMemoryStore(MemoryStore):
+    """
+    Alternatywny magazyn pamięci w SQLite (tryb WAL). Interfejs jak w MemoryStore:
+    ta sama kolejka zapisów i group commit – jedna transakcja na partię.
+    """
+
+    def __init__(self, root=MEMORY_ROOT, categories=MEMORY_CATEGORIES, **_):
+        self.root = root
+        self.prefix = os.path.normpath(root).replace(os.sep, "/")
+        self.categories = list(categories)
+        self.lock = threading.Lock()
+        self.db_lock = threading.Lock()
+        self.pending = []
+        self.pending_cond = threading.Condition(self.lock)
+        self.closed = False
+        self.listeners = []
+        self.last_ts = {}
+        self.reserved = {category: set() for category in self.categories}
+        self.archive = MemoryArchive(root)
+        os.makedirs(root, exist_ok=True)
+        self.db = sqlite3.connect(os.path.join(root, "memory.sqlite3"), check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS entries ("
+            " category TEXT NOT NULL, name TEXT NOT NULL, ts REAL NOT NULL, body TEXT NOT NULL,"
+            " PRIMARY KEY (category, name))"
+        )
+        self.db.execute("CREATE INDEX IF NOT EXISTS entries_by_time ON entries (category, ts)")
+        self.db.commit()
+        for category in self.categories:
+            row = self.db.execute("SELECT MAX(ts) FROM entries WHERE category = ?", (category,)).fetchone()
+            self.last_ts[category] = row[0] or 0.0
+        self.committer = threading.Thread(target=self._commit_loop, name="luna-memory-commit", daemon=True)
+        self.committer.start()
+
+    def append(self, category, text, wait=True):
+        if category not in self.last_ts:
+            raise ValueError(f"Nieznana kategoria pamięci: {category}")
+        done = WriteTicket()
+        with self.lock:
+            if self.closed:
+                raise RuntimeError("Magazyn pamięci jest zamknięty.")
+            ts = max(time.time(), self.last_ts[category])
+            self.last_ts[category] = ts
+            seq = 1
+            while self._entry_name(ts, seq) in self.reserved[category] or self._exists(category, self._entry_name(ts, seq)):
+                seq += 1
+            name = self._entry_name(ts, seq)
+            self.reserved[category].add(name)
+            self.pending.append((category, ts, seq, name, None, text, done))
+            self.pending_cond.notify()
+        if wait:
+            done.wait()
+        return name
+
+    def _exists(self, category, name):
+        with self.db_lock:
+            return self.db.execute("SELECT 1 FROM entries WHERE category = ? AND name = ?",
+                                   (category, name)).fetchone() is not None
+
+    def _write_batch(self, batch):
+        with self.db_lock:
+            with self.db:
+                self.db.executemany(
+                    "INSERT INTO entries (category, name, ts, body) VALUES (?, ?, ?, ?)",
+                    [(category, name, ts, text) for category, ts, _, name, _, text, _ in batch],
+                )
+        for category, _, _, name, _, text, _ in batch:
+            for listener in self.listeners:
+                try:
+                    listener(category, name, text)
+                except Exception as e:
+                    logging.exception("Błąd słuchacza magazynu pamięci: %s", e)
+
+    def read(self, category, name):
+        with self.db_lock:
+            row = self.db.execute("SELECT body FROM entries WHERE category = ? AND name = ?",
+                                  (category, name)).fetchone()
+        return row[0] if row else None
+
+    def query(self, category, since=None, until=None):
+        with self.db_lock:
+            rows = self.db.execute(
+                "SELECT name FROM entries WHERE category = ? AND ts >= ? AND ts < ? ORDER BY ts",
+                (category, since if since is not None else float("-inf"),
+                 until if until is not None else float("inf")),
+            ).fetchall()
+        return [row[0] for row in rows]
+
+    def iter_entries(self, category):
+        with self.db_lock:
+            rows = self.db.execute("SELECT name, body FROM entries WHERE category = ? ORDER BY ts",
+                                   (category,)).fetchall()
+        yield from rows
+
+    def names(self, category):
+        with self.db_lock:
+            rows = self.db.execute("SELECT name FROM entries WHERE category = ? ORDER BY ts", (category,)).fetchall()
+        return [row[0] for row in rows]
+
+    def compact(self, category, before):
+        return 0  # SQLite manages its own pages; there are no segments to compress
+
+    def drop_before(self, category, cutoff):
+        with self.db_lock:
+            with self.db:
+                names = [row[0] for row in self.db.execute(
+                    "SELECT name FROM entries WHERE category = ? AND ts < ?", (category, cutoff))]
+                self.db.execute("DELETE FROM entries WHERE category = ? AND ts < ?", (category, cutoff))
+        return names
+
+    def close(self):
+        with self.lock:
+            self.closed = True
+            self.pending_cond.notify()
+        self.committer.join()
+        with self.db_lock:
+            self.db.close()
+
+
+def namespace_paths(namespace):
+    """Zwraca (katalog pamięci, katalog stanu) dla przestrzeni nazw; None to układ domyślny."""
+    if not namespace:
+        return MEMORY_ROOT, STATE_DIR
+    return os.path.join(MEMORY_ROOT, namespace), os.path.join(STATE_DIR, namespace)
+
+
+memory_store = None  # magazyn domyślnej przestrzeni nazw
+memory_stores = {}  # przestrzeń nazw -> magazyn
+_memory_store_lock = threading.Lock()
+# Wywoływane dla każdego nowo otwartego magazynu: hook(store) – np. serwer dopina słuchacza pamięci podręcznej %LOAD%
+store_open_hooks = []
+
+def get_memory_store(namespace=None):
+    """
+    Zwraca (tworząc przy pierwszym użyciu) magazyn pamięci wybrany w MEMORY_BACKEND.
+    Bez argumentu używa przestrzeni nazw sesji obsługiwanej w bieżącym wątku.
+    """
+    global memory_store
+    namespace = namespace or current_namespace()
+    with _memory_store_lock:
+        store = memory_stores.get(namespace)
+        if store is None:
+            root, _ = namespace_paths(namespace)
+            store_class = SqliteMemoryStore if MEMORY_BACKEND == "sqlite" else MemoryStore
+            store = memory_stores[namespace] = store_class(root)
+            for hook in store_open_hooks:
+                hook(store)
+            if namespace is None:
+                memory_store = store
+            logging.info("Otwarto magazyn pamięci (%s) w katalogu %s.", MEMORY_BACKEND, root)
+        return store
+
+def open_memory_stores():
+    """Lista (przestrzeń nazw, magazyn) wszystkich otwartych magazynów pamięci."""
+    with _memory_store_lock:
+        return list(memory_stores.items())
+
+
+# Indeks pełnotekstowy pamięci (wyszukiwanie przez L:>SZU)
+
+_TOKEN_RE = re.compile(r"\w+", re.UNICODE)
+# Litery, których NFKD nie rozkłada na literę bazową i znak diakrytyczny
+_FOLD_SPECIAL = {"ł": "l", "Ł": "l", "ß": "s", "ø": "o", "đ": "d"}
+
+def fold_char(c):
+    """Sprowadza znak do małej litery bez diakrytyków (zawsze dokładnie jeden znak)."""
+    if c in _FOLD_SPECIAL:
+        return _FOLD_SPECIAL[c]
+    lower = c.lower()
+    if len(lower) != 1:
+        return c
+    base = unicodedata.normalize("NFKD", lower)[0]
+    return base if base.isalnum() else lower
+
+def fold_text(text):
+    """Wersja tekstu do wyszukiwania – tej samej długości, więc pozycje pasują do oryginału."""
+    return "".join(fold_char(c) for c in text)
+
+def tokenize(text):
+    """Dzieli tekst na znormalizowane tokeny (np. 'Żółć' i 'zolc' dają ten sam token)."""
+    return [t for t in _TOKEN_RE.findall(fold_text(text)) if len(t) >= SEARCH_MIN_TOKEN]
+
+
+class SearchIndex:
+    """
+    Odwrócony indeks nad wpisami pamięci (magazyn + stare pliki .txt).
+    Aktualizowany przyrostowo przy każdym zapisie (słuchacz MemoryStore), utrwalany
+    w dzienniku state/search_index.jsonl, ranking BM25, wyniki z fragmentami tekstu.
+    Dokumentem jest ścieżka, którą można od razu przekazać do %LOAD%. Usunięty dokument
+    znika od razu z postings; dziennik przepisuje compact() (kompaktowanie, start).
+    """
+
+    def __init__(self, path=SEARCH_INDEX_FILE):
+        self.path = path
+        self.lock = threading.Lock()
+        self.doc_paths = []  # numer dokumentu -> ścieżka (None po usunięciu)
+        self.doc_lengths = []
+        self.doc_terms = []  # numer dokumentu -> tokeny dokumentu (do usuwania z postings)
+        self.doc_ids = {}  # ścieżka -> numer dokumentu
+        self.postings = {}  # token -> {numer dokumentu: liczba wystąpień}
+        self.sorted_terms = []  # do wyszukiwania po prefiksie ("kot*")
+        self.total_length = 0
+        self.journal_lines = 0  # linie dziennika, także te nieaktualne
+        if os.path.exists(path):
+            self._load()
+        self.journal = open(path, "a", encoding="utf-8")
+
+    def _load(self):
+        with open(self.path, "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue  # torn last line after a crash – the entry gets re-indexed
+                self.journal_lines += 1
+                if record.get("deleted"):
+                    self._purge(record["doc"])
+                else:
+                    self._add_terms(record["doc"], record["terms"], record["len"])
+        self.sorted_terms = sorted(self.postings)
+
+    def _add_terms(self, doc, terms, length):
+        if doc in self.doc_ids:
+            self._purge(doc)
+        num = len(self.doc_paths)
+        self.doc_paths.append(doc)
+        self.doc_lengths.append(length)
+        self.doc_terms.append(tuple(terms))
+        self.doc_ids[doc] = num
+        self.total_length += length
+        new_terms = []
+        for term, tf in terms.items():
+            postings = self.postings.get(term)
+            if postings is None:
+                postings = self.postings[term] = {}
+                new_terms.append(term)
+            postings[num] = tf
+        return new_terms
+
+    def _purge(self, doc):
+        # Caller holds self.lock (or is _load). Drops the document's postings and tokens left without any.
+        num = self.doc_ids.pop(doc, None)
+        if num is None:
+            return
+        self.total_length -= self.doc_lengths[num]
+        for term in self.doc_terms[num]:
+            postings = self.postings.get(term)
+            if postings is None:
+                continue
+            postings.pop(num, None)
+            if not postings:
+                del self.postings[term]
+                i = bisect.bisect_left(self.sorted_terms, term)
+                if i < len(self.sorted_terms) and self.sorted_terms[i] == term:
+                    del self.sorted_terms[i]
+        self.doc_paths[num], self.doc_terms[num] = None, ()
+
+    def __contains__(self, doc):
+        return doc in self.doc_ids
+
+    def add(self, doc, text):
+        """Indeksuje (lub ponownie indeksuje) dokument o podanej ścieżce."""
+        tokens = tokenize(text)
+        terms = {}
+        for token in tokens:
+            terms[token] = terms.get(token, 0) + 1
+        with self.lock:
+            for term in self._add_terms(doc, terms, len(tokens)):
+                bisect.insort(self.sorted_terms, term)
+            self.journal.write(json.dumps({"doc": doc, "len": len(tokens), "terms": terms}, ensure_ascii=False) + "\n")
+            self.journal.flush()
+            self.journal_lines += 1
+
+    def remove(self, doc):
+        """Usuwa dokument z indeksu (np. po usunięciu wpisu przez retencję)."""
+        with self.lock:
+            if doc not in self.doc_ids:
+                return
+            self._purge(doc)
+            self.journal.write(json.dumps({"doc": doc, "deleted": True}) + "\n")
+            self.journal.flush()
+            self.journal_lines += 1
+
+    def retain(self, docs):
+        """Usuwa dokumenty spoza zbioru docs (np. skasowane, gdy indeks nie był otwarty). Zwraca ich liczbę."""
+        with self.lock:
+            stale = [doc for doc in self.doc_ids if doc not in docs]
+        for doc in stale:
+            self.remove(doc)
+        return len(stale)
+
+    def dead_lines(self):
+        """Liczba linii dziennika, które nie opisują aktualnego dokumentu."""
+        with self.lock:
+            return self.journal_lines - len(self.doc_ids)
+
+    def compact(self):
+        """
+        Przepisuje dziennik atomowo – po jednej linii na aktualny dokument – i numeruje
+        dokumenty od nowa. Zwraca liczbę usuniętych linii.
+        """
+        with self.lock:
+            live = [(doc, self.doc_lengths[num], {term: self.postings[term][num] for term in self.doc_terms[num]})
+                    for doc, num in sorted(self.doc_ids.items(), key=lambda item: item[1])]
+            tmp_path = self.path + ".tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                for doc, length, terms in live:
+                    f.write(json.dumps({"doc": doc, "len": length, "terms": terms}, ensure_ascii=False) + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+            self.journal.close()
+            os.replace(tmp_path, self.path)
+            self.journal = open(self.path, "a", encoding="utf-8")
+            dropped = self.journal_lines - len(live)
+            self.doc_paths, self.doc_lengths, self.doc_terms = [], [], []
+            self.doc_ids, self.postings, self.total_length = {}, {}, 0
+            for doc, length, terms in live:
+                self._add_terms(doc, terms, length)
+            self.sorted_terms = sorted(self.postings)
+            self.journal_lines = len(live)
+        logging.info("Przepisano dziennik indeksu wyszukiwania %s (%d dokumentów, usunięto %d linii).",
+                     self.path, len(live), dropped)
+        return dropped
+
+    def _expand(self, term):
+        # "kot*" matches every indexed token starting with "kot"
+        if not term.endswith("*"):
+            return [term]
+        stem = term[:-1]
+        start = bisect.bisect_left(self.sorted_terms, stem)
+        matches = []
+        for candidate in itertools.islice(self.sorted_terms, start, None):
+            if not candidate.startswith(stem):
+                break
+            matches.append(candidate)
+        return matches
+
+    def search(self, query, limit=SEARCH_RESULTS):
+        """Zwraca listę (ścieżka, wynik, tokeny zapytania) posortowaną wg BM25."""
+        raw_terms = [fold_text(t) for t in re.findall(r"\w+\*?", query, re.UNICODE)]
+        with self.lock:
+            live_docs = len(self.doc_ids)
+            if not live_docs:
+                return []
+            avg_length = max(self.total_length / live_docs, 1)
+            scores = {}
+            matched_terms = []
+            for raw in raw_terms:
+                for term in self._expand(raw):
+                    postings = self.postings.get(term)
+                    if not postings:
+                        continue
+                    matched_terms.append(term)
+                    idf = math.log(1 + (live_docs - len(postings) + 0.5) / (len(postings) + 0.5))
+                    for num, tf in postings.items():
+                        norm = tf + BM25_K1 * (1 - BM25_B + BM25_B * self.doc_lengths[num] / avg_length)
+                        scores[num] = scores.get(num, 0.0) + idf * tf * (BM25_K1 + 1) / norm
+            best = heapq.nlargest(limit, scores.items(), key=lambda item: item[1])
+            return [(self.doc_paths[num], score, matched_terms) for num, score in best]
+
+    def close(self):
+        self.journal.close()
+
+
+def read_memory_document(doc):
+    """Zwraca treść dokumentu pamięci (stary plik albo wpis magazynu) albo None."""
+    if os.path.isfile(doc):
+        with open(doc, "r", encoding="utf-8", errors="replace") as f:
+            return f.read()
+    return get_memory_store().read_path(doc)
+
+def make_snippet(text, terms, width=SEARCH_SNIPPET_CHARS):
+    """Wycina fragment tekstu wokół pierwszego trafienia (porównanie bez diakrytyków)."""
+    folded = fold_text(text)
+    position = -1
+    for term in terms:
+        match = re.search(r"\b" + re.escape(term), folded)
+        if match and (position < 0 or match.start() < position):
+            position = match.start()
+    start = max(0, position - width // 3) if position >= 0 else 0
+    snippet = " ".join(text[start:start + width].split())
+    return ("…" if start > 0 else "") + snippet + ("…" if start + width < len(text) else "")
+
+
+search_indexes = {}  # przestrzeń nazw -> indeks wyszukiwania
+_search_index_lock = threading.Lock()
+
+def get_search_index(namespace=None):
+    """
+    Zwraca (tworząc przy pierwszym użyciu) indeks wyszukiwania przestrzeni nazw. Przy tworzeniu
+    dopina go do magazynu pamięci i indeksuje wpisy oraz stare pliki, których jeszcze nie zna.
+    """
+    namespace = namespace or current_namespace()
+    with _search_index_lock:
+        if namespace in search_indexes:
+            return search_indexes[namespace]
+        store = get_memory_store(namespace)
+        _, state_dir = namespace_paths(namespace)
+        index_path = SEARCH_INDEX_FILE if namespace is None else os.path.join(state_dir, os.path.basename(SEARCH_INDEX_FILE))
+        os.makedirs(os.path.dirname(index_path), exist_ok=True)
+        index = SearchIndex(index_path)
+        store.listeners.append(lambda category, name, text: index.add(f"{store.prefix}/{category}/{name}.txt", text))
+        added = 0
+        live = set()  # every document that still exists – the rest is dropped from the index
+        for category in store.categories:
+            # Only entries missing from the persisted index are read from disk
+            for name in store.names(category):
+                doc = f"{store.prefix}/{category}/{name}.txt"
+                live.add(doc)
+                if doc not in index:
+                    text = store.read(category, name)
+                    if text is not None:
+                        index.add(doc, text)
+                        added += 1
+            legacy_dir = os.path.join(store.root, category)
+            for entry in os.scandir(legacy_dir) if os.path.isdir(legacy_dir) else []:
+                doc = f"{store.prefix}/{category}/{entry.name}"
+                if entry.name.startswith(CMD_SPILL_PREFIX):
+                    continue  # full L:>CMD output dumps are not memory entries
+                if entry.is_file() and entry.name.endswith(".txt"):
+                    live.add(doc)
+                    if doc not in index:
+                        index.add(doc, read_memory_document(entry.path))
+                        added += 1
+            live.update(f"{store.prefix}/{category}/{name}" for name in store.archive.names(category))
+        purged = index.retain(live)
+        if index.dead_lines() >= SEARCH_INDEX_COMPACT_LINES:
+            index.compact()
+        logging.info("Indeks wyszukiwania gotowy (%d dokumentów, nowo zaindeksowanych: %d, usuniętych: %d).",
+                     len(index.doc_ids), added, purged)
+        search_indexes[namespace] = index
+        return index
@@ -0,0 +1,1018 @@
+# -*- coding: utf-8 -*-
+"""
+--------------------------------------------------
+    SERWER – TRANSPORT ROZMOWY
+--------------------------------------------------
+
+Selenium (karta przeglądarki, ładowane przy pierwszym użyciu) i HTTP (API czatu,
+fake_chat_server.py): selektory, pobieranie wiadomości po kursorze, wysyłanie,
+obserwator DOM oraz interfejs ChatTransport używany przez ChatSession.
+--------------------------------------------------
+"""
+
+import os
+import time
+import logging
+import abc
+import hashlib
+import re
+import json
+import uuid
+import urllib.request
+from collections import deque
+
+from luna_metrics import LogBody, metrics
+
+# Lista selektorów, które mogą odpowiadać polu tekstowemu (textarea)
+TEXTAREA_SELECTORS = [
+    "textarea",
+    "div[contenteditable='true']",
+    "form textarea",
+    "form div[contenteditable='true']"
+]
+# Lista selektorów, które mogą odpowiadać elementom zawierającym odpowiedź (np. wiadomość od Luny)
+RESPONSE_SELECTORS = [
+    "[data-message-author-role='assistant']",
+    ".markdown.prose",
+    "[data-testid='conversation-turn-3']",
+    ".prose",
+    "div[data-message-author-role='assistant'] div.prose",
+    "div[data-message-author-role='assistant']"
+]
+
+# Tryb zdarzeniowy – MutationObserver w przeglądarce budzi pętlę, gdy tylko pojawi się nowa wiadomość.
+# Gdy obserwatora nie da się zainstalować, pętla wraca do zwykłego odpytywania co POLL_INTERVAL sekund.
+EVENT_DRIVEN_MODE = True
+TURN_STABLE_PROBE = 0.3  # co ile sekund sprawdzamy ostatnią wiadomość, dopóki nie jest kompletna
+POLL_INTERVAL = 30  # maksymalny czas oczekiwania na zdarzenie / interwał odpytywania (sekundy)
+OBSERVER_QUIET_MS = 300  # ile ms bez zmian w DOM, zanim obudzimy pętlę (o końcu odpowiedzi decyduje SeleniumTransport)
+ASSISTANT_TURN_SELECTOR = "[data-message-author-role='assistant']"
+
+# Skrypt instalowany w przeglądarce: liczy wiadomości asystenta i po chwili ciszy w DOM
+# budzi wszystkich oczekujących (wait_for_new_message), jeśli liczba się zmieniła.
+OBSERVER_INSTALL_SCRIPT = """
+var selector = arguments[0], quietMs = arguments[1];
+if (window.__lunaObserver) { return window.__lunaTurnCount; }
+window.__lunaTurnCount = document.querySelectorAll(selector).length;
+window.__lunaWaiters = [];
+var debounce = null;
+var check = function () {
+    debounce = null;
+    var n = document.querySelectorAll(selector).length;
+    if (n !== window.__lunaTurnCount) {
+        window.__lunaTurnCount = n;
+        var waiters = window.__lunaWaiters;
+        window.__lunaWaiters = [];
+        waiters.forEach(function (cb) { cb(n); });
+    }
+};
+window.__lunaObserver = new MutationObserver(function () {
+    if (debounce !== null) { clearTimeout(debounce); }
+    debounce = setTimeout(check, quietMs);
+});
+window.__lunaObserver.observe(document.body, {childList: true, subtree: true, characterData: true});
+return window.__lunaTurnCount;
+"""
+
+# Skrypt asynchroniczny: wraca natychmiast, jeśli liczba wiadomości różni się od znanej,
+# w przeciwnym razie czeka na powiadomienie obserwatora albo na upływ timeoutu.
+# Zwraca -1, gdy obserwatora nie ma (np. po przeładowaniu strony).
+OBSERVER_WAIT_SCRIPT = """
+var known = arguments[0], timeoutMs = arguments[1], done = arguments[arguments.length - 1];
+if (!window.__lunaObserver) { done(-1); return; }
+if (window.__lunaTurnCount !== known) { done(window.__lunaTurnCount); return; }
+var timer = setTimeout(function () { done(window.__lunaTurnCount); }, timeoutMs);
+window.__lunaWaiters.push(function (n) { clearTimeout(timer); done(n); });
+"""
+
+# Preferowany selektor treści wiadomości asystenta (typowa struktura ChatGPT)
+PREFERRED_RESPONSE_SELECTOR = "div[data-message-author-role='assistant'] > div > div.markdown"
+
+# Skrypt zbierający w jednym wywołaniu execute_script tylko wiadomości po kursorze.
+# Kursor to indeks następnej wiadomości oraz data-message-id ostatniej przetworzonej –
+# identyfikator ma pierwszeństwo, bo indeksy mogą się przesunąć po przeładowaniu strony.
+# Dla każdej wiadomości zwracany jest skrót treści (FNV-1a, 32 bity, hex). Ostatnia wiadomość
+# w DOM ma znacznik tail, a streaming, jeśli Luna wciąż ją pisze (przycisk "stop" albo klasa
+# result-streaming); generating mówi, czy przycisk "stop" jest w ogóle widoczny.
+SCRAPE_SCRIPT = """
+var selectors = arguments[0], cursorIndex = arguments[1], cursorId = arguments[2], stopSel = arguments[3];
+var nodes = [], used = null;
+for (var i = 0; i < selectors.length; i++) {
+    nodes = document.querySelectorAll(selectors[i]);
+    if (nodes.length) { used = selectors[i]; break; }
+}
+var messageId = function (node) {
+    var owner = node.closest('[data-message-id]');
+    return owner ? owner.getAttribute('data-message-id') : null;
+};
+var fnv = function (s) {
+    var h = 0x811c9dc5;
+    for (var k = 0; k < s.length; k++) {
+        h ^= s.charCodeAt(k);
+        h = Math.imul(h, 0x01000193) >>> 0;
+    }
+    return ('0000000' + h.toString(16)).slice(-8);
+};
+var start = Math.min(cursorIndex, nodes.length);
+if (cursorId) {
+    for (var j = nodes.length - 1; j >= 0; j--) {
+        if (messageId(nodes[j]) === cursorId) { start = j + 1; break; }
+    }
+}
+var generating = !!document.querySelector(stopSel);
+var turns = [];
+for (var n = start; n < nodes.length; n++) {
+    var text = (nodes[n].innerText || '').trim();
+    if (!text) { continue; }
+    var tail = n === nodes.length - 1;
+    var streaming = tail && (generating || !!nodes[n].querySelector('.result-streaming') ||
+                             nodes[n].classList.contains('result-streaming'));
+    turns.push({index: n, id: messageId(nodes[n]), text: text, hash: fnv(text), tail: tail, streaming: streaming});
+}
+return {selector: used, total: nodes.length, generating: generating, turns: turns};
+"""
+
+PENDING_WAKE_SLICE = 0.05  # przy zadaniach w toku obserwator DOM czeka krócej, żeby gotowy wynik wyszedł od razu
+
+# Wysyłanie wiadomości – wstawianie całego tekstu naraz zamiast pisania znak po znaku
+SEND_BUTTON_SELECTOR = "button[data-testid='send-button']"
+STOP_BUTTON_SELECTOR = "button[data-testid='stop-button']"
+SEND_READY_TIMEOUT = 5  # ile sekund czekamy, aż przycisk wysyłania będzie aktywny
+COMPOSER_IDLE_TIMEOUT = 120  # ile sekund czekamy, aż Luna skończy odpowiadać, przed kolejną częścią
+GENERATION_START_TIMEOUT = 2  # ile sekund czekamy, aż po wysłaniu pojawi się przycisk "stop"
+COMPOSER_POLL_INTERVAL = 0.1
+
+# Czyści pole wpisu (textarea albo contenteditable) i ustawia w nim kursor
+CLEAR_COMPOSER_SCRIPT = """
+var el = arguments[0];
+el.focus();
+if (el.tagName === 'TEXTAREA' || el.tagName === 'INPUT') {
+    var setter = Object.getOwnPropertyDescriptor(Object.getPrototypeOf(el), 'value').set;
+    setter.call(el, '');
+    el.dispatchEvent(new Event('input', {bubbles: true}));
+} else {
+    document.execCommand('selectAll', false, null);
+    document.execCommand('delete', false, null);
+}
+"""
+
+# Wkleja tekst zdarzeniem 'paste' (edytory contenteditable obsługują je jak wklejenie ze schowka);
+# dla zwykłego textarea ustawia wartość i wysyła zdarzenie 'input'
+PASTE_TEXT_SCRIPT = """
+var el = arguments[0], text = arguments[1];
+el.focus();
+if (el.tagName === 'TEXTAREA' || el.tagName === 'INPUT') {
+    var setter = Object.getOwnPropertyDescriptor(Object.getPrototypeOf(el), 'value').set;
+    setter.call(el, text);
+    el.dispatchEvent(new Event('input', {bubbles: true}));
+    return;
+}
+var data = new DataTransfer();
+data.setData('text/plain', text);
+el.dispatchEvent(new ClipboardEvent('paste', {clipboardData: data, bubbles: true, cancelable: true}));
+"""
+
+# Stan pola wpisu: tekst w polu, aktywność przycisku wysyłania, czy Luna właśnie generuje odpowiedź
+COMPOSER_STATE_SCRIPT = """
+var el = arguments[0], sendSel = arguments[1], stopSel = arguments[2];
+var send = document.querySelector(sendSel);
+var text = !el ? '' : (el.tagName === 'TEXTAREA' || el.tagName === 'INPUT') ? el.value : el.innerText;
+return {
+    text: text || '',
+    send_ready: !!send && !send.disabled && send.getAttribute('aria-disabled') !== 'true',
+    generating: !!document.querySelector(stopSel)
+};
+"""
+
+# Adres rozmowy, którą obsługuje serwer
+CHAT_URL = "https://chatgpt.com/c/684583aa-f7a8-8006-b808-b10b00644761"
+# Fallback or default if the specific chat isn't available
+# CHAT_URL = "https://chatgpt.com/"
+
+# Sondy zdrowia karty (HealthMonitor w server.py) i oczekiwanie na załadowanie strony
+HEALTH_WINDOW = 300  # okno (s), w którym liczymy błędy "stale element"
+PAGE_READY_TIMEOUT = 30
+
+# Transport rozmowy: "selenium" (karta przeglądarki) albo "http" (bezpośrednio przez API)
+TRANSPORT = "selenium"
+HTTP_URL = "http://127.0.0.1:8765/v1/chat/completions"  # np. fake_chat_server.py albo endpoint zgodny z OpenAI
+HTTP_API = "openai"  # "openai" (/v1/chat/completions) albo "vercel" (app/api/chat/route.ts)
+HTTP_MODEL = "grok-3-mini-beta"
+HTTP_API_KEY_ENV = "LUNA_API_KEY"  # zmienna środowiskowa z kluczem API (opcjonalna)
+HTTP_TIMEOUT = 120
+HTTP_HISTORY_LIMIT = 40  # ile ostatnich wiadomości rozmowy wysyłamy przy każdym żądaniu
+
+# Ciepły start: instrukcja nie jest wysyłana ponownie, jeśli jest nadal w ostatnich wiadomościach
+INSTRUCTION_MARKER = "#####INSTRUCTION_MSG("
+INSTRUCTION_CONTEXT_TURNS = 20  # w ilu ostatnich wiadomościach serwera szukamy instrukcji
+USER_TURN_SELECTOR = "[data-message-author-role='user']"
+
+# Liczba wiadomości wysłanych przez serwer i treść ostatniej (sprawdzenie przed ponowieniem wysyłki)
+LAST_USER_TURN_SCRIPT = """
+var nodes = document.querySelectorAll(arguments[0]);
+return {count: nodes.length, text: nodes.length ? (nodes[nodes.length - 1].innerText || '') : null};
+"""
+
+# Czy instrukcja jest wśród ostatnich wiadomości wysłanych przez serwer
+INSTRUCTION_CHECK_SCRIPT = """
+var nodes = document.querySelectorAll(arguments[0]), marker = arguments[1], depth = arguments[2];
+for (var i = nodes.length - 1; i >= Math.max(0, nodes.length - depth); i--) {
+    if ((nodes[i].innerText || '').indexOf(marker) !== -1) { return true; }
+}
+return false;
+"""
+
+# This is a placeholder for CHROME_DRIVER_PATH. 
+# You would need to set this to the actual path of your ChromeDriver executable.
+CHROME_DRIVER_PATH = "path/to/chromedriver" 
+
+
+# Selenium is imported on first use (load_selenium): HTTP sessions and tooling start without it
+webdriver = Options = By = Keys = StaleElementReferenceException = None
+
+def load_selenium():
+    """Importuje selenium przy pierwszym użyciu – start bez przeglądarki jest szybszy."""
+    global webdriver, Options, By, Keys, StaleElementReferenceException
+    if webdriver is None:
+        from selenium import webdriver
+        from selenium.webdriver.chrome.options import Options
+        from selenium.webdriver.common.by import By
+        from selenium.webdriver.common.keys import Keys
+        from selenium.common.exceptions import StaleElementReferenceException
+
+
+class SelectorResolver:
+    """
+    Pamięć podręczna selektorów: zapamiętuje selektor, który ostatnio zadziałał,
+    i próbuje go jako pierwszego. Prowadzi statystyki trafień/chybień; cache jest
+    czyszczony po odświeżeniu strony, nawigacji lub błędzie "stale element".
+    """
+
+    def __init__(self, name, selectors):
+        self.name = name
+        self.selectors = list(selectors)
+        self.cached = None
+        self.stats = {"hits": 0, "misses": 0, "probes": 0, "invalidations": 0}
+
+    def ordered(self):
+        """Zwraca listę selektorów z zapamiętanym selektorem na początku."""
+        if self.cached is None:
+            return list(self.selectors)
+        return [self.cached] + [s for s in self.selectors if s != self.cached]
+
+    def record(self, selector):
+        """Odnotowuje selektor, który zadziałał (np. wewnątrz skryptu JS)."""
+        if selector is None:
+            return
+        if selector == self.cached:
+            self.stats["hits"] += 1
+        else:
+            self.stats["misses"] += 1
+            if self.cached is not None:
+                metrics.inc("luna_selector_fallbacks_total", resolver=self.name)
+            self.cached = selector
+
+    def find_element(self, driver_instance):
+        """Zwraca pierwszy znaleziony element; zgłasza wyjątek, gdy nie zadziała żaden selektor."""
+        previous = self.cached
+        for selector in self.ordered():
+            self.stats["probes"] += 1
+            try:
+                element = driver_instance.find_element(By.CSS_SELECTOR, selector)
+            except Exception:
+                if selector == self.cached:
+                    self.cached = None
+                continue
+            self.record(selector)
+            if previous is not None and selector != previous:
+                # record() no longer sees the failed cached selector, so the fallback is counted here
+                metrics.inc("luna_selector_fallbacks_total", resolver=self.name)
+            return element
+        raise Exception(f"Nie znaleziono elementu '{self.name}' przy użyciu żadnego selektora.")
+
+    def invalidate(self, reason):
+        """Zapomina zapamiętany selektor."""
+        if self.cached is not None:
+            logging.info("Unieważniono selektor %s (%s): %s", self.name, reason, self.cached)
+        self.cached = None
+        self.stats["invalidations"] += 1
+
+
+class PageSelectors:
+    """
+    Stan selektorów jednej karty rozmowy: resolvery pola wpisu i wiadomości oraz czasy
+    ostatnich błędów "stale element" (sonda zdrowia). Każdy SeleniumTransport ma własny,
+    więc cache i błędy jednej rozmowy nie wpływają na pozostałe.
+    """
+
+    def __init__(self):
+        self.textarea = SelectorResolver("textarea", TEXTAREA_SELECTORS + ["#prompt-textarea"])
+        self.response = SelectorResolver("response", [PREFERRED_RESPONSE_SELECTOR] + RESPONSE_SELECTORS)
+        self.stale_events = deque(maxlen=100)
+
+    def invalidate(self, reason):
+        """Czyści cache obu resolverów; błąd "stale element" jest też odnotowywany dla sond zdrowia."""
+        if reason == "stale element":
+            self.stale_events.append(time.monotonic())
+            metrics.inc("luna_stale_elements_total")
+        for resolver in (self.textarea, self.response):
+            resolver.invalidate(reason)
+
+    def recent_stale_events(self, window=HEALTH_WINDOW):
+        """Liczba błędów "stale element" w ostatnich window sekundach."""
+        cutoff = time.monotonic() - window
+        return sum(1 for t in self.stale_events if t >= cutoff)
+
+    def stats(self):
+        """Zwraca statystyki trafień/chybień resolverów selektorów."""
+        return {resolver.name: dict(resolver.stats) for resolver in (self.textarea, self.response)}
+
+
+# Selektory wywołań bez transportu (np. benchmark); sesje mają własne (SeleniumTransport.selectors)
+default_selectors = PageSelectors()
+
+def refresh_page(driver_instance, selectors=None):
+    """Odświeża stronę i unieważnia cache selektorów."""
+    selectors = selectors or default_selectors
+    logging.info("Statystyki selektorów przed odświeżeniem: %s", selectors.stats())
+    selectors.invalidate("odświeżenie strony")
+    metrics.inc("luna_page_refreshes_total")
+    driver_instance.refresh()
+
+
+def get_chrome_options():
+    """Przykładowa funkcja zwracająca opcje Chrome – możesz zmodyfikować według własnych potrzeb."""
+    chrome_options = Options()
+    # Ensure Chrome is launched with: --remote-debugging-port=9222
+    chrome_options.add_experimental_option("debuggerAddress", "127.0.0.1:9222") 
+    return chrome_options
+
+def setup_driver():
+    """
+    Konfiguruje Selenium do łączenia się z Chrome w trybie debugowania.
+    Upewnij się, że Chrome uruchomiony jest z flagą:
+      --remote-debugging-port=9222 --user-data-dir="ścieżka_do_profilu"
+    """
+    load_selenium()
+    chrome_options = get_chrome_options()
+    try:
+        # If CHROME_DRIVER_PATH is not set, Selenium might find it if it's in PATH
+        # For explicit path: webdriver.Chrome(executable_path=CHROME_DRIVER_PATH, options=chrome_options)
+        driver = webdriver.Chrome(options=chrome_options)
+        logging.info("Połączono z Chrome przez Selenium.")
+        return driver
+    except Exception as e:
+        # Fallback if connection to existing debugger fails, try to launch a new one
+        # This part might need adjustment based on how Chrome is launched for debugging
+        logging.warning(f"Nie udało się połączyć z istniejącą instancją Chrome przez debuggerAddress: {e}. Próba uruchomienia nowej instancji.")
+        try:
+            # Reset options for a standard launch if debugger connection fails
+            new_chrome_options = Options() 
+            # Add any necessary options for a new instance, e.g., headless, user-data-dir
+            # new_chrome_options.add_argument("--headless") 
+            driver = webdriver.Chrome(options=new_chrome_options)
+            logging.info("Uruchomiono nową instancję Chrome.")
+            return driver
+        except Exception as ex:
+            logging.exception("Błąd przy łączeniu/uruchamianiu Chrome: %s", ex)
+            raise
+
+
+def navigate_to_chat(driver_instance, url=CHAT_URL, selectors=None):
+    """Nawiguje do strony czatu – domyślnie CHAT_URL."""
+    selectors = selectors or default_selectors
+    selectors.invalidate("nawigacja")
+    driver_instance.get(url)
+    logging.info("Nawigacja do strony: %s", url)
+    wait_for_page_ready(driver_instance, selectors=selectors) # Ready as soon as the composer shows up, no fixed delay
+
+def get_textarea_element(driver_instance, selectors=None):
+    """
+    Zwraca element pola tekstowego. Najpierw próbuje selektora, który zadziałał
+    ostatnio (PageSelectors.textarea), potem pozostałych z TEXTAREA_SELECTORS oraz #prompt-textarea.
+    Jeśli żaden element nie zostanie znaleziony, zgłasza wyjątek.
+    """
+    try:
+        return (selectors or default_selectors).textarea.find_element(driver_instance)
+    except Exception:
+        logging.error("Nie znaleziono elementu pola tekstowego przy użyciu żadnego selektora.")
+        raise Exception("Nie znaleziono elementu pola tekstowego.")
+
+
+def get_composer_state(driver_instance, input_box=None):
+    """Zwraca stan pola wpisu (text, send_ready, generating) jednym wywołaniem execute_script."""
+    return driver_instance.execute_script(COMPOSER_STATE_SCRIPT, input_box, SEND_BUTTON_SELECTOR, STOP_BUTTON_SELECTOR)
+
+def wait_for_composer(driver_instance, condition, timeout, input_box=None):
+    """
+    Odpytuje stan pola wpisu co COMPOSER_POLL_INTERVAL, aż condition(stan) będzie prawdziwe.
+    Zwraca True, jeśli warunek został spełniony przed upływem timeout.
+    """
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            if condition(get_composer_state(driver_instance, input_box)):
+                return True
+        except StaleElementReferenceException:
+            return False
+        except Exception:
+            pass
+        if time.monotonic() >= deadline:
+            return False
+        time.sleep(COMPOSER_POLL_INTERVAL)
+
+def wait_for_composer_idle(driver_instance, timeout=COMPOSER_IDLE_TIMEOUT):
+    """Czeka, aż Luna skończy generować odpowiedź – zastępuje stałe opóźnienia między częściami."""
+    # The stop button shows up a moment after sending; don't mistake that gap for "idle"
+    wait_for_composer(driver_instance, lambda state: state["generating"], GENERATION_START_TIMEOUT)
+    if not wait_for_composer(driver_instance, lambda state: not state["generating"], timeout):
+        logging.warning("Luna nadal odpowiada po %d s – wysyłam mimo to.", timeout)
+
+def _normalized(text):
+    return "".join(text.split())
+
+def inject_text(driver_instance, input_box, message):
+    """
+    Wstawia cały tekst do pola wpisu w jednym kroku: najpierw przez CDP Input.insertText,
+    potem zdarzeniem 'paste', a w ostateczności przez send_keys (pisanie znak po znaku).
+    Zwraca nazwę użytej metody.
+    """
+    expected = _normalized(message)
+    def injected(state):
+        return _normalized(state["text"]) == expected
+
+    driver_instance.execute_script(CLEAR_COMPOSER_SCRIPT, input_box)
+    try:
+        driver_instance.execute_cdp_cmd("Input.insertText", {"text": message})
+        if wait_for_composer(driver_instance, injected, 1, input_box):
+            return "cdp"
+    except StaleElementReferenceException:
+        raise
+    except Exception as e:
+        logging.debug("Input.insertText niedostępne: %s", e)
+
+    driver_instance.execute_script(CLEAR_COMPOSER_SCRIPT, input_box)
+    try:
+        driver_instance.execute_script(PASTE_TEXT_SCRIPT, input_box, message)
+        if wait_for_composer(driver_instance, injected, 1, input_box):
+            return "paste"
+    except StaleElementReferenceException:
+        raise
+    except Exception as e:
+        logging.debug("Wklejanie przez zdarzenie 'paste' nie zadziałało: %s", e)
+
+    driver_instance.execute_script(CLEAR_COMPOSER_SCRIPT, input_box)
+    input_box.send_keys(message)
+    return "send_keys"
+
+def send_message(driver_instance, message, selectors=None):
+    """
+    Wysyła wiadomość do pola tekstowego. Zwraca True, jeśli wiadomość została wysłana.
+    Wyszukuje element przy użyciu funkcji get_textarea_element i wstawia tekst naraz
+    (inject_text). Jeśli element okaże się nieaktualny (stale), cache selektorów jest
+    czyszczony i próba ponawiana raz.
+    """
+    for attempt in range(2):
+        try:
+            started = time.monotonic()
+            input_box = get_textarea_element(driver_instance, selectors)
+            input_box.click()
+            method = inject_text(driver_instance, input_box, message)
+            # Click the send button as soon as it becomes active; fall back to Enter
+            try:
+                if not wait_for_composer(driver_instance, lambda state: state["send_ready"], SEND_READY_TIMEOUT, input_box):
+                    raise Exception("Przycisk wysyłania nieaktywny.")
+                send_button = driver_instance.find_element(By.CSS_SELECTOR, SEND_BUTTON_SELECTOR)
+                send_button.click()
+            except StaleElementReferenceException:
+                raise
+            except Exception:
+                input_box.send_keys(Keys.ENTER)
+            
+            logging.info("Wysłano wiadomość (%s, %.2f s): %s", method, time.monotonic() - started, LogBody(message))
+            metrics.observe("luna_send_seconds", time.monotonic() - started, method=method)
+            return True
+        except StaleElementReferenceException as e:
+            (selectors or default_selectors).invalidate("stale element")
+            if attempt == 0:
+                logging.warning("Pole tekstowe nieaktualne, ponawiam wysyłanie.")
+                continue
+            logging.exception("Błąd przy wysyłaniu wiadomości: %s", e)
+        except Exception as e:
+            logging.exception("Błąd przy wysyłaniu wiadomości: %s", e)
+            break
+    metrics.inc("luna_send_failures_total", method="selenium")
+    return False
+
+def get_response_messages(driver_instance, selectors=None):
+    """
+    Przechodzi przez listę RESPONSE_SELECTORS i zbiera tekst z odnalezionych elementów.
+    Zwraca listę tekstów (jeśli znajdzie kilka wiadomości).
+    """
+    selectors = selectors or default_selectors
+    # Selectors come from the response resolver: the last one that worked is tried first,
+    # then the preferred ChatGPT selector and the general RESPONSE_SELECTORS
+    for selector in selectors.response.ordered():
+        try:
+            elements = driver_instance.find_elements(By.CSS_SELECTOR, selector)
+            current_selector_messages = []
+            for el in elements:
+                text = el.text.strip()
+                if text:
+                    current_selector_messages.append(text)
+            if current_selector_messages:
+                 logging.info(f"Znaleziono {len(current_selector_messages)} wiadomości przy użyciu selektora: {selector}")
+                 selectors.response.record(selector)
+                 # Return messages from the first successful selector to avoid duplicates from overlapping selectors
+                 return current_selector_messages
+        except StaleElementReferenceException:
+            selectors.invalidate("stale element")
+            continue
+        except Exception:
+            continue
+    
+    logging.info("Nie znaleziono nowych wiadomości przy użyciu żadnego selektora.")
+    return []
+
+
+def turn_hash(text):
+    """Skrót treści wiadomości zgodny z SCRAPE_SCRIPT (FNV-1a po jednostkach UTF-16)."""
+    h = 0x811c9dc5
+    data = text.encode("utf-16-le")
+    for k in range(0, len(data), 2):
+        h ^= data[k] | (data[k + 1] << 8)
+        h = (h * 0x01000193) & 0xFFFFFFFF
+    return f"{h:08x}"
+
+def new_scrape_cursor():
+    """Zwraca pusty kursor – pierwsze pobranie obejmie całą rozmowę."""
+    return {"index": 0, "id": None}
+
+def turn_key(turn):
+    """
+    Klucz deduplikacji wiadomości: data-message-id, a gdy go brak – skrót SHA-1
+    z pozycji i treści (ta sama treść w innym miejscu rozmowy to nowa wiadomość).
+    """
+    if turn.get("id"):
+        return "id:" + turn["id"]
+    digest = hashlib.sha1(f"{turn['index']}:{turn['text']}".encode("utf-8")).hexdigest()
+    return "sha1:" + digest
+
+
+def get_new_turns(driver_instance, cursor, selectors=None):
+    """
+    Pobiera jednym wywołaniem execute_script tylko wiadomości asystenta po kursorze.
+    Zwraca krotkę (lista_wiadomości, nowy_kursor); każda wiadomość to słownik
+    z kluczami index, id, text, hash, tail i streaming (zob. SCRAPE_SCRIPT). Koszt zależy od liczby nowych wiadomości,
+    a nie od długości rozmowy. Gdy skrypt zawiedzie, używa get_response_messages.
+    """
+    selectors = selectors or default_selectors
+    started = time.perf_counter()
+    method = "script"
+    try:
+        result = driver_instance.execute_script(
+            SCRAPE_SCRIPT, selectors.response.ordered(), cursor["index"], cursor["id"], STOP_BUTTON_SELECTOR)
+        turns = result["turns"] if result else []
+        if result:
+            selectors.response.record(result["selector"])
+    except Exception as e:
+        logging.warning(f"Skrypt pobierania wiadomości nie zadziałał, powrót do find_elements: {e}")
+        method = "find_elements"
+        texts = get_response_messages(driver_instance, selectors)
+        turns = [
+            {"index": i, "id": None, "text": text, "hash": turn_hash(text), "tail": i == len(texts) - 1, "streaming": False}
+            for i, text in enumerate(texts) if i >= cursor["index"]
+        ]
+    metrics.observe("luna_scrape_seconds", time.perf_counter() - started, method=method)
+    if not turns:
+        return [], cursor
+    last = turns[-1]
+    return turns, {"index": last["index"] + 1, "id": last["id"]}
+
+
+def install_message_observer(driver_instance):
+    """
+    Instaluje w przeglądarce MutationObserver śledzący wiadomości asystenta.
+    Zwraca aktualną liczbę wiadomości albo None, jeśli instalacja się nie powiodła
+    (wtedy cycle_loop przechodzi na zwykłe odpytywanie).
+    """
+    try:
+        # The async wait must be able to outlive its own timeout by a safe margin.
+        driver_instance.set_script_timeout(POLL_INTERVAL + 10)
+        count = driver_instance.execute_script(OBSERVER_INSTALL_SCRIPT, ASSISTANT_TURN_SELECTOR, OBSERVER_QUIET_MS)
+        logging.info("Zainstalowano obserwator wiadomości (liczba wiadomości: %s).", count)
+        return int(count)
+    except Exception as e:
+        logging.warning(f"Nie udało się zainstalować obserwatora wiadomości, tryb odpytywania: {e}")
+        return None
+
+def wait_for_new_message(driver_instance, known_count, timeout=POLL_INTERVAL):
+    """
+    Czeka (maksymalnie timeout sekund), aż obserwator zgłosi nową wiadomość.
+    Zwraca krotkę (liczba_wiadomości, czy_zmiana). Liczba None oznacza,
+    że obserwator zniknął (np. po odświeżeniu) i trzeba go zainstalować ponownie.
+    """
+    try:
+        count = driver_instance.execute_async_script(OBSERVER_WAIT_SCRIPT, known_count, int(timeout * 1000))
+    except Exception as e:
+        logging.warning(f"Oczekiwanie na zdarzenie nie powiodło się: {e}")
+        return None, True
+    if count is None or int(count) < 0:
+        return None, True
+    return int(count), int(count) != known_count
+
+
+def wait_for_page_ready(driver_instance, timeout=PAGE_READY_TIMEOUT, selectors=None):
+    """Czeka, aż strona się załaduje i pole wpisu będzie dostępne. Zwraca True przy sukcesie."""
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            if driver_instance.execute_script("return document.readyState") == "complete":
+                get_textarea_element(driver_instance, selectors)
+                return True
+        except Exception:
+            pass
+        time.sleep(0.5)
+    logging.warning("Strona nie była gotowa po %d s.", timeout)
+    return False
+
+
+# Warstwa transportu: skąd przychodzą wiadomości Luny i dokąd wysyłamy odpowiedzi
+
+class ChatTransport(abc.ABC):
+    """
+    Interfejs transportu rozmowy. Pętla serwera (ChatSession) korzysta wyłącznie z tych
+    metod, więc ten sam protokół prefiksów działa przez przeglądarkę (SeleniumTransport)
+    albo bezpośrednio przez HTTP (HttpTransport), także z lokalnym fake_chat_server.py.
+    Transport bez send, wait_for_activity lub new_turns nie da się utworzyć (abc).
+    """
+
+    name = "transport"
+    resumable = False  # czy kursor z poprzedniego uruchomienia nadal wskazuje tę samą rozmowę
+
+    def open(self, claimed):
+        """Przygotowuje połączenie z rozmową. claimed: zasoby zajęte już przez inne sesje."""
+
+    def activate(self):
+        """Wywoływane przed obsługą sesji, gdy kilka sesji dzieli jeden zasób (np. przeglądarkę)."""
+
+    @abc.abstractmethod
+    def send(self, message):
+        """Wysyła wiadomość do Luny. Zwraca True, jeśli wiadomość została wysłana."""
+
+    def wait_idle(self, timeout=COMPOSER_IDLE_TIMEOUT):
+        """Czeka, aż Luna skończy odpowiadać na właśnie wysłaną wiadomość."""
+
+    def wait_ready(self, timeout=COMPOSER_IDLE_TIMEOUT):
+        """Czeka, aż rozmowa przyjmie nową wiadomość (Luna nic nie pisze)."""
+
+    def busy(self):
+        """Czy Luna właśnie odpowiada – sprawdzenie bez czekania (wysyłka przy wspólnej pętli sesji)."""
+        return False
+
+    def delivery_mark(self):
+        """Stan rozmowy zapamiętywany przed wysłaniem (np. liczba wysłanych wiadomości) – dla was_delivered."""
+        return None
+
+    def was_delivered(self, message, mark):
+        """Czy wiadomość, której wysłanie zgłosiło błąd, mimo to trafiła do rozmowy już po mark."""
+        return False
+
+    @abc.abstractmethod
+    def wait_for_activity(self, timeout, wake=None):
+        """
+        Czeka (maksymalnie timeout sekund) na nową wiadomość Luny albo na ustawienie zdarzenia wake
+        (gotowy wynik zadania). Zwraca True, gdy warto pobrać wiadomości.
+        """
+
+    @abc.abstractmethod
+    def new_turns(self, cursor):
+        """Zwraca krotkę (nowe_wiadomości, nowy_kursor) – jak get_new_turns."""
+
+    def instruction_in_context(self):
+        """Czy instrukcja protokołu jest nadal wśród ostatnich wiadomości rozmowy."""
+        return False
+
+    def probe(self):
+        """Sondy zdrowia transportu: słownik z kluczami dom_alive, on_chat i composer (opcjonalnie stale_events)."""
+        return {"dom_alive": True, "on_chat": True, "composer": True}
+
+    def recover(self, action):
+        """Wykonuje działanie naprawcze HealthMonitor ("refresh" albo "renavigate")."""
+
+    def close(self):
+        pass
+
+
+class SeleniumTransport(ChatTransport):
+    """Rozmowa w karcie przeglądarki: odczyt przez skrypty DOM, zapis przez pole wpisu."""
+
+    name = "selenium"
+    resumable = True
+
+    def __init__(self, driver_instance, url=CHAT_URL):
+        load_selenium()
+        self.driver = driver_instance
+        self.url = url
+        self.handle = None
+        self.observed_count = None
+        self.last_poll = 0.0
+        self.pending_tail = None  # (indeks, skrót, od kiedy) ostatniej, jeszcze niepotwierdzonej wiadomości
+        self.stop_button_seen = False
+        self.selectors = PageSelectors()  # cache selektorów i błędy "stale element" tej karty
+
+    def open(self, claimed):
+        """
+        Wiąże sesję z kartą przeglądarki: z kartą otwartą już na adresie rozmowy
+        (bez przeładowania – ciepły start), z bieżącą kartą (gdy żadna inna sesja jej
+        nie zajęła) albo z nowo otwartą.
+        """
+        target = self.url.rstrip("/")
+        for handle in self.driver.window_handles:
+            if handle in claimed:
+                continue
+            self.driver.switch_to.window(handle)
+            if self.driver.current_url.split("?")[0].rstrip("/") == target:
+                self.handle = handle
+                claimed.add(handle)
+                logging.info("Karta %s jest już na stronie rozmowy – bez przeładowania.", handle)
+                wait_for_page_ready(self.driver, selectors=self.selectors)
+                return
+        if self.driver.window_handles[0] not in claimed:
+            self.driver.switch_to.window(self.driver.window_handles[0])
+        else:
+            self.driver.switch_to.new_window("tab")
+        self.handle = self.driver.current_window_handle
+        claimed.add(self.handle)
+        logging.info("Sesja przypięta do karty %s.", self.handle)
+        navigate_to_chat(self.driver, self.url, self.selectors)
+
+    def activate(self):
+        self.driver.switch_to.window(self.handle)
+
+    def send(self, message):
+        return send_message(self.driver, message, self.selectors)
+
+    def wait_idle(self, timeout=COMPOSER_IDLE_TIMEOUT):
+        return wait_for_composer_idle(self.driver, timeout)
+
+    def wait_ready(self, timeout=COMPOSER_IDLE_TIMEOUT):
+        if not wait_for_composer(self.driver, lambda state: not state["generating"], timeout):
+            logging.warning("Luna nadal odpowiada po %d s – wysyłam mimo to.", timeout)
+
+    def busy(self):
+        try:
+            return bool(get_composer_state(self.driver)["generating"])
+        except Exception as e:
+            logging.warning("Nie udało się sprawdzić stanu pola wpisu: %s", e)
+            return False  # Like wait_ready after its timeout: send anyway
+
+    def delivery_mark(self):
+        try:
+            return self.driver.execute_script(LAST_USER_TURN_SCRIPT, USER_TURN_SELECTOR)["count"]
+        except Exception as e:
+            logging.warning("Nie udało się policzyć wysłanych wiadomości: %s", e)
+            return None
+
+    def was_delivered(self, message, mark):
+        if mark is None:
+            return False  # Without a baseline an identical earlier post (e.g. a fixed status) looks delivered
+        try:
+            last = self.driver.execute_script(LAST_USER_TURN_SCRIPT, USER_TURN_SELECTOR)
+        except Exception as e:
+            logging.warning("Nie udało się sprawdzić ostatniej wysłanej wiadomości: %s", e)
+            return False
+        # Only a turn added after the mark counts – the same text earlier in the chat is a different post
+        return last["count"] > mark and last["text"] is not None and _normalized(last["text"]) == _normalized(message)
+
+    def wait_for_activity(self, timeout, wake=None):
+        sleep = wake.wait if wake is not None else time.sleep
+        if self.pending_tail is not None:
+            # Luna is still writing the last turn: re-check it shortly instead of waiting for the observer
+            sleep(min(timeout, TURN_STABLE_PROBE))
+            return True
+        if EVENT_DRIVEN_MODE and self.observed_count is None:
+            # (Re)install after start-up or after a refresh wiped the page state
+            self.observed_count = install_message_observer(self.driver)
+            if self.observed_count is not None:
+                return True # Scrape once: turns may have landed while there was no observer
+        if self.observed_count is None:
+            # Fallback: plain polling every POLL_INTERVAL seconds
+            wait = POLL_INTERVAL - (time.monotonic() - self.last_poll)
+            if wait > timeout:
+                sleep(timeout)
+                return False
+            sleep(max(wait, 0))
+            if wake is not None and wake.is_set():
+                return False
+            self.last_poll = time.monotonic()
+            return True
+        if wake is None:
+            self.observed_count, page_changed = wait_for_new_message(self.driver, self.observed_count, timeout)
+            return page_changed
+        # The browser-side wait cannot be interrupted: wait in short slices and check wake in between
+        deadline = time.monotonic() + timeout
+        while not wake.is_set():
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            self.observed_count, page_changed = wait_for_new_message(
+                self.driver, self.observed_count, min(remaining, PENDING_WAKE_SLICE))
+            if page_changed:
+                return True
+        return False
+
+    def _is_final(self, turn):
+        """
+        Czy wiadomość jest już kompletna. Wcześniejsze wiadomości są zawsze kompletne; ostatnia –
+        gdy nie jest generowana, a zniknięcie przycisku "stop" jest wiarygodne (widzieliśmy go
+        wcześniej) albo jej treść nie zmieniła się między dwoma sprawdzeniami.
+        """
+        if not turn.get("tail", True):
+            return True
+        now = time.monotonic()
+        previous, self.pending_tail = self.pending_tail, None
+        if turn.get("streaming"):
+            self.stop_button_seen = True
+            self.pending_tail = (turn["index"], turn["hash"], now)
+            return False
+        if self.stop_button_seen:
+            return True
+        if previous is not None and previous[:2] == (turn["index"], turn["hash"]):
+            if now - previous[2] >= TURN_STABLE_PROBE:
+                return True
+            self.pending_tail = previous
+            return False
+        self.pending_tail = (turn["index"], turn["hash"], now)
+        return False
+
+    def new_turns(self, cursor):
+        turns, new_cursor = get_new_turns(self.driver, cursor, self.selectors)
+        if turns and not self._is_final(turns[-1]):
+            # Hold the unfinished turn back: the cursor stays before it, so it is read again once complete
+            turns = turns[:-1]
+            new_cursor = {"index": turns[-1]["index"] + 1, "id": turns[-1]["id"]} if turns else cursor
+        elif not turns:
+            self.pending_tail = None
+        return turns, new_cursor
+
+    def instruction_in_context(self):
+        try:
+            return bool(self.driver.execute_script(
+                INSTRUCTION_CHECK_SCRIPT, USER_TURN_SELECTOR, INSTRUCTION_MARKER, INSTRUCTION_CONTEXT_TURNS))
+        except Exception as e:
+            logging.warning("Nie udało się sprawdzić, czy instrukcja jest w rozmowie: %s", e)
+            return False
+
+    def probe(self):
+        result = {"dom_alive": False, "on_chat": False, "composer": False}
+        try:
+            page = self.driver.execute_script(
+                "return {ready: document.readyState, url: location.href, body: !!document.body};")
+            result["dom_alive"] = bool(page and page["body"]) and page["ready"] in ("interactive", "complete")
+            result["on_chat"] = bool(page) and page["url"].split("?")[0].rstrip("/") == self.url.rstrip("/")
+        except Exception as e:
+            logging.warning("Sonda DOM nie odpowiada: %s", e)
+        if result["dom_alive"]:
+            try:
+                get_textarea_element(self.driver, self.selectors)
+                result["composer"] = True
+            except Exception:
+                pass
+        result["stale_events"] = self.selectors.recent_stale_events()
+        return result
+
+    def recover(self, action):
+        if action == "renavigate":
+            navigate_to_chat(self.driver, self.url, self.selectors)
+        elif action == "refresh":
+            refresh_page(self.driver, self.selectors)
+            wait_for_page_ready(self.driver, selectors=self.selectors)
+        self.observed_count = None # The page was reloaded – reinstall the observer
+
+
+class HttpTransport(ChatTransport):
+    """
+    Rozmowa bez przeglądarki – bezpośrednio przez HTTP ze strumieniowaniem odpowiedzi:
+      • api="openai": endpoint zgodny z OpenAI (/v1/chat/completions, SSE),
+      • api="vercel": trasa app/api/chat/route.ts tego repozytorium (strumień AI SDK,
+        identyfikator rozmowy w nagłówku x-conversation-id).
+    Odpowiedź Luny jest odbierana w całości w send(), więc wait_idle() nie czeka.
+    """
+
+    name = "http"
+
+    def __init__(self, url, api=HTTP_API, model=HTTP_MODEL, timeout=HTTP_TIMEOUT):
+        self.url = url
+        self.api = api
+        self.model = model
+        self.timeout = timeout
+        self.history = []  # [{"role": ..., "content": ...}] – wysyłane przy każdym żądaniu
+        self.turns = []  # odpowiedzi Luny w formacie get_new_turns
+        self.delivered = 0
+        self.conversation_id = None
+        self.last_error = None
+        # The history lives only in this process: a per-run prefix keeps turn ids from matching
+        # keys that an earlier run saved in the seen journal (which would skip every new reply)
+        self.run_id = uuid.uuid4().hex[:12]
+
+    def _request_body(self, message):
+        messages = (self.history + [{"role": "user", "content": message}])[-HTTP_HISTORY_LIMIT:]
+        if self.api == "vercel":
+            return {"messages": messages, "data": {"conversationId": self.conversation_id}}
+        return {"model": self.model, "messages": messages, "stream": True}
+
+    def _headers(self):
+        headers = {"Content-Type": "application/json", "Accept": "text/event-stream"}
+        api_key = os.environ.get(HTTP_API_KEY_ENV)
+        if api_key:
+            headers["Authorization"] = f"Bearer {api_key}"
+        return headers
+
+    def _read_reply(self, response):
+        """Składa odpowiedź ze strumienia (SSE OpenAI, strumień AI SDK albo zwykły JSON)."""
+        if response.headers.get("Content-Type", "").startswith("application/json"):
+            data = json.loads(response.read().decode("utf-8"))
+            return data["choices"][0]["message"]["content"] or ""
+        chunks = []
+        for raw in response:
+            line = raw.decode("utf-8").rstrip("\r\n")
+            if self.api == "vercel":
+                # AI SDK data stream: '0:"text"' are text parts, other part types are skipped
+                if line.startswith("0:"):
+                    chunks.append(json.loads(line[2:]))
+                elif line and not re.match(r"^[0-9a-z]+:", line):
+                    chunks.append(line + "\n")
+                continue
+            if not line.startswith("data:"):
+                continue
+            payload = line[5:].strip()
+            if payload == "[DONE]":
+                break
+            delta = json.loads(payload)["choices"][0].get("delta", {})
+            chunks.append(delta.get("content") or "")
+        return "".join(chunks)
+
+    def send(self, message):
+        started = time.monotonic()
+        # The message joins the history only once it was accepted – a retry never duplicates it
+        request = urllib.request.Request(
+            self.url, data=json.dumps(self._request_body(message)).encode("utf-8"), headers=self._headers(), method="POST")
+        try:
+            with urllib.request.urlopen(request, timeout=self.timeout) as response:
+                self.conversation_id = response.headers.get("x-conversation-id") or self.conversation_id
+                reply = self._read_reply(response)
+        except Exception as e:
+            self.last_error = e
+            logging.exception("Błąd przy wysyłaniu wiadomości (HTTP %s): %s", self.url, e)
+            metrics.inc("luna_send_failures_total", method="http")
+            return False
+        self.last_error = None
+        self.history.append({"role": "user", "content": message})
+        logging.info("Wysłano wiadomość (http, %.2f s): %s", time.monotonic() - started, LogBody(message))
+        metrics.observe("luna_send_seconds", time.monotonic() - started, method="http")
+        if reply.strip():
+            self.history.append({"role": "assistant", "content": reply})
+            index = len(self.turns)
+            self.turns.append({"index": index, "id": f"http-{self.run_id}-{index}", "text": reply.strip(), "hash": turn_hash(reply.strip())})
+        return True
+
+    def wait_for_activity(self, timeout, wake=None):
+        # Replies arrive inside send(); nothing can land while we wait here
+        if len(self.turns) > self.delivered:
+            return True
+        if wake is not None:
+            wake.wait(timeout)
+        else:
+            time.sleep(timeout)
+        return False
+
+    def new_turns(self, cursor):
+        turns = self.turns[cursor["index"]:]
+        self.delivered = len(self.turns)
+        if not turns:
+            return [], cursor
+        return turns, {"index": turns[-1]["index"] + 1, "id": turns[-1]["id"]}
+
+    def instruction_in_context(self):
+        recent = [m for m in self.history if m["role"] == "user"][-INSTRUCTION_CONTEXT_TURNS:]
+        return any(INSTRUCTION_MARKER in m["content"] for m in recent)
+
+    def probe(self):
+        return {"dom_alive": True, "on_chat": True, "composer": self.last_error is None}
+
+    def recover(self, action):
+        # Stateless HTTP: start a fresh conversation only when re-navigation is requested
+        if action == "renavigate":
+            self.conversation_id = None
+        self.last_error = None
+
+
+def make_transport(config, driver_instance=None):
+    """Tworzy transport sesji na podstawie jej konfiguracji (klucz "transport")."""
+    kind = config.get("transport", TRANSPORT)
+    if kind == "http":
+        return HttpTransport(config.get("url", HTTP_URL), config.get("api", HTTP_API), config.get("model", HTTP_MODEL))
+    if kind == "selenium":
+        return SeleniumTransport(driver_instance, config.get("url", CHAT_URL))
+    raise ValueError(f"Nieznany transport: {kind}")
@@ -6,38 +6,79 @@
 --------------------------------------------------
 
 Funkcjonalności:
-  • Łączy się z Chrome (tryb debugowania przez Selenium).
-  • Nawiguje do czatu (domyślnie https://chatgpt.com).
+  • Łączy się z Chrome (tryb debugowania przez Selenium) albo – transport "http" –
+    bezpośrednio z API czatu (zgodnym z OpenAI lub app/api/chat/route.ts);
+    offline/CI: fake_chat_server.py.
+  • Nawiguje do czatu (domyślnie https://chatgpt.com); może obsługiwać wiele rozmów
+    naraz (sessions.json) – każda w osobnej karcie, z własną pamięcią i stanem.
   • Po uruchomieniu wysyła wiadomość INSTRUCTION_MSG z zasadami komunikacji.
-  • W cyklicznych iteracjach (co 30 sekund) pobiera nowe odpowiedzi Luny,
-    interpretuje prefiksy, wykonuje akcje i odsyła odpowiedź.
+  • Czeka na nowe odpowiedzi Luny – w trybie zdarzeniowym (MutationObserver w DOM)
+    budzi się zaraz po pojawieniu się wiadomości, awaryjnie odpytuje co 30 sekund –
+    interpretuje prefiksy, wykonuje akcje i odsyła odpowiedź. Każda wiadomość jest
+    przetwarzana dokładnie raz – dopiero gdy Luna skończy ją pisać.
   • Wykorzystuje wiele możliwych selektorów do wyszukiwania pola wpisu (textarea)
     oraz elementów z odpowiedziami (response selectors).
-  • Co 5 cykli odświeża stronę.
+  • Przetwarza każdą nową wiadomość (nie tylko ostatnią) – historia przetworzonych
+    wiadomości jest trwała (state/seen_messages.log), więc nic nie jest wykonywane dwa razy.
+  • Ciepły start: używa karty, która jest już na stronie rozmowy, wznawia kursor
+    (state/checkpoint.json) i nie wysyła instrukcji, jeśli jest nadal w rozmowie.
+  • Zapisuje pamięć Luny w segmentowanych logach (memory/<kategoria>/segments)
+    z indeksem przesunięć i wspólnym fsync dla partii zapisów (opcjonalnie SQLite WAL).
+  • Utrzymuje przyrostowy indeks pełnotekstowy pamięci – prefiks L:>SZU.
+  • Zbiera metryki (czasy etapów, przepustowość, kolejki) – endpoint Prometheusa
+    http://127.0.0.1:9464/metrics i okresowe migawki JSON w logs/metrics.jsonl.
+  • Odświeża stronę, nawiguje ponownie lub ponawia instrukcję tylko wtedy, gdy
+    wymagają tego sondy zdrowia (HealthMonitor), z wykładniczym odstępem.
 --------------------------------------------------
 """
 
 import os
 import time
 import logging
+import logging.handlers
 import datetime
 import subprocess
+import signal
+import threading
+import itertools
+import re
+import json
+import heapq
+import mmap
+import gzip
+import shutil
+import queue
+import atexit
+import copy
+import zlib
+import argparse
+import tempfile
+from collections import deque, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from math import ceil
-from selenium import webdriver
-from selenium.webdriver.chrome.options import Options
-from selenium.webdriver.common.by import By
-from selenium.webdriver.common.keys import Keys
-
-# Ustawienia globalne – lista prefiksów (możesz ją rozszerzać, jeśli potrzebujesz)
-ALLOWED_PREFIXES = ["L:>P", "L:>L", "!PAMIETNIK!", "!OBRAZEK!", "L:>CMD", "%LOAD%", "L:>WIA", "L:>AKC"]
-
-# Definicje katalogów (używamy ścieżek względnych – jeśli cały projekt znajduje się np. w F:\Lunafreya_server)
-MESSAGES_TO_ME_DIR = os.path.join("memory", "wiadomosci_do_ciebie")
-MEMORY_DIR = os.path.join("memory", "rozmyslania")
-PAMIECIANKA_DIR = os.path.join("memory", "pamietniki")
-OBRAZY_DIR = os.path.join("memory", "obrazy")
-WIADOMOSCI_DIR = os.path.join("memory", "wiadomosci")
-AKCJE_DIR = os.path.join("memory", "akcje")
+
+from luna_metrics import (
+    METRICS_ENABLED, METRICS_SNAPSHOT_INTERVAL, LogBody, metrics, start_metrics_server,
+    start_metrics_snapshots,
+)
+from luna_executor import (
+    ALLOWED_PREFIXES, WORKER_THREADS, CommandExecutor, current_cancel_event, current_namespace,
+    detect_prefix, job_context, split_commands,
+)
+from luna_storage import (
+    AKCJE_DIR, CMD_SPILL_PREFIX, DISPATCH_JOURNAL_FILE, MEMORY_CATEGORIES, MEMORY_DIR,
+    MESSAGES_TO_ME_DIR, OBRAZY_DIR, PAMIECIANKA_DIR, SEEN_INDEX_FILE, STATE_DIR, WIADOMOSCI_DIR,
+    DispatchJournal, get_memory_store, get_search_index, make_snippet, memory_stores,
+    namespace_paths, open_memory_stores, read_memory_document, search_indexes, SeenIndex,
+    store_open_hooks,
+)
+from luna_transport import (
+    HEALTH_WINDOW, POLL_INTERVAL, TRANSPORT, make_transport, new_scrape_cursor, setup_driver,
+    turn_key,
+)
+
+# Prefiksy i wykonywanie poleceń: luna_executor.py; magazyn pamięci, indeks wyszukiwania i stan
+# sesji (state/): luna_storage.py; przeglądarka i API czatu: luna_transport.py; metryki: luna_metrics.py
 LOGS_DIR = os.path.join("logs", "server_log")
 
 # Limity – całkowita długość wiadomości brutto: 4096 znaków; margines (np. 200 znaków) na nagłówki itp.
@@ -45,283 +86,819 @@ SAFETY_MARGIN = 200
 MAX_TOTAL_LENGTH = 4096
 MAX_CONTENT_LENGTH = MAX_TOTAL_LENGTH - SAFETY_MARGIN
 
-# Lista selektorów, które mogą odpowiadać polu tekstowemu (textarea)
-TEXTAREA_SELECTORS = [
-    "textarea",
-    "div[contenteditable='true']",
-    "form textarea",
-    "form div[contenteditable='true']"
-]
-# Lista selektorów, które mogą odpowiadać elementom zawierającym odpowiedź (np. wiadomość od Luny)
-RESPONSE_SELECTORS = [
-    "[data-message-author-role='assistant']",
-    ".markdown.prose",
-    "[data-testid='conversation-turn-3']",
-    ".prose",
-    "div[data-message-author-role='assistant'] div.prose",
-    "div[data-message-author-role='assistant']"
-]
-
-# This is a placeholder for CHROME_DRIVER_PATH. 
-# You would need to set this to the actual path of your ChromeDriver executable.
-CHROME_DRIVER_PATH = "path/to/chromedriver" 
+# Handlery w puli wątków (luna_executor.CommandExecutor): limity L:>CMD, potwierdzenia przyjęcia, partie
+CMD_TIMEOUT = 30  # limit czasu pojedynczej komendy L:>CMD
+# Wynik L:>CMD czytany strumieniowo: w pamięci tylko początek i koniec, całość trafia do pliku w 'akcje'
+CMD_MAX_OUTPUT_BYTES = 50 * 1024 * 1024  # po przekroczeniu komenda jest przerywana
+CMD_HEAD_BYTES = 1024  # ile bajtów z początku wyniku trafia do odpowiedzi
+CMD_TAIL_BYTES = 1024  # ile bajtów z końca wyniku trafia do odpowiedzi (bufor pierścieniowy)
+CMD_READ_CHUNK = 64 * 1024
+# Limity dla wybranych programów (pierwsze słowo komendy), np. {"ping": {"timeout": 60, "max_bytes": 65536}}
+CMD_LIMITS = {}
+# Prefiksy, dla których od razu wysyłamy do rozmowy potwierdzenie przyjęcia (wynik przychodzi później).
+# Domyślnie pusta: każde potwierdzenie to dodatkowa wiadomość i dodatkowa odpowiedź Luny; przyjęcie
+# zadania widać w logu i w metryce luna_jobs_submitted_total. Włączenie np.: ["L:>CMD"]
+ACK_PREFIXES = []
+PENDING_POLL_INTERVAL = 1  # jak często (s) sprawdzać gotowe wyniki, gdy zadania są w toku
+# Polecenia, które w partii mogą działać równolegle (tylko zapisy do pamięci); pozostałe
+# (L:>CMD, %LOAD%, L:>SZU) czekają na wcześniejsze i wykonują się po kolei
+BATCH_PARALLEL_PREFIXES = ["L:>P", "L:>L", "!PAMIETNIK!", "!OBRAZEK!", "L:>WIA", "L:>AKC"]
+
+# Kompaktowanie i retencja (zadanie w tle): stare pliki .txt trafiają do miesięcznych archiwów gzip,
+# zamknięte segmenty magazynu są kompresowane, logi rotowane według rozmiaru; %LOAD% czyta archiwa jak pliki
+COMPACTION_INTERVAL = 3600  # co ile sekund uruchamiać kompaktowanie (0 = wyłączone)
+COMPACTION_START_DELAY = 60  # pierwszy przebieg chwilę po starcie serwera
+COMPACT_AFTER_DAYS = 7  # wpisy starsze niż tyle dni są archiwizowane / kompresowane
+MEMORY_RETENTION_DAYS = {}  # kategoria -> po ilu dniach usuwać wpisy, np. {"akcje": 90}; brak kategorii = bez limitu
+CMD_SPILL_RETENTION_DAYS = 30  # pliki z pełnym wynikiem L:>CMD (memory/akcje/cmd-*.txt)
+LOG_MAX_BYTES = 10 * 1024 * 1024  # rozmiar, po którym plik logu jest rotowany
+LOG_BACKUP_COUNT = 5  # ile rotowanych (skompresowanych) części logu zachować
+LOG_RETENTION_DAYS = 30  # starsze logi z poprzednich uruchomień są usuwane (0 = bez limitu)
+
+# %LOAD% – stronicowanie dużych plików i pamięć podręczna wczytanych modułów
+LOAD_PAGE_BYTES = MAX_CONTENT_LENGTH - 400  # bajty na stronę (zapas na nagłówek odpowiedzi)
+LOAD_CACHE_ENTRIES = 64  # ile stron / indeksów stron trzymamy w pamięci podręcznej LRU
+
+# Harmonogram naprawczy sterowany sondami zdrowia (zamiast bezwarunkowego odświeżania)
+HEALTH_CHECK_INTERVAL = 60  # co ile sekund uruchamiamy sondy, gdy wszystko działa
+STALE_EVENTS_LIMIT = 5  # tyle błędów stale w oknie => odświeżenie strony
+HEALTH_ERROR_LIMIT = 2  # tyle kolejnych błędów cyklu => odświeżenie (dwa razy tyle => nawigacja)
+PROTOCOL_DRIFT_TURNS = 3  # tyle kolejnych wiadomości Luny bez prefiksu => ponowne wysłanie instrukcji
+HEALTH_BACKOFF_MIN = 30  # minimalny odstęp (s) między powtórzeniami tego samego działania
+HEALTH_BACKOFF_MAX = 900
+
+# Kolejka wiadomości wychodzących (Outbox): priorytety (mniejsza liczba = wcześniej), scalanie, ponawianie
+# Potwierdzenia mają priorytet odpowiedzi: kolejność wyznacza wtedy numer wpisu, więc potwierdzenie
+# późniejszego zadania nie wyprzedza czekających odpowiedzi na wcześniejsze
+OUTBOX_PRIORITY_REPLY = 1
+OUTBOX_PRIORITY_ACK = OUTBOX_PRIORITY_REPLY
+OUTBOX_PRIORITY_INSTRUCTION = 2
+OUTBOX_MERGEABLE_PREFIXES = ("REQ:>STATUS", "ERR:>LOG")  # krótkie komunikaty z tymi prefiksami są scalane
+OUTBOX_MERGE_MAX_CHARS = 500  # dłuższe komunikaty wychodzą jako osobne posty
+OUTBOX_RETRIES = 3  # próby wysłania w jednym przebiegu
+OUTBOX_RETRY_DELAY = 1  # sekundy (podwajane przy kolejnych próbach)
+OUTBOX_MAX_ATTEMPTS = 5  # po tylu nieudanych przebiegach post jest porzucany
+
+# Zapis przebiegu sesji (wiadomości, przekazanie do wykonania, wyniki, wysłane posty) do odtworzenia:
+#   python server.py --replay logs/traces/<sesja>-<czas>.trace.jsonl.gz [...] [--speed 1000] [--output wyniki.jsonl]
+# (kilka plików – kilka sesji: wiadomości wracają do przestrzeni nazw swojej sesji)
+TRACE_ENABLED = True
+TRACE_DIR = os.path.join("logs", "traces")
+TRACE_FLUSH_INTERVAL = 5  # co ile sekund zrzucać bufor pliku zapisu na dysk
+TRACE_VERSION = 2  # 2: każde zdarzenie ma pole "session", start – "namespace"
+
+# Ciepły start: stan sesji (kursor) zapisywany w state/, instrukcja pomijana, jeśli jest nadal w rozmowie
+CHECKPOINT_FILE = os.path.join(STATE_DIR, "checkpoint.json")
+
+# Wiele rozmów z jednego procesu: plik JSON z listą rozmów (brak pliku = jedna rozmowa CHAT_URL)
+SESSIONS_FILE = "sessions.json"
+MULTI_SESSION_TICK = 1  # co ile sekund odwiedzamy karty, gdy rozmów jest kilka
 
 # Global driver variable, initialized later
 driver = None
+# Global session manager (tabs, per-conversation state, shared worker pool), created by server_loop
+session_manager = None
+
 
 def ensure_directories():
     """Tworzy wymagane katalogi, jeśli ich nie ma."""
     dirs = [
         MESSAGES_TO_ME_DIR, MEMORY_DIR, PAMIECIANKA_DIR,
-        OBRAZY_DIR, WIADOMOSCI_DIR, AKCJE_DIR, LOGS_DIR
+        OBRAZY_DIR, WIADOMOSCI_DIR, AKCJE_DIR, LOGS_DIR, STATE_DIR
     ]
     for d in dirs:
         if not os.path.exists(d):
             os.makedirs(d)
             logging.info("Utworzono katalog: %s", d)
 
+# Logowanie nieblokujące: wątki tylko wrzucają rekordy do kolejki, zapis robi osobny wątek (QueueListener).
+# Plik logu to JSON Lines (jeden rekord na linię), konsola – zwykły tekst.
+LOG_JSON = True  # False = plik logu w formacie tekstowym jak na konsoli
+LOG_TEXT_FORMAT = "[%(asctime)s] %(levelname)s: %(message)s"
+LOG_DATE_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+log_listener = None  # wątek zapisujący logi, uruchamiany przez setup_logging()
+
+
+class LogContextFilter(logging.Filter):
+    """Dopisuje do rekordu identyfikator cyklu i zadania (korelacja) oraz pola treści z LogBody."""
+
+    def filter(self, record):
+        record.cycle = getattr(job_context, "cycle", None)
+        record.job = getattr(job_context, "job", None)
+        args = record.args if isinstance(record.args, tuple) else ()
+        for arg in args:
+            if isinstance(arg, LogBody):
+                record.body_len, record.body_sha1 = len(arg.text), arg.digest
+                break
+        return True
+
+
+class LogQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler, który w wątku wołającym tylko scala argumenty – formatowanie (i tracebacki) robi QueueListener."""
+
+    def prepare(self, record):
+        record = copy.copy(record)
+        record.msg, record.args = record.getMessage(), None
+        return record
+
+
+class JsonFormatter(logging.Formatter):
+    """Rekord logu jako jedna linia JSON – do przeszukiwania logów narzędziami (jq, grep)."""
+
+    FIELDS = ("cycle", "job", "body_len", "body_sha1")
+
+    def format(self, record):
+        entry = {
+            "ts": datetime.datetime.fromtimestamp(record.created).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "thread": record.threadName,
+            "msg": record.getMessage(),
+        }
+        for field in self.FIELDS:
+            value = getattr(record, field, None)
+            if value is not None:
+                entry[field] = value
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            entry["exc"] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False)
+
+
+def _gzip_rotator(source, dest):
+    """Rotacja logu: zamknięta część trafia od razu do archiwum .gz."""
+    with open(source, "rb") as src, gzip.open(dest, "wb") as dst:
+        shutil.copyfileobj(src, dst)
+    os.remove(source)
+
 def setup_logging():
-    """Konfiguruje logowanie – logi zapisywane są do pliku oraz wyświetlane na konsoli."""
+    """
+    Konfiguruje logowanie – logi zapisywane są do pliku oraz wyświetlane na konsoli.
+    Wywołania logging.* tylko wrzucają rekord do kolejki; plik i konsolę obsługuje
+    wątek QueueListener. Plik jest rotowany po LOG_MAX_BYTES; starsze części są
+    kompresowane (.log.N.gz).
+    """
+    global log_listener
     log_file = os.path.join(LOGS_DIR, datetime.datetime.now().strftime("%Y-%m-%d-%H%M") + ".log")
-    logging.basicConfig(
-        level=logging.INFO,
-        format="[%(asctime)s] %(levelname)s: %(message)s",
-        datefmt="%Y-%m-%d %H:%M:%S",
-        handlers=[
-            logging.FileHandler(log_file, encoding="utf-8"),
-            logging.StreamHandler()
-        ]
-    )
+    file_handler = logging.handlers.RotatingFileHandler(
+        log_file, maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUP_COUNT, encoding="utf-8")
+    file_handler.namer = lambda name: name + ".gz"
+    file_handler.rotator = _gzip_rotator
+    text_formatter = logging.Formatter(LOG_TEXT_FORMAT, datefmt=LOG_DATE_FORMAT)
+    file_handler.setFormatter(JsonFormatter() if LOG_JSON else text_formatter)
+    console_handler = logging.StreamHandler()
+    console_handler.setFormatter(text_formatter)
+
+    log_queue = queue.SimpleQueue()
+    queue_handler = LogQueueHandler(log_queue)
+    queue_handler.addFilter(LogContextFilter())  # runs in the calling thread, before the record is queued
+    log_listener = logging.handlers.QueueListener(log_queue, file_handler, console_handler)
+    log_listener.start()
+    atexit.register(log_listener.stop)  # flush queued records on exit
+    logging.basicConfig(level=logging.INFO, handlers=[queue_handler])
+
+def active_log_files():
+    """Ścieżki plików logu, do których właśnie piszemy (pomijane przy kompaktowaniu)."""
+    handlers = list(logging.getLogger().handlers) + list(log_listener.handlers if log_listener else ())
+    return {os.path.abspath(handler.baseFilename) for handler in handlers if isinstance(handler, logging.FileHandler)}
+
 
-def get_chrome_options():
-    """Przykładowa funkcja zwracająca opcje Chrome – możesz zmodyfikować według własnych potrzeb."""
-    chrome_options = Options()
-    # Ensure Chrome is launched with: --remote-debugging-port=9222
-    chrome_options.add_experimental_option("debuggerAddress", "127.0.0.1:9222") 
-    return chrome_options
+# Stronicowanie %LOAD% i pamięć podręczna wczytanych modułów
 
-def setup_driver():
+def compute_page_offsets(buf, start, end, page_bytes=LOAD_PAGE_BYTES):
     """
-    Konfiguruje Selenium do łączenia się z Chrome w trybie debugowania.
-    Upewnij się, że Chrome uruchomiony jest z flagą:
-      --remote-debugging-port=9222 --user-data-dir="ścieżka_do_profilu"
+    Dzieli bajty buf[start:end] (bytes albo mmap) na strony o rozmiarze co najwyżej
+    page_bytes. Granica strony wypada na końcu linii, jeśli to możliwe, i nigdy
+    w środku znaku UTF-8. Zwraca listę przesunięć kolejnych granic (bez start).
     """
-    global driver # Use the global driver variable
-    chrome_options = get_chrome_options()
-    try:
-        # If CHROME_DRIVER_PATH is not set, Selenium might find it if it's in PATH
-        # For explicit path: webdriver.Chrome(executable_path=CHROME_DRIVER_PATH, options=chrome_options)
-        driver = webdriver.Chrome(options=chrome_options)
-        logging.info("Połączono z Chrome przez Selenium.")
-        return driver
-    except Exception as e:
-        # Fallback if connection to existing debugger fails, try to launch a new one
-        # This part might need adjustment based on how Chrome is launched for debugging
-        logging.warning(f"Nie udało się połączyć z istniejącą instancją Chrome przez debuggerAddress: {e}. Próba uruchomienia nowej instancji.")
-        try:
-            # Reset options for a standard launch if debugger connection fails
-            new_chrome_options = Options() 
-            # Add any necessary options for a new instance, e.g., headless, user-data-dir
-            # new_chrome_options.add_argument("--headless") 
-            driver = webdriver.Chrome(options=new_chrome_options)
-            logging.info("Uruchomiono nową instancję Chrome.")
-            return driver
-        except Exception as ex:
-            logging.exception("Błąd przy łączeniu/uruchamianiu Chrome: %s", ex)
-            raise
-
-
-def navigate_to_chat(driver_instance):
-    """Nawiguje do strony czatu – domyślnie https://chatgpt.com."""
-    # The URL from your screenshot and prompt
-    url = "https://chatgpt.com/c/684583aa-f7a8-8006-b808-b10b00644761" 
-    # Fallback or default if the specific chat isn't available
-    # url = "https://chatgpt.com/" 
-    driver_instance.get(url)
-    logging.info("Nawigacja do strony: %s", url)
-    time.sleep(5)
-
-def get_textarea_element(driver_instance):
-    """
-    Przechodzi przez listę TEXTAREA_SELECTORS i zwraca pierwszy znaleziony element.
-    Jeśli żaden element nie zostanie znaleziony, zgłasza wyjątek.
-    """
-    for selector in TEXTAREA_SELECTORS:
-        try:
-            element = driver_instance.find_element(By.CSS_SELECTOR, selector)
-            logging.info("Znaleziono element textarea przy użyciu selektora: %s", selector)
-            return element
-        except Exception:
-            continue
-    # A more specific selector based on common ChatGPT structure if others fail
-    try:
-        element = driver_instance.find_element(By.ID, "prompt-textarea")
-        logging.info("Znaleziono element textarea przy użyciu selektora: #prompt-textarea")
-        return element
-    except Exception:
-        logging.error("Nie znaleziono elementu pola tekstowego przy użyciu żadnego selektora.")
-        raise Exception("Nie znaleziono elementu pola tekstowego.")
+    offsets = []
+    pos = start
+    while end - pos > page_bytes:
+        limit = pos + page_bytes
+        newline = buf.rfind(b"\n", pos + page_bytes // 2, limit)
+        if newline >= 0:
+            cut = newline + 1
+        else:
+            cut = limit
+            while cut > pos and (buf[cut] & 0xC0) == 0x80:  # UTF-8 continuation byte
+                cut -= 1
+        offsets.append(cut)
+        pos = cut
+    offsets.append(end)
+    return offsets
+
 
+class FilePageIndex:
+    """Indeks granic stron pliku; dla rosnących plików (logi) dobudowywany przyrostowo."""
 
-def send_message(driver_instance, message):
+    def __init__(self, path):
+        self.path = path
+        self.size = 0
+        self.mtime = None
+        self.offsets = [0]
+        self.lock = threading.Lock()
+
+    def refresh(self):
+        """Aktualizuje indeks po zmianie pliku – bez czytania stron, które się nie zmieniły."""
+        stat = os.stat(self.path)
+        if stat.st_size == self.size and stat.st_mtime_ns == self.mtime:
+            return
+        if stat.st_size < self.size:
+            self.offsets = [0]  # truncated or rotated – start over
+        # The last page may have been partial; recompute from its start
+        if len(self.offsets) > 1:
+            self.offsets.pop()
+        start = self.offsets[-1]
+        if stat.st_size > start:
+            with open(self.path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                self.offsets.extend(compute_page_offsets(mm, start, stat.st_size))
+        elif len(self.offsets) == 1:
+            self.offsets.append(0)  # empty file – one empty page
+        self.size = stat.st_size
+        self.mtime = stat.st_mtime_ns
+
+    @property
+    def pages(self):
+        return len(self.offsets) - 1
+
+    def read_page(self, page):
+        """Zwraca tekst strony (numerowanej od 1) – czyta tylko jej bajty przez mmap."""
+        start, end = self.offsets[page - 1], self.offsets[page]
+        if end <= start:
+            return ""
+        with open(self.path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            return mm[start:end].decode("utf-8", errors="replace")
+
+
+class LoadCache:
     """
-    Wysyła wiadomość do pola tekstowego.
-    Wyszukuje element przy użyciu funkcji get_textarea_element.
+    Pamięć podręczna LRU dla %LOAD%: wczytane strony modułów oraz indeksy stron plików.
+    Wpisy modułu są unieważniane przy każdym zapisie do tego modułu.
     """
-    try:
-        input_box = get_textarea_element(driver_instance)
-        # More robust clearing and sending
-        driver_instance.execute_script("arguments[0].value = '';", input_box) # Clear with JS
-        input_box.click()
-        input_box.send_keys(message)
-        # Try to find a send button if Enter doesn't work reliably
-        try:
-            send_button = driver_instance.find_element(By.CSS_SELECTOR, "button[data-testid='send-button']")
-            send_button.click()
-        except:
-            input_box.send_keys(Keys.ENTER)
-        
-        logging.info("Wysłano wiadomość:\n%s", message)
-    except Exception as e:
-        logging.exception("Błąd przy wysyłaniu wiadomości: %s", e)
 
-def get_response_messages(driver_instance):
+    def __init__(self, capacity=LOAD_CACHE_ENTRIES):
+        self.capacity = capacity
+        self.lock = threading.Lock()
+        self.pages = OrderedDict()  # (moduł, strona) -> (tekst, liczba stron)
+        self.file_indexes = OrderedDict()  # ścieżka -> FilePageIndex
+        self.stats = {"hits": 0, "misses": 0, "invalidations": 0}
+
+    def get(self, module, page):
+        with self.lock:
+            value = self.pages.get((module, page))
+            if value is None:
+                self.stats["misses"] += 1
+                return None
+            self.pages.move_to_end((module, page))
+            self.stats["hits"] += 1
+            return value
+
+    def put(self, module, page, value):
+        with self.lock:
+            self.pages[(module, page)] = value
+            self.pages.move_to_end((module, page))
+            while len(self.pages) > self.capacity:
+                self.pages.popitem(last=False)
+
+    def file_index(self, path):
+        with self.lock:
+            index = self.file_indexes.get(path)
+            if index is None:
+                index = self.file_indexes[path] = FilePageIndex(path)
+            self.file_indexes.move_to_end(path)
+            while len(self.file_indexes) > self.capacity:
+                self.file_indexes.popitem(last=False)
+            return index
+
+    def invalidate(self, module):
+        """Usuwa z pamięci podręcznej wszystkie strony modułu."""
+        with self.lock:
+            for key in [key for key in self.pages if key[0] == module]:
+                del self.pages[key]
+                self.stats["invalidations"] += 1
+
+    def on_store_write(self, prefix, category, name):
+        """Słuchacz MemoryStore: zapis wpisu unieważnia też dzienny moduł tej kategorii."""
+        self.invalidate(f"{prefix}/{category}/{name}.txt")
+        self.invalidate(f"{prefix}/{category}/{name[:10]}.txt")
+
+
+load_cache = LoadCache()
+# Every write to a memory store invalidates the cached %LOAD% pages of that module
+store_open_hooks.append(lambda store: store.listeners.append(
+    lambda category, name, text: load_cache.on_store_write(store.prefix, category, name)))
+
+def load_module_page(module, path, page):
     """
-    Przechodzi przez listę RESPONSE_SELECTORS i zbiera tekst z odnalezionych elementów.
-    Zwraca listę tekstów (jeśli znajdzie kilka wiadomości).
+    Zwraca (tekst strony, liczba stron) dla modułu %LOAD% albo None, jeśli moduł nie istnieje.
+    Pliki na dysku stronicowane są przez mmap i indeks przesunięć; wpisy magazynu
+    pamięci dzielone są na strony w pamięci.
     """
-    messages = []
-    # Prioritize more specific selectors that are common in ChatGPT
-    # This selector targets the main content of assistant messages
-    preferred_selector = "div[data-message-author-role='assistant'] > div > div.markdown"
-    
-    try:
-        elements = driver_instance.find_elements(By.CSS_SELECTOR, preferred_selector)
-        for el in elements:
-            text = el.text.strip()
-            if text:
-                messages.append(text)
-        if messages: # If preferred selector yields results, use them
-            logging.info(f"Znaleziono {len(messages)} wiadomości przy użyciu preferowanego selektora.")
-            return messages
-    except Exception:
-        logging.warning("Preferowany selektor odpowiedzi nie zadziałał lub nie znalazł elementów.")
+    if not os.path.isfile(path) and os.path.isfile(path + ".gz"):
+        path += ".gz"  # log compressed by compaction
+    if os.path.isfile(path) and not path.endswith(".gz"):
+        # Files on disk are validated by size/mtime in their page index, not cached by content
+        index = load_cache.file_index(path)
+        with index.lock:
+            index.refresh()
+            if page > index.pages:
+                return "", index.pages
+            return index.read_page(page), index.pages
+    cached = load_cache.get(module, page)
+    if cached is not None:
+        return cached
+    if os.path.isfile(path):
+        with gzip.open(path, "rt", encoding="utf-8", errors="replace") as f:
+            text = f.read()
+    else:
+        text = get_memory_store().read_path(module)
+    if text is None:
+        return None
+    data = text.encode("utf-8")
+    offsets = [0] + compute_page_offsets(data, 0, len(data))
+    total = len(offsets) - 1
+    result = ("", total)
+    for number in range(1, total + 1):
+        value = (data[offsets[number - 1]:offsets[number]].decode("utf-8"), total)
+        load_cache.put(module, number, value)
+        if number == page:
+            result = value
+    return result
 
-    # Fallback to the list of general selectors if the preferred one fails
-    for selector in RESPONSE_SELECTORS:
-        try:
-            elements = driver_instance.find_elements(By.CSS_SELECTOR, selector)
-            current_selector_messages = []
-            for el in elements:
-                text = el.text.strip()
-                if text:
-                    current_selector_messages.append(text)
-            if current_selector_messages:
-                 logging.info(f"Znaleziono {len(current_selector_messages)} wiadomości przy użyciu selektora: {selector}")
-                 # Return messages from the first successful selector to avoid duplicates from overlapping selectors
-                 return current_selector_messages
-        except Exception:
+
+# Kompaktowanie i retencja pamięci oraz logów
+
+def compact_memory(store, namespace, now):
+    """
+    Jeden przebieg dla magazynu: retencja (MEMORY_RETENTION_DAYS, pliki wyników L:>CMD),
+    potem archiwizacja starych plików .txt, kompresja starych segmentów i przepisanie
+    dziennika indeksu wyszukiwania.
+    """
+    before = now - COMPACT_AFTER_DAYS * 86400
+    for category in store.categories:
+        directory = os.path.join(store.root, category)
+        loose = []
+        for entry in os.scandir(directory) if os.path.isdir(directory) else []:
+            if entry.is_file() and entry.name.endswith(".txt"):
+                loose.append((entry.name, entry.path, entry.stat().st_mtime))
+
+        removed_files, removed_entries = [], []
+        spills = [item for item in loose if item[0].startswith(CMD_SPILL_PREFIX)]
+        loose = [item for item in loose if not item[0].startswith(CMD_SPILL_PREFIX)]
+        if CMD_SPILL_RETENTION_DAYS:
+            cutoff = now - CMD_SPILL_RETENTION_DAYS * 86400
+            for name, path, mtime in spills:
+                if mtime < cutoff:
+                    os.remove(path)
+                    removed_files.append(name)
+        days = MEMORY_RETENTION_DAYS.get(category)
+        if days:
+            cutoff = now - days * 86400
+            for name, path, mtime in [item for item in loose if item[2] < cutoff]:
+                os.remove(path)
+                removed_files.append(name)
+            loose = [item for item in loose if item[2] >= cutoff]
+            removed_files += store.archive.drop_before(category, cutoff)
+            removed_entries = store.drop_before(category, cutoff)
+        if removed_files or removed_entries:
+            index = get_search_index(namespace)
+            for name in removed_files:
+                index.remove(f"{store.prefix}/{category}/{name}")
+                load_cache.invalidate(f"{store.prefix}/{category}/{name}")
+            for name in removed_entries:
+                index.remove(f"{store.prefix}/{category}/{name}.txt")
+                load_cache.on_store_write(store.prefix, category, name)
+            metrics.inc("luna_retention_removed_total", len(removed_files) + len(removed_entries))
+            logging.info("Retencja: usunięto %d plików i %d wpisów z kategorii %s (%s).",
+                         len(removed_files), len(removed_entries), category, store.root)
+
+        saved = 0
+        old = [item for item in loose if item[2] < before]
+        if old:
+            saved += store.archive.add(category, old)
+            logging.info("Zarchiwizowano %d starych plików kategorii %s (%s).", len(old), category, store.root)
+        saved += store.compact(category, before)
+        if saved:
+            metrics.inc("luna_compaction_saved_bytes_total", saved)
+
+    # Rewrite the postings journal so removed documents don't linger in it
+    index = search_indexes.get(namespace)
+    if index is not None and index.dead_lines():
+        index.compact()
+
+def compact_logs(now, logs_dir=LOGS_DIR):
+    """Kompresuje logi z poprzednich uruchomień (.log -> .log.gz) i usuwa logi starsze niż LOG_RETENTION_DAYS."""
+    active = active_log_files()
+    removed = saved = 0
+    for entry in os.scandir(logs_dir) if os.path.isdir(logs_dir) else []:
+        if not entry.is_file() or os.path.abspath(entry.path) in active:
             continue
-    
-    logging.info("Nie znaleziono nowych wiadomości przy użyciu żadnego selektora.")
-    return []
+        mtime = entry.stat().st_mtime
+        if LOG_RETENTION_DAYS and mtime < now - LOG_RETENTION_DAYS * 86400:
+            os.remove(entry.path)
+            removed += 1
+        elif entry.name.endswith(".log"):
+            with open(entry.path, "rb") as src, gzip.open(entry.path + ".gz", "wb") as dst:
+                shutil.copyfileobj(src, dst)
+            os.utime(entry.path + ".gz", (mtime, mtime))  # retention keeps counting from the original date
+            saved += entry.stat().st_size - os.path.getsize(entry.path + ".gz")
+            os.remove(entry.path)
+    if removed:
+        metrics.inc("luna_retention_removed_total", removed)
+        logging.info("Retencja: usunięto %d starych plików logów.", removed)
+    if saved:
+        metrics.inc("luna_compaction_saved_bytes_total", saved)
+
+def run_compaction(now=None):
+    """Jeden przebieg kompaktowania i retencji dla otwartych magazynów pamięci i logów."""
+    now = now or time.time()
+    started = time.monotonic()
+    for namespace, store in open_memory_stores():
+        try:
+            compact_memory(store, namespace, now)
+        except Exception as e:
+            logging.exception("Błąd kompaktowania pamięci %s: %s", store.root, e)
+    try:
+        compact_logs(now)
+        compact_logs(now, TRACE_DIR) # Traces are gzipped already – only retention applies
+    except Exception as e:
+        logging.exception("Błąd kompaktowania logów: %s", e)
+    metrics.observe("luna_compaction_seconds", time.monotonic() - started)
+
+def start_compaction(interval=COMPACTION_INTERVAL, delay=COMPACTION_START_DELAY):
+    """Uruchamia kompaktowanie w tle (pierwszy przebieg po delay, potem co interval sekund). Zwraca Event zatrzymania."""
+    stop = threading.Event()
+    def loop():
+        wait = delay
+        while not stop.wait(wait):
+            run_compaction()
+            wait = interval
+    threading.Thread(target=loop, name="luna-compaction", daemon=True).start()
+    return stop
 
 
 # Funkcje przetwarzające komunikaty wg prefiksów:
 
 def process_LP(content):
     """L:>P – wiadomość do Promyka (zapisywane w 'wiadomosci_do_ciebie')."""
-    now = datetime.datetime.now().strftime("%Y-%m-%d-%H%M%S") # Added seconds for uniqueness
-    filename = os.path.join(MESSAGES_TO_ME_DIR, f"{now}.txt")
-    with open(filename, "w", encoding="utf-8") as f: # Changed to 'w' to avoid appending to same file if called rapidly
-        f.write(content + "\n" + "-" * 40 + "\n")
+    get_memory_store().append(os.path.basename(MESSAGES_TO_ME_DIR), content + "\n" + "-" * 40 + "\n")
     return "REQ:>STATUS - L:[notif] <_> L:>P Wiadomość wysłana do Promyka."
 
 def process_LL(content):
     """L:>L – rozmyślanie/refleksja (zapisywane w 'rozmyslania')."""
-    now = datetime.datetime.now().strftime("%Y-%m-%d-%H%M%S")
-    filename = os.path.join(MEMORY_DIR, f"{now}.txt")
-    with open(filename, "w", encoding="utf-8") as f:
-        f.write(content + "\n" + "=" * 40 + "\n")
+    get_memory_store().append(os.path.basename(MEMORY_DIR), content + "\n" + "=" * 40 + "\n")
     return "REQ:>STATUS - L:[notif] <_> L:>L Aktywne – Zapisane w pamięci."
 
 def process_pamietnik(content):
     """!PAMIETNIK! – wpis do pamiętnika (zapisywane w 'pamietniki')."""
-    now_date = datetime.datetime.now().strftime("%Y-%m-%d")
     now_time = datetime.datetime.now().strftime("%H%M%S")
-    # Append to daily file, but ensure unique entries if called multiple times
-    filename = os.path.join(PAMIECIANKA_DIR, f"{now_date}.txt") 
+    # Each entry is its own record; 'memory/pamietniki/YYYY-MM-DD.txt' still reads the whole day
     entry_header = f"\nWpis z {now_time}:\n"
-    with open(filename, "a", encoding="utf-8") as f:
-        f.write(entry_header + content + "\n" + "=" * 40 + "\n")
+    get_memory_store().append(os.path.basename(PAMIECIANKA_DIR), entry_header + content + "\n" + "=" * 40 + "\n")
     return "REQ:>STATUS - L:[notif] <_> !PAMIETNIK! Wiadomość zapisana w pamiętniku."
 
 def process_obrazek(content):
     """!OBRAZEK! – opis obrazu (zapisywane w 'obrazy')."""
-    now = datetime.datetime.now().strftime("%Y-%m-%d-%H%M%S")
-    filename = os.path.join(OBRAZY_DIR, f"{now}.txt")
-    with open(filename, "w", encoding="utf-8") as f:
-        f.write(content + "\n" + "=" * 40 + "\n")
+    get_memory_store().append(os.path.basename(OBRAZY_DIR), content + "\n" + "=" * 40 + "\n")
     return "REQ:>STATUS - L:[notif] <_> !OBRAZEK! prompt zapisany jako opis obrazu."
 
+def _kill_process(proc):
+    """Zabija proces komendy wraz z procesami potomnymi powłoki (tam, gdzie to możliwe)."""
+    try:
+        if os.name == "posix":
+            os.killpg(proc.pid, signal.SIGKILL)
+        else:
+            proc.kill()
+    except Exception:
+        proc.kill()
+    proc.wait()
+
+class CommandOutput:
+    """
+    Wynik komendy L:>CMD czytany strumieniowo przy stałym zużyciu pamięci:
+    pierwsze head_bytes bajtów, bufor pierścieniowy z ostatnimi tail_bytes bajtami
+    i – gdy wynik nie mieści się w odpowiedzi – pełna kopia w pliku w module 'akcje'.
+    """
+
+    def __init__(self, head_bytes=CMD_HEAD_BYTES, tail_bytes=CMD_TAIL_BYTES, max_bytes=CMD_MAX_OUTPUT_BYTES):
+        self.head_bytes = head_bytes
+        self.tail_bytes = tail_bytes
+        self.max_bytes = max_bytes
+        self.head = bytearray()
+        self.tail = bytearray()
+        self.total = 0
+        self.over_limit = False  # komenda wypisała więcej niż max_bytes
+        self.spill = None  # uchwyt pliku z pełnym wynikiem
+        self.spill_path = None
+        self.spill_failed = False
+
+    @property
+    def truncated(self):
+        return self.total > self.head_bytes + self.tail_bytes
+
+    def _open_spill(self):
+        try:
+            self._create_spill_file()
+        except OSError as e:
+            logging.error(f"Nie udało się zapisać pełnego wyniku L:>CMD: {e}")
+            self.spill_failed = True
+
+    def _create_spill_file(self):
+        directory = os.path.join(get_memory_store().root, os.path.basename(AKCJE_DIR))
+        os.makedirs(directory, exist_ok=True)
+        stamp = datetime.datetime.now().strftime("%Y-%m-%d-%H%M%S")
+        path = os.path.join(directory, f"{CMD_SPILL_PREFIX}{stamp}.txt")
+        suffix = 1
+        while True:
+            try:
+                # "x" creates atomically, so two commands spilling in the same second never share a file
+                self.spill = open(path, "xb")
+                break
+            except FileExistsError:
+                suffix += 1
+                path = os.path.join(directory, f"{CMD_SPILL_PREFIX}{stamp}-{suffix}.txt")
+        self.spill_path = os.path.normpath(path).replace(os.sep, "/")
+        # Everything read so far is still in head + tail
+        self.spill.write(self.head)
+        self.spill.write(self.tail)
+        metrics.inc("luna_cmd_spills_total")
+
+    def write(self, chunk):
+        if self.over_limit:
+            return
+        if len(chunk) > self.max_bytes - self.total:
+            chunk = chunk[:self.max_bytes - self.total]
+            self.over_limit = True
+        self.total += len(chunk)
+        if self.spill is not None:
+            self.spill.write(chunk)
+        room = self.head_bytes - len(self.head)
+        if room > 0:
+            self.head += chunk[:room]
+            chunk = chunk[room:]
+        self.tail += chunk
+        if len(self.tail) > self.tail_bytes:
+            # The tail buffer overflows: from now on the full output goes to a file
+            if self.spill is None and not self.spill_failed:
+                self._open_spill()
+            del self.tail[:-self.tail_bytes]
+
+    def close(self):
+        if self.spill is not None:
+            self.spill.close()
+            self.spill = None
+        metrics.inc("luna_cmd_output_bytes_total", self.total)
+
+    @staticmethod
+    def _decode(data):
+        return data.decode("utf-8", errors="replace").replace("\r\n", "\n")
+
+    def summary(self):
+        """Tekst do odpowiedzi: cały wynik albo początek, koniec i odnośnik %LOAD% do pełnej treści."""
+        if not self.truncated:
+            return self._decode(bytes(self.head + self.tail))
+        omitted = self.total - len(self.head) - len(self.tail)
+        text = (f"{self._decode(bytes(self.head))}\n"
+                f"[... pominięto {omitted} B z {self.total} B ...]\n"
+                f"{self._decode(bytes(self.tail))}")
+        if self.spill_path:
+            text += f"\n[Pełny wynik: %LOAD% {self.spill_path}]"
+        return text
+
+
+def command_limits(command):
+    """Zwraca (limit czasu, limit bajtów wyniku) dla komendy – CMD_LIMITS według pierwszego słowa."""
+    words = command.split()
+    program = os.path.basename(words[0]).lower() if words else ""
+    if program.endswith(".exe"):
+        program = program[:-4]
+    limits = CMD_LIMITS.get(program, {})
+    return limits.get("timeout", CMD_TIMEOUT), limits.get("max_bytes", CMD_MAX_OUTPUT_BYTES)
+
+
+def _pump_output(stream, output):
+    """Wątek czytający wynik komendy kawałkami (bez trzymania całości w pamięci)."""
+    try:
+        while True:
+            chunk = stream.read1(CMD_READ_CHUNK)
+            if not chunk:
+                break
+            output.write(chunk)
+    except (OSError, ValueError):
+        pass
+
+
 def process_CMD(content):
-    """L:>CMD – wykonanie komendy systemowej z użyciem subprocess."""
+    """
+    L:>CMD – wykonanie komendy systemowej z użyciem subprocess.
+    Wynik czytany jest strumieniowo (CommandOutput); długi wynik wraca jako początek i koniec
+    z odnośnikiem %LOAD% do pełnej treści. Komenda może zostać przerwana po przekroczeniu
+    limitu czasu lub rozmiaru wyniku (CMD_LIMITS) albo przez anulowanie zadania.
+    """
+    cancel_event = current_cancel_event()
+    timeout, max_bytes = command_limits(content)
+    output = CommandOutput(max_bytes=max_bytes)
+    started = time.monotonic()
+    outcome = "error"
     try:
         # Security consideration: shell=True can be dangerous if `content` is not trusted.
         # Consider alternatives if input source is not fully controlled.
-        result = subprocess.check_output(content, shell=True, stderr=subprocess.STDOUT, universal_newlines=True, timeout=30)
-    except subprocess.CalledProcessError as e:
-        result = f"Command failed with error code {e.returncode}:\n{e.output}"
-    except subprocess.TimeoutExpired:
-        result = "Command timed out after 30 seconds."
+        proc = subprocess.Popen(content, shell=True, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                                start_new_session=(os.name == "posix"))
+        reader = threading.Thread(target=_pump_output, args=(proc.stdout, output), name="luna-cmd-output", daemon=True)
+        reader.start()
+        deadline = started + timeout
+        while True:
+            reader.join(timeout=0.5)
+            if not reader.is_alive():
+                proc.wait()
+                break
+            if cancel_event is not None and cancel_event.is_set():
+                outcome = "cancelled"
+            elif time.monotonic() >= deadline:
+                outcome = "timeout"
+            elif output.over_limit:
+                outcome = "limit"
+            else:
+                continue
+            _kill_process(proc)
+            reader.join(timeout=1)
+            break
+        output.close()
+        if outcome == "cancelled":
+            metrics.observe("luna_subprocess_seconds", time.monotonic() - started, outcome=outcome)
+            return "ERR:>LOG <_> Error: L:>CMD anulowane."
+        if outcome == "timeout":
+            result = f"Command timed out after {timeout} seconds.\n{output.summary()}"
+        elif outcome == "limit":
+            result = f"Command output exceeded {max_bytes} bytes and was stopped.\n{output.summary()}"
+        elif proc.returncode:
+            result = f"Command failed with error code {proc.returncode}:\n{output.summary()}"
+            outcome = "failed"
+        else:
+            result = output.summary()
+            outcome = "ok"
     except Exception as e:
+        output.close()
         result = f"An unexpected error occurred: {str(e)}"
+    metrics.observe("luna_subprocess_seconds", time.monotonic() - started, outcome=outcome)
     return f"REQ:>STATUS - L:[notif] <_> L:>CMD wykonane: {result}"
 
 def process_LOAD(content):
-    """%LOAD% – wczytanie modułu pamięci."""
+    """
+    %LOAD% – wczytanie modułu pamięci. Długie moduły są dzielone na strony:
+    "%LOAD% ścieżka #N" zwraca stronę N (bez czytania stron wcześniejszych).
+    """
     file_to_load = content.strip()
+    page = 1
+    page_match = re.match(r"^(.*?)\s+#(\d+)$", file_to_load)
+    if page_match:
+        file_to_load, page = page_match.group(1), max(1, int(page_match.group(2)))
     # Basic path traversal protection
-    base_memory_path = os.path.abspath(os.path.join(os.getcwd(), "memory"))
+    # Each session may only load its own memory namespace
+    base_memory_path = os.path.abspath(os.path.join(os.getcwd(), get_memory_store().root))
     requested_path = os.path.abspath(os.path.join(os.getcwd(), file_to_load))
 
-    if not requested_path.startswith(base_memory_path) and not file_to_load.startswith(os.path.join("logs", "server_log")):
+    base_logs_path = os.path.abspath(os.path.join(os.getcwd(), LOGS_DIR))
+
+    in_memory = requested_path.startswith(base_memory_path + os.sep)
+    if not in_memory and not requested_path.startswith(base_logs_path + os.sep):
         logging.warning(f"Attempt to load file outside allowed directories: {file_to_load}")
         return "ERR:>LOG <_> Error: Dostęp zabroniony. Próba wczytania pliku spoza dozwolonych katalogów."
+    # Other namespaces live under the default memory root (memory/<namespace>/...): only categories are loadable
+    if in_memory and os.path.relpath(requested_path, base_memory_path).split(os.sep)[0] not in MEMORY_CATEGORIES:
+        logging.warning(f"Attempt to load file outside the session's memory categories: {file_to_load}")
+        return "ERR:>LOG <_> Error: Dostęp zabroniony. Moduł nie należy do pamięci tej sesji."
+
+    # Legacy files and logs are paged straight from disk, newer entries come from the memory store
+    try:
+        module = os.path.relpath(requested_path, os.getcwd()).replace(os.sep, "/")
+        loaded = load_module_page(module, requested_path, page)
+        if loaded is None:
+            return f"ERR:>LOG <_> Error: Plik {file_to_load} nie istnieje lub nie jest plikiem."
+        file_content, total_pages = loaded
+        if page > total_pages:
+            return f"ERR:>LOG <_> Error: Moduł {file_to_load} ma tylko {total_pages} stron."
+        if total_pages == 1:
+            return f"REQ:>STATUS - L:[notif] <_> %LOAD% – Wczytano moduł: {file_to_load}\nTreść:\n{file_content}"
+        response = f"REQ:>STATUS - L:[notif] <_> %LOAD% – Wczytano moduł: {file_to_load} (strona {page}/{total_pages})\nTreść:\n{file_content}"
+        if page < total_pages:
+            response += f"\n[Dalej: %LOAD% {file_to_load} #{page + 1}]"
+        return response
+    except Exception as e:
+        logging.error(f"Błąd podczas wczytywania pliku {file_to_load}: {e}")
+        return f"ERR:>LOG <_> Error: Nie udało się wczytać pliku {file_to_load}."
 
-    if os.path.exists(requested_path) and os.path.isfile(requested_path):
-        try:
-            with open(requested_path, "r", encoding="utf-8") as f:
-                file_content = f.read(MAX_CONTENT_LENGTH * 2) # Read a bit more to check if it's too long
-                if len(file_content) > MAX_CONTENT_LENGTH:
-                    return f"ERR:>LOG <_> Error: Zawartość pliku {file_to_load} jest zbyt długa do przesłania."
-            return f"REQ:>STATUS - L:[notif] <_> %LOAD% – Wczytano moduł: {file_to_load}\nTreść:\n{file_content[:MAX_CONTENT_LENGTH]}"
-        except Exception as e:
-            logging.error(f"Błąd podczas wczytywania pliku {file_to_load}: {e}")
-            return f"ERR:>LOG <_> Error: Nie udało się wczytać pliku {file_to_load}."
-    else:
-        return f"ERR:>LOG <_> Error: Plik {file_to_load} nie istnieje lub nie jest plikiem."
 
+def process_SZU(content):
+    """L:>SZU – wyszukiwanie w pamięci; zwraca ścieżki do %LOAD% z fragmentami tekstu."""
+    results = get_search_index().search(content)
+    if not results:
+        return f"REQ:>STATUS - L:[notif] <_> L:>SZU Brak wyników dla: {content}"
+    response = f"REQ:>STATUS - L:[notif] <_> L:>SZU Wyniki dla: {content}"
+    for i, (doc, score, terms) in enumerate(results, 1):
+        text = read_memory_document(doc)
+        entry = f"\n{i}. {doc} (trafność {score:.2f})\n   {make_snippet(text, terms) if text else ''}"
+        if len(response) + len(entry) > MAX_CONTENT_LENGTH:
+            break
+        response += entry
+    return response
 
 def process_wiadomosci(content):
     """L:>WIA – wiadomość zapisana w module 'wiadomosci'."""
-    now = datetime.datetime.now().strftime("%Y-%m-%d-%H%M%S")
-    filename = os.path.join(WIADOMOSCI_DIR, f"{now}.txt")
-    with open(filename, "w", encoding="utf-8") as f:
-        f.write(content + "\n" + "-" * 40 + "\n")
+    get_memory_store().append(os.path.basename(WIADOMOSCI_DIR), content + "\n" + "-" * 40 + "\n")
     return "REQ:>STATUS - L:[notif] <_> L:>WIA Wiadomość zapisana w module 'wiadomosci'."
 
 def process_akcje(content):
     """L:>AKC – dane zapisywane w module 'akcje'."""
-    now = datetime.datetime.now().strftime("%Y-%m-%d-%H%M%S")
-    filename = os.path.join(AKCJE_DIR, f"{now}.txt")
-    with open(filename, "w", encoding="utf-8") as f:
-        f.write(content + "\n" + "-" * 40 + "\n")
+    get_memory_store().append(os.path.basename(AKCJE_DIR), content + "\n" + "-" * 40 + "\n")
     return "REQ:>STATUS - L:[notif] <_> L:>AKC Dane zapisane w module 'akcje'."
 
+
 def process_incoming_message(message):
     """
-    Przetwarza odbieraną wiadomość na podstawie jej prefiksu.
+    Przetwarza odbieraną wiadomość: jedno polecenie (process_command) albo – gdy wiadomość
+    zawiera kilka poleceń, każde od nowej linii – całą partię z jedną zbiorczą odpowiedzią.
+    """
+    commands = split_commands(message)
+    if len(commands) > 1:
+        return process_batch(commands)
+    return process_command(message)
+
+def process_batch(commands):
+    """
+    Wykonuje polecenia z jednej wiadomości. Sąsiednie zapisy do pamięci (BATCH_PARALLEL_PREFIXES)
+    działają równolegle; pozostałe polecenia czekają na wszystkie wcześniejsze i wykonują się
+    po kolei. Każde polecenie zajmuje miejsce swojego prefiksu w CommandExecutor, więc partia
+    nie omija PREFIX_CONCURRENCY. Zwraca jedną odpowiedź ze statusem każdego polecenia (albo None).
+    """
+    cancel_event, namespace = current_cancel_event(), current_namespace()
+    cycle, job = getattr(job_context, "cycle", None), getattr(job_context, "job", None)
+    executor = getattr(job_context, "executor", None)
+    def run(command):
+        # Batch workers inherit the job's cancellation flag, memory namespace, executor and log correlation ids
+        job_context.cancel_event, job_context.namespace = cancel_event, namespace
+        job_context.cycle, job_context.job = cycle, job
+        job_context.executor = executor
+        prefix = detect_prefix(command)
+        try:
+            if executor is None:
+                return process_command(command)  # replay / direct call: no limits to respect
+            if not executor.acquire_slot(prefix, cancel_event):
+                return "ERR:>LOG <_> Error: Zadanie anulowane."
+            try:
+                return process_command(command)
+            finally:
+                executor.release_slot(prefix)
+        finally:
+            job_context.cancel_event = job_context.namespace = None
+            job_context.cycle = job_context.job = None
+            job_context.executor = None
+
+    responses = [None] * len(commands)
+    parallel = []
+    def flush():
+        if len(parallel) < 2 or executor is None:
+            for i in parallel:
+                responses[i] = run(commands[i])
+            parallel.clear()
+            return
+        pool = executor.batch_pool()
+        futures = [(i, pool.submit(run, commands[i])) for i in parallel]
+        for i, future in futures:
+            try:
+                responses[i] = future.result()
+            except Exception as e:
+                logging.exception("Błąd polecenia %d w partii: %s", i + 1, e)
+                responses[i] = f"ERR:>LOG <_> Error: {e}"
+        parallel.clear()
+
+    for i, command in enumerate(commands):
+        if detect_prefix(command) in BATCH_PARALLEL_PREFIXES:
+            parallel.append(i)
+            continue
+        flush()
+        if cancel_event is not None and cancel_event.is_set():
+            responses[i] = "ERR:>LOG <_> Error: Zadanie anulowane."
+        else:
+            responses[i] = run(command)
+    flush()
+
+    statuses = [(i, r) for i, r in enumerate(responses) if r]
+    if not statuses:
+        return None
+    status_prefix = "REQ:>STATUS - L:[notif] <_> "
+    lines = [f"{status_prefix}Partia {len(commands)} poleceń:"]
+    for i, response in statuses:
+        if response.startswith(status_prefix):
+            response = response[len(status_prefix):] # One status header for the whole batch
+        lines.append(f"[{i + 1}/{len(commands)}] {response}")
+    return "\n".join(lines)
+
+def process_command(message):
+    """
+    Przetwarza pojedyncze polecenie na podstawie jego prefiksu.
     Jeśli prefiks nie jest rozpoznany, zwraca komunikat błędu.
     """
     msg = message.strip()
@@ -345,6 +922,7 @@ def process_incoming_message(message):
             elif prefix == "%LOAD%": response = process_LOAD(content) # Content is the filename
             elif prefix == "L:>WIA": response = process_wiadomosci(content)
             elif prefix == "L:>AKC": response = process_akcje(content)
+            elif prefix == "L:>SZU": response = process_SZU(content)
             processed = True
             break
     
@@ -375,9 +953,16 @@ def split_long_text(text, max_length=MAX_CONTENT_LENGTH):
         parts.append(part_header + part_content)
     return parts
 
-def send_instruction_msg(driver_instance):
+def send_response(outbox, response_to_send):
+    """Kolejkuje odpowiedź handlera do wysłania (Outbox dzieli ją na części). None oznacza brak odpowiedzi."""
+    if not response_to_send: # Only send if process_incoming_message returns something
+        return
+    outbox.put(response_to_send)
+
+def send_instruction_msg(outbox):
     """
-    Wysyła do Luny instrukcję systemu (INSTRUCTION_MSG) z pełnym opisem zasad komunikacji.
+    Kolejkuje instrukcję systemu (INSTRUCTION_MSG) z pełnym opisem zasad komunikacji.
+    Części instrukcji wychodzą razem – nie przeplatają się z innymi wiadomościami.
     """
     instruction_message = (
         "#####INSTRUCTION_MSG(\n"
@@ -406,11 +991,13 @@ def send_instruction_msg(driver_instance):
         "    -> Przykład: \"!OBRAZEK! ... <3 pyk-pyk-pyk ...; opis sceny: ...\"\n\n"
         "L:>CMD - komenda systemowa\n"
         "    -> Serwer uruchamia ją jako subprocess (timeout 30s)\n"
+        "    -> Długi wynik: początek i koniec w odpowiedzi, pełna treść przez \"%LOAD% memory/akcje/cmd-....txt\"\n"
         "    -> Odpowiedź: REQ:>STATUS - L:[notif] <_> L:>CMD wykonane: {wynik}\n"
         "        lub: ERR:>LOG <_> Error:\n"
         "    -> Przykład: \"L:>CMD dir\"\n\n"
         "%LOAD% - wczytanie modułu pamięci (pliki z 'memory/' lub 'logs/server_log/')\n"
         "    -> Serwer odsyła komunikat o wczytaniu i treść pliku (do MAX_CONTENT_LENGTH)\n"
+        "    -> Długie pliki są dzielone na strony: \"%LOAD% ścieżka #N\" wczytuje stronę N\n"
         "    -> Przykład: \"%LOAD% memory/rozmyslania/YYYY-MM-DD-HHMMSS.txt\"\n\n"
         "L:>WIA - wiadomość zapisana w module 'wiadomosci'\n"
         "    -> Serwer zapisuje do: 'memory/wiadomosci/YYYY-MM-DD-HHMMSS.txt'\n"
@@ -418,122 +1005,780 @@ def send_instruction_msg(driver_instance):
         "L:>AKC - dane zapisywane w module 'akcje'\n"
         "    -> Serwer zapisuje do: 'memory/akcje/YYYY-MM-DD-HHMMSS.txt'\n"
         "    -> Odpowiedź: REQ:>STATUS - L:[notif] <_> L:>AKC Dane zapisane w module 'akcje'.\n\n"
+        "L:>SZU - wyszukiwanie w całej pamięci (rozmyślania, pamiętniki, wiadomości, akcje...)\n"
+        "    -> Serwer zwraca najtrafniejsze wpisy (ścieżki do %LOAD%) z fragmentami tekstu\n"
+        "    -> Wielkość liter i polskie znaki nie mają znaczenia; 'słow*' szuka po początku słowa\n"
+        "    -> Przykład: \"L:>SZU spacer nad jeziorem\"\n\n"
         "ERR:>LOG - komunikat o błędzie (przy niepoprawnych prefiksach lub odczycie)\n"
         "    -> Logi zapisywane są w: 'logs/server_log/YYYY-MM-DD-HHMM.log'\n\n"
         "L:[notif] - potwierdzenie serwera o rozpoznaniu prefiksu\n\n"
-        "REQ:>STATUS - instrukcja statusowa systemu\n"
+        "REQ:>STATUS - instrukcja statusowa systemu\n\n"
+        "Kilka poleceń w jednej wiadomości: każde zaczynaj od prefiksu na początku nowej linii.\n"
+        "    -> Serwer wykona je razem i odeśle jedną zbiorczą odpowiedź ([1/N] ..., [2/N] ...)\n"
         "#####INSTRUCTION_MSG_END"
     )
     
-    parts = split_long_text(instruction_message)
-    for i, part in enumerate(parts):
-        logging.info(f"Wysyłanie instrukcji - część {i+1}/{len(parts)}")
-        send_message(driver_instance, part)
-        if i < len(parts) - 1: # Add delay between parts if message is split
-            time.sleep(3) 
+    outbox.put(instruction_message, priority=OUTBOX_PRIORITY_INSTRUCTION, mergeable=False, label="instrukcja")
 
 
-def cycle_loop(driver_instance):
+class TraceRecorder:
     """
-    Główny cykl komunikacyjny:
-      - Co 30 sekund sprawdzamy, czy pojawiła się nowa wiadomość.
-      - Jeśli tak, przetwarzamy ją wg prefiksu i wysyłamy odpowiedź.
-      - Co 5 cykli odświeżamy stronę.
+    Zapis przebiegu sesji: JSON Lines w gzip (logs/traces/<sesja>-<czas>.trace.jsonl.gz).
+    Każde zdarzenie ma czas od początku zapisu ("t") i rodzaj ("ev"): start, turn (zaobserwowana
+    wiadomość), dispatch (przekazanie do wykonania, z treścią), result (odpowiedź handlera)
+    i send (wysłana część posta). Każde zdarzenie niesie nazwę sesji ("session"), a start także
+    jej przestrzeń nazw pamięci. Zapis odtwarza replay_trace().
     """
-    last_processed_messages = [] # Store a few last messages to better detect new ones
-    MAX_HISTORY = 5 
-    cycle_count = 0
-    refresh_cycle = 10 # Refresh every 10 * 30s = 5 minutes
-    
-    logging.info("Rozpoczynam cykliczne sprawdzanie wiadomości...")
-    while True:
-        time.sleep(30) # Check every 30 seconds
-        cycle_count += 1
 
+    def __init__(self, session, namespace=None, directory=TRACE_DIR):
+        os.makedirs(directory, exist_ok=True)
+        stamp = datetime.datetime.now().strftime("%Y-%m-%d-%H%M%S")
+        self.path = os.path.join(directory, f"{session}-{stamp}.trace.jsonl.gz")
+        self.session = session
+        self.lock = threading.Lock()
+        self.file = gzip.open(self.path, "at", encoding="utf-8")
+        self.started = self.last_flush = time.monotonic()
+        self.dirty = False  # czy są zdarzenia zapisane po ostatnim flush
+        self.record("start", namespace=namespace, version=TRACE_VERSION,
+                    wall=datetime.datetime.now().isoformat(timespec="milliseconds"))
+        logging.info("[%s] Zapis przebiegu sesji: %s", session, self.path)
+
+    def record(self, event, **fields):
+        now = time.monotonic()
+        line = json.dumps({"t": round(now - self.started, 4), "ev": event, "session": self.session, **fields},
+                          ensure_ascii=False, separators=(",", ":"))
+        with self.lock:
+            if self.file is None:
+                return
+            self.file.write(line + "\n")
+            self.dirty = True
+            self._flush_if_due(now)
+
+    def flush_if_due(self):
+        """
+        Wymusza zapis na dysk, jeśli od ostatniego minęło TRACE_FLUSH_INTERVAL – wywoływane
+        co cykl, żeby ostatnie zdarzenia przed ciszą w rozmowie nie czekały na kolejne.
+        """
+        with self.lock:
+            if self.file is not None:
+                self._flush_if_due(time.monotonic())
+
+    def _flush_if_due(self, now):
+        # Caller holds self.lock. A sync flush keeps the file readable up to here if the server dies
+        if self.dirty and now - self.last_flush >= TRACE_FLUSH_INTERVAL:
+            self.file.flush()
+            self.last_flush = now
+            self.dirty = False
+
+    def close(self):
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+
+
+class OutboxPost:
+    """Jedna pozycja kolejki wychodzącej: tekst podzielony na części (wysyłane razem, po kolei)."""
+
+    def __init__(self, seq, text, priority, mergeable, label):
+        self.seq = seq
+        self.text = text
+        self.priority = priority
+        self.mergeable = mergeable
+        self.label = label
+        self.parts = None  # ustalane przy wysyłce (po ewentualnym scaleniu)
+        self.sent_parts = 0
+        self.attempts = 0
+
+    def __lt__(self, other):
+        return (self.priority, self.seq) < (other.priority, other.seq)
+
+
+class Outbox:
+    """
+    Kolejka wiadomości wychodzących sesji (kolejka priorytetowa, FIFO w obrębie priorytetu):
+      • krótkie komunikaty statusu stojące obok siebie w kolejce są scalane w jeden post,
+      • posty są wysyłane w tempie pola wpisu (czekamy, aż Luna skończy odpowiadać),
+        a części długiego tekstu nigdy nie przeplatają się z innymi postami,
+      • nieudane wysłanie jest ponawiane; jeśli wiadomość mimo błędu dotarła, nie jest
+        wysyłana drugi raz, a post, którego nie udało się wysłać, zostaje na początku kolejki.
+    """
+
+    def __init__(self, transport, name="outbox", trace=None):
+        self.transport = transport
+        self.name = name
+        self.trace = trace  # TraceRecorder sesji (albo None)
+        self.lock = threading.Lock()
+        self.heap = []
+        self.seq = itertools.count()
+        self.current = None  # post odłożony w połowie przez flush(block=False) – wznawiany jako pierwszy
+
+    def put(self, text, priority=OUTBOX_PRIORITY_REPLY, mergeable=None, label="odpowiedź"):
+        """Dodaje wiadomość do kolejki. None/pusty tekst jest pomijany."""
+        if not text:
+            return
+        if mergeable is None:
+            mergeable = len(text) <= OUTBOX_MERGE_MAX_CHARS and text.startswith(OUTBOX_MERGEABLE_PREFIXES)
+        with self.lock:
+            heapq.heappush(self.heap, OutboxPost(next(self.seq), text, priority, mergeable, label))
+            metrics.set("luna_outbox_depth", len(self.heap), session=self.name)
+
+    def __len__(self):
+        with self.lock:
+            return len(self.heap) + (self.current is not None)
+
+    def _next_post(self):
+        # Caller holds self.lock. Adjacent short statuses are merged while they fit in one message.
+        post = heapq.heappop(self.heap)
+        if post.parts is not None or not post.mergeable:
+            return post
+        merged = 1
+        while self.heap and self.heap[0].mergeable and self.heap[0].parts is None \
+                and len(post.text) + 1 + len(self.heap[0].text) <= MAX_CONTENT_LENGTH:
+            post.text += "\n" + heapq.heappop(self.heap).text
+            merged += 1
+        if merged > 1:
+            metrics.inc("luna_outbox_merged_total", merged - 1, session=self.name)
+            logging.info("[%s] Scalono %d komunikatów w jeden post.", self.name, merged)
+        return post
+
+    def _deliver(self, text, paced, block=True):
+        # Without block, flush() has already checked that Luna is not answering
+        if block and paced:
+            self.transport.wait_idle() # Luna is answering the previous post
+        elif block:
+            self.transport.wait_ready()
+        mark = self.transport.delivery_mark()
+        for attempt in range(OUTBOX_RETRIES):
+            if self.transport.send(text):
+                return True
+            if self.transport.was_delivered(text, mark):
+                logging.warning("[%s] Wiadomość dotarła mimo błędu – bez ponownego wysyłania.", self.name)
+                return True
+            metrics.inc("luna_outbox_retries_total", session=self.name)
+            time.sleep(OUTBOX_RETRY_DELAY * 2 ** attempt)
+        return False
+
+    def flush(self, block=True):
+        """
+        Wysyła wszystkie posty z kolejki. Zwraca False, jeśli wysyłanie trzeba było przerwać.
+        Przy block=False (kilka sesji w jednej pętli) nie czeka, aż Luna skończy odpowiadać:
+        wysyła co najwyżej jedną część, a resztę zostawia na kolejny cykl.
+        """
+        paced = False
+        while True:
+            with self.lock:
+                if self.current is not None:
+                    post, self.current = self.current, None
+                elif self.heap:
+                    post = self._next_post()
+                else:
+                    break
+            if post.parts is None:
+                post.parts = split_long_text(post.text)
+            while post.sent_parts < len(post.parts):
+                if not block and (paced or self.transport.busy()):
+                    with self.lock:
+                        self.current = post # Resumed first: its parts never interleave with other posts
+                    break
+                part = post.parts[post.sent_parts]
+                logging.info("[%s] Wysyłanie: %s (część %d/%d): %s", self.name, post.label,
+                             post.sent_parts + 1, len(post.parts), LogBody(part))
+                delivered = self._deliver(part, paced, block)
+                if self.trace:
+                    self.trace.record("send", label=post.label, text=part, ok=delivered)
+                if not delivered:
+                    post.attempts += 1
+                    if post.attempts >= OUTBOX_MAX_ATTEMPTS:
+                        logging.error("[%s] Porzucam post (%s) po %d nieudanych próbach.", self.name, post.label, post.attempts)
+                    else:
+                        with self.lock:
+                            heapq.heappush(self.heap, post) # Same (priority, seq): stays at the head
+                    break
+                post.sent_parts += 1
+                paced = True
+            else:
+                continue
+            break
+        with self.lock:
+            metrics.set("luna_outbox_depth", len(self.heap) + (self.current is not None), session=self.name)
+            return not self.heap and self.current is None
+
+
+class HealthMonitor:
+    """
+    Harmonogram działań naprawczych sterowany sondami zdrowia:
+      • żywotność DOM (czy strona odpowiada i jest na adresie rozmowy),
+      • częstość błędów "stale element",
+      • dostępność pola wpisu,
+      • czy Luna nadal używa prefiksów protokołu.
+    Odświeżenie, ponowna nawigacja i ponowne wysłanie instrukcji dzieją się tylko wtedy,
+    gdy sondy tego wymagają, z wykładniczym odstępem między powtórzeniami tego samego
+    działania. Każda decyzja jest logowana wraz z powodem.
+    """
+
+    def __init__(self):
+        self.consecutive_errors = 0
+        self.unprefixed_streak = 0
+        self.last_probe = time.monotonic()
+        self.backoff = {}  # działanie -> (najwcześniejszy czas powtórzenia, aktualny odstęp)
+
+    def record_turn(self, prefixed):
+        """Odnotowuje wiadomość Luny – z prefiksem protokołu lub bez."""
+        self.unprefixed_streak = 0 if prefixed else self.unprefixed_streak + 1
+
+    def record_error(self, error):
+        self.consecutive_errors += 1
+
+    def record_success(self):
+        self.consecutive_errors = 0
+
+    def probe(self, transport):
+        """Uruchamia sondy i zwraca słownik z ich wynikami."""
+        result = transport.probe()
+        result.setdefault("stale_events", 0)  # counted per tab by SeleniumTransport
+        result["unprefixed_streak"] = self.unprefixed_streak
+        result["consecutive_errors"] = self.consecutive_errors
+        return result
+
+    def decide(self, probes):
+        """Zwraca (działanie, powód) albo (None, None), gdy wszystko jest w porządku."""
+        if not probes["dom_alive"]:
+            return "renavigate", "strona nie odpowiada"
+        if not probes["on_chat"]:
+            return "renavigate", "przeglądarka nie jest na stronie rozmowy"
+        if probes["consecutive_errors"] >= HEALTH_ERROR_LIMIT * 2:
+            return "renavigate", f"{probes['consecutive_errors']} kolejnych błędów cyklu"
+        if not probes["composer"]:
+            return "refresh", "brak pola wpisu"
+        if probes["stale_events"] >= STALE_EVENTS_LIMIT:
+            return "refresh", f"{probes['stale_events']} błędów stale element w ciągu {HEALTH_WINDOW} s"
+        if probes["consecutive_errors"] >= HEALTH_ERROR_LIMIT:
+            return "refresh", f"{probes['consecutive_errors']} kolejnych błędów cyklu"
+        if probes["unprefixed_streak"] >= PROTOCOL_DRIFT_TURNS:
+            return "resend_instruction", f"{probes['unprefixed_streak']} wiadomości Luny bez prefiksu"
+        return None, None
+
+    def _allowed(self, action, now):
+        next_allowed, _ = self.backoff.get(action, (0, 0))
+        return now >= next_allowed
+
+    def _register(self, action, now):
+        _, delay = self.backoff.get(action, (0, 0))
+        delay = min(max(delay * 2, HEALTH_BACKOFF_MIN), HEALTH_BACKOFF_MAX)
+        self.backoff[action] = (now + delay, delay)
+
+    def run(self, transport, outbox):
+        """
+        Co HEALTH_CHECK_INTERVAL (albo od razu po błędzie cyklu) uruchamia sondy i w razie
+        potrzeby wykonuje działanie naprawcze. Zwraca nazwę wykonanego działania albo None.
+        """
+        now = time.monotonic()
+        if now - self.last_probe < HEALTH_CHECK_INTERVAL and not self.consecutive_errors \
+                and self.unprefixed_streak < PROTOCOL_DRIFT_TURNS:
+            return None
+        self.last_probe = now
+        probes = self.probe(transport)
+        action, reason = self.decide(probes)
+        if action is None:
+            if self.backoff:
+                logging.info("Sondy zdrowia w normie – reset odstępów działań naprawczych.")
+            self.backoff.clear()
+            return None
+        if not self._allowed(action, now):
+            logging.info("Decyzja harmonogramu: %s odroczone (odstęp) – powód: %s; sondy: %s", action, reason, probes)
+            return None
+        logging.warning("Decyzja harmonogramu: %s – powód: %s; sondy: %s", action, reason, probes)
+        metrics.inc("luna_recovery_actions_total", action=action)
+        self._register(action, now)
+        try:
+            if action in ("renavigate", "refresh"):
+                transport.recover(action)
+            elif action == "resend_instruction":
+                send_instruction_msg(outbox) # Queued behind pending replies – never interleaved with them
+                self.unprefixed_streak = 0
+            self.consecutive_errors = 0
+        except Exception as e:
+            logging.exception("Działanie naprawcze %s nie powiodło się: %s", action, e)
+        return action
+
+
+class ChatSession:
+    """
+    Jedna obsługiwana rozmowa z własnym stanem: transportem (karta przeglądarki albo
+    połączenie HTTP), kursorem, trwałą historią przetworzonych wiadomości, przestrzenią
+    nazw pamięci, kolejką zadań (CommandExecutor) i harmonogramem naprawczym (HealthMonitor).
+    """
+
+    def __init__(self, name, transport, namespace=None, pool=None):
+        self.name = name
+        self.transport = transport
+        self.namespace = namespace
+        _, state_dir = namespace_paths(namespace)
+        os.makedirs(state_dir, exist_ok=True)
+        self.seen = SeenIndex(os.path.join(state_dir, os.path.basename(SEEN_INDEX_FILE)))
+        self.dispatches = DispatchJournal(os.path.join(state_dir, os.path.basename(DISPATCH_JOURNAL_FILE)))
+        self.job_keys = {}  # numer zadania -> klucz wiadomości w dzienniku przekazań
+        self.checkpoint_path = os.path.join(state_dir, os.path.basename(CHECKPOINT_FILE))
+        self.cursor = self._restore_cursor()
+        self.executor = CommandExecutor(process_incoming_message, pool=pool, namespace=namespace)
+        self.monitor = HealthMonitor()
+        self.trace = TraceRecorder(name, namespace) if TRACE_ENABLED else None
+        self.outbox = Outbox(transport, name, self.trace)
+        self.cycle_count = 0
+        self.shared_loop = False  # kilka sesji w jednej pętli: wysyłka nie może czekać na odpowiedź Luny
+
+    def _restore_cursor(self):
+        """Kursor z poprzedniego uruchomienia (jeśli dotyczy tej samej rozmowy) albo nowy."""
+        if not self.transport.resumable or not os.path.exists(self.checkpoint_path):
+            return new_scrape_cursor()
+        try:
+            with open(self.checkpoint_path, "r", encoding="utf-8") as f:
+                checkpoint = json.load(f)
+            if checkpoint.get("url") == self.transport.url:
+                logging.info("[%s] Wznowiono kursor z %s: %s", self.name, checkpoint.get("saved"), checkpoint["cursor"])
+                return checkpoint["cursor"]
+        except (OSError, ValueError, KeyError) as e:
+            logging.warning("[%s] Nieczytelny punkt kontrolny %s: %s", self.name, self.checkpoint_path, e)
+        return new_scrape_cursor()
+
+    def save_checkpoint(self):
+        """Zapisuje kursor atomowo (plik tymczasowy + os.replace)."""
+        checkpoint = {
+            "url": self.transport.url,
+            "cursor": self.cursor,
+            "saved": datetime.datetime.now().isoformat(timespec="seconds"),
+        }
+        tmp_path = self.checkpoint_path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(checkpoint, f)
+        os.replace(tmp_path, self.checkpoint_path)
+
+    def open(self, claimed):
+        """Otwiera transport rozmowy i przygotowuje pamięć sesji."""
+        self.transport.open(claimed)
+        logging.info("[%s] Sesja gotowa (transport: %s).", self.name, self.transport.name)
+        get_search_index(self.namespace) # Open the memory store and catch up the search index before the first query
+        self.resume_unfinished()
+
+    def resume_unfinished(self):
+        """Ponownie przekazuje do wykonania wiadomości, których poprzednie uruchomienie nie dokończyło."""
+        for key, text in self.dispatches.unfinished():
+            self.seen.add(key) # The crash may have come before the turn was marked as seen
+            job = self.executor.submit(text)
+            self.job_keys[job.id] = key
+            logging.warning("[%s] Ponownie wykonuję niedokończoną wiadomość (zadanie #%d): %s",
+                            self.name, job.id, LogBody(text))
+
+    def greet(self):
+        """Wysyła powitanie i instrukcję protokołu – chyba że instrukcja jest nadal w rozmowie."""
+        if self.transport.instruction_in_context():
+            logging.info("[%s] Instrukcja jest nadal w ostatnich wiadomościach – pomijam powitanie i instrukcję.", self.name)
+            return
+        initial_greeting = "Cześć Luna! Serwer Promyka jest online i gotowy do komunikacji. Wysyłam instrukcje..."
+        self.outbox.put(initial_greeting, mergeable=False, label="powitanie")
+        send_instruction_msg(self.outbox)
+        self.outbox.flush() # Each post waits until Luna has answered the previous one
+
+    def wait_for_activity(self, blocking=True):
+        """
+        Sprawdza, czy w rozmowie pojawiła się nowa wiadomość. W trybie blokującym czeka
+        (do POLL_INTERVAL), w nieblokującym tylko sprawdza stan.
+        """
+        if not blocking:
+            return self.transport.wait_for_activity(0)
+        if not self.executor.pending():
+            with metrics.timer("luna_wait_seconds", session=self.name):
+                return self.transport.wait_for_activity(POLL_INTERVAL)
+        # While commands run in the background, a finished job (results_ready) ends the wait at once
+        ready = self.executor.results_ready
+        if ready.is_set():
+            return self.transport.wait_for_activity(0)
+        with metrics.timer("luna_wait_seconds", session=self.name):
+            return self.transport.wait_for_activity(PENDING_POLL_INTERVAL, ready)
+
+    def step(self, page_changed):
+        """Jeden cykl: pobranie nowych wiadomości, przekazanie ich do wykonania, wysłanie gotowych odpowiedzi."""
+        self.cycle_count += 1
+        cycle_count = self.cycle_count
+        job_context.cycle = f"{self.name}-{cycle_count}"  # correlation id of every log record of this cycle
+        transport, seen, executor, monitor = self.transport, self.seen, self.executor, self.monitor
+        started = time.perf_counter()
         try:
-            current_page_messages = get_response_messages(driver_instance)
+            # In event-driven mode an idle wait means nothing new landed – skip the scrape
+            new_turns = []
+            previous_cursor = self.cursor
+            if page_changed:
+                new_turns, self.cursor = transport.new_turns(self.cursor)
+                metrics.inc("luna_turns_total", len(new_turns), session=self.name)
             
-            new_message_to_process = None
-            if current_page_messages:
-                # Check if the latest message on the page is truly new
-                # by comparing against a short history of processed messages
-                latest_on_page = current_page_messages[-1]
-                if latest_on_page not in last_processed_messages:
-                    new_message_to_process = latest_on_page
+            if new_turns and not seen.existed and len(seen) == 0:
+                # First run without any saved state: treat the existing conversation as
+                # history and only handle the latest turn (the old "latest message" behaviour)
+                for turn in new_turns[:-1]:
+                    seen.add(turn_key(turn))
+                seen.existed = True
+
+            # Every unprocessed turn is queued, in conversation order
+            incoming = deque(turn for turn in new_turns if turn_key(turn) not in seen)
+            if self.trace:
+                for turn in new_turns:
+                    self.trace.record("turn", cycle=cycle_count, key=turn_key(turn), new=turn in incoming,
+                                      chars=len(turn["text"]))
             
-            if new_message_to_process:
-                logging.info("Cykl %d: Wykryto nową wiadomość:\n%s", cycle_count, new_message_to_process[:200] + "...") # Log snippet
-                
-                response_to_send = process_incoming_message(new_message_to_process)
+            # Replies that are already done go out before acknowledgements of the turns below
+            executor.check_deadlines()
+            self.post_ready(cycle_count)
+            if not incoming and page_changed:
+                logging.info("[%s] Cykl %d: Brak nowych, nieprzetworzonych wiadomości.", self.name, cycle_count)
+            while incoming:
+                turn = incoming.popleft()
+                new_message_to_process = turn["text"]
+                logging.info("[%s] Cykl %d: Wykryto nową wiadomość: %s", self.name, cycle_count, LogBody(new_message_to_process))
+                # Journal the dispatch before marking the turn as seen: a crash before the reply
+                # is queued re-runs the turn on restart (resume_unfinished) instead of dropping it
+                key = turn_key(turn)
+                self.dispatches.dispatched(key, new_message_to_process)
+                seen.add(key)
+                monitor.record_turn(detect_prefix(new_message_to_process) is not None)
                 
-                if response_to_send: # Only send if process_incoming_message returns something
-                    parts = split_long_text(response_to_send)
-                    for i, part in enumerate(parts):
-                        logging.info(f"Wysyłanie odpowiedzi (część {i+1}/{len(parts)}):\n{part[:200]}...")
-                        send_message(driver_instance, part)
-                        if i < len(parts) - 1:
-                            time.sleep(3) # Delay between parts
-                
-                # Update history of processed messages
-                last_processed_messages.append(new_message_to_process)
-                if len(last_processed_messages) > MAX_HISTORY:
-                    last_processed_messages.pop(0) # Keep history size limited
-            else:
-                logging.info("Cykl %d: Brak nowych, nieprzetworzonych wiadomości.", cycle_count)
+                # Handlers run in the worker pool; results are posted below, in message order
+                job = executor.submit(new_message_to_process)
+                self.job_keys[job.id] = key
+                if self.trace:
+                    self.trace.record("dispatch", cycle=cycle_count, job=job.id, key=key,
+                                      prefixes=job.prefixes, text=new_message_to_process)
+                if any(prefix in ACK_PREFIXES for prefix in job.prefixes):
+                    self.outbox.put(f"REQ:>STATUS - L:[notif] <_> {job.prefix} przyjęte do wykonania (zadanie #{job.id}).",
+                                    priority=OUTBOX_PRIORITY_ACK, label="potwierdzenie")
+            if self.cursor != previous_cursor and transport.resumable:
+                self.save_checkpoint() # After the seen journal: a restart never skips an unhandled turn
+
+            self.post_ready(cycle_count)
+            metrics.set("luna_queue_depth", executor.pending(), session=self.name)
+            monitor.record_success()
 
         except Exception as e:
-            logging.exception(f"Błąd w cyklu {cycle_count}: {e}")
-            # Attempt to recover by refreshing or re-navigating
-            try:
-                logging.info("Próba odświeżenia strony po błędzie...")
-                driver_instance.refresh()
-                time.sleep(10)
-                # Potentially re-send instruction message if context is lost
-                # send_instruction_msg(driver_instance) 
-            except Exception as refresh_error:
-                logging.error(f"Nie udało się odświeżyć strony po błędzie: {refresh_error}")
-                # Consider more drastic recovery or exit
-
-        if cycle_count % refresh_cycle == 0:
+            logging.exception(f"[{self.name}] Błąd w cyklu {cycle_count}: {e}")
+            # Recovery (refresh / re-navigation) is decided by the health probes below
+            monitor.record_error(e)
+
+        monitor.run(transport, self.outbox)
+        try:
+            # Acknowledgements, replies and instruction resends, in order, paced by the composer
+            self.outbox.flush(block=not self.shared_loop)
+        except Exception as e:
+            logging.exception(f"[{self.name}] Błąd wysyłania z kolejki: {e}")
+            monitor.record_error(e)
+        if self.trace:
+            self.trace.flush_if_due()
+        metrics.observe("luna_cycle_seconds", time.perf_counter() - started, session=self.name)
+        job_context.cycle = None
+
+    def post_ready(self, cycle_count):
+        """Przekazuje do kolejki wysyłki gotowe odpowiedzi (w kolejności wiadomości)."""
+        for job in self.executor.pop_ready():
+            if self.trace:
+                self.trace.record("result", cycle=cycle_count, job=job.id, response=job.response,
+                                  ms=round((job.finished - job.started) * 1000, 2) if job.started and job.finished else None)
+            send_response(self.outbox, job.response)
+            if job.id in self.job_keys:
+                self.dispatches.finished(self.job_keys.pop(job.id))
+
+    def close(self):
+        self.executor.shutdown()
+        self.seen.close()
+        self.dispatches.close()
+        if self.trace:
+            self.trace.close()
+        self.transport.close()
+
+
+def load_session_configs(path=SESSIONS_FILE):
+    """
+    Wczytuje listę rozmów z pliku JSON: [{"name": ..., "url": ..., "namespace": ...,
+    "transport": "selenium" | "http", "api": "openai" | "vercel", "model": ...}, ...].
+    Bez pliku obsługiwana jest jedna rozmowa CHAT_URL (albo HTTP_URL) w domyślnej przestrzeni nazw.
+    Sesja "default" korzysta z domyślnej pamięci, pozostałe domyślnie z memory/<name>.
+    """
+    if not os.path.exists(path):
+        return [{"name": "default", "transport": TRANSPORT, "namespace": None}]
+    with open(path, "r", encoding="utf-8") as f:
+        configs = json.load(f)
+    for config in configs:
+        config.setdefault("transport", TRANSPORT)
+        config.setdefault("namespace", None if config["name"] == "default" else config["name"])
+    return configs
+
+
+class SessionManager:
+    """
+    Obsługuje wiele rozmów z jednego procesu: każda rozmowa ma własną sesję (ChatSession),
+    a wszystkie sesje dzielą jedną pętlę i jedną pulę wątków dla handlerów. Sesje Selenium
+    dzielą jedną przeglądarkę (Chrome na porcie 9222) – każda w osobnej karcie.
+    """
+
+    def __init__(self, configs, driver_instance=None):
+        self.pool = ThreadPoolExecutor(max_workers=max(WORKER_THREADS, 2 * len(configs)), thread_name_prefix="luna-cmd")
+        self.sessions = [
+            ChatSession(config["name"], make_transport(config, driver_instance), config["namespace"], pool=self.pool)
+            for config in configs
+        ]
+        for session in self.sessions:
+            # One session waiting for Luna's answer must not stall the others (and their shared browser)
+            session.shared_loop = len(self.sessions) > 1
+        self.active = None
+
+    def activate(self, session):
+        """Przełącza wspólny zasób (np. kartę przeglądarki) na sesję – tylko gdy to konieczne."""
+        if session is not self.active:
+            session.transport.activate()
+            self.active = session
+
+    def start(self):
+        """Otwiera transporty sesji i wysyła w każdej powitanie z instrukcją."""
+        claimed = set()
+        for session in self.sessions:
+            session.open(claimed)
+            self.active = session
+        for session in self.sessions:
+            self.activate(session)
+            session.greet()
+
+    def run(self):
+        """
+        Główna pętla. Przy jednej sesji czeka na jej zdarzenia (cycle_loop);
+        przy wielu co MULTI_SESSION_TICK odwiedza kolejno wszystkie sesje.
+        """
+        if len(self.sessions) == 1:
+            cycle_loop(self.sessions[0])
+            return
+        logging.info("Rozpoczynam obsługę %d rozmów...", len(self.sessions))
+        while True:
+            for session in self.sessions:
+                try:
+                    self.activate(session)
+                    page_changed = session.wait_for_activity(blocking=False)
+                except Exception as e:
+                    logging.exception("[%s] Nie udało się sprawdzić rozmowy: %s", session.name, e)
+                    page_changed = False
+                session.step(page_changed)
+            time.sleep(MULTI_SESSION_TICK)
+
+    def shutdown(self):
+        for session in self.sessions:
+            session.close()
+        self.pool.shutdown(wait=False)
+
+
+def cycle_loop(session):
+    """
+    Główny cykl komunikacyjny (jedna rozmowa):
+      - Czekamy na nową wiadomość: w trybie zdarzeniowym budzi nas obserwator DOM
+        (EVENT_DRIVEN_MODE), w przeciwnym razie sprawdzamy stronę co POLL_INTERVAL sekund.
+      - Jeśli pojawiła się nowa wiadomość, przekazujemy ją do puli wątków (CommandExecutor),
+        a gotowe odpowiedzi wysyłamy w kolejności wiadomości – pętla nie czeka na handlery.
+      - HealthMonitor sprawdza stan rozmowy i tylko w razie potrzeby odświeża stronę,
+        nawiguje ponownie lub ponawia instrukcję.
+    """
+    logging.info("Rozpoczynam cykliczne sprawdzanie wiadomości...")
+    while True:
+        page_changed = session.wait_for_activity(blocking=True)
+        session.step(page_changed)
+
+
+# Odtwarzanie zapisu sesji (python server.py --replay ...)
+
+# Timestamps (with the -N suffix of entries written within one second) and job numbers
+_VOLATILE_RE = re.compile(r"\d{4}-\d{2}-\d{2}[-T ]?\d{2}:?\d{2}:?\d{2}(?:-\d+)?|#\d+")
+
+def normalize_response(text):
+    """Odpowiedź bez elementów zmiennych między przebiegami (znaczniki czasu, numery zadań) – do porównań."""
+    return _VOLATILE_RE.sub("#", text) if text else text
+
+def read_trace(path):
+    """Iteruje po zdarzeniach zapisu; zapis urwany przez awarię jest czytany do ostatniego całego zdarzenia."""
+    opener = gzip.open if path.endswith(".gz") else open
+    with opener(path, "rt", encoding="utf-8") as f:
+        try:
+            for line in f:
+                try:
+                    yield json.loads(line)
+                except ValueError:
+                    return  # torn last line
+        except (EOFError, OSError, zlib.error):
+            return  # compressed stream cut short
+
+def load_trace_dispatches(path):
+    """
+    Czyta zapis jednej sesji. Zwraca (przekazania, oczekiwane odpowiedzi): przekazania mają dodane
+    pola "session", "namespace" i "at" (czas bezwzględny), odpowiedzi są kluczowane (sesja, zadanie).
+    """
+    events = list(read_trace(path))
+    start = next((event for event in events if event["ev"] == "start"), {})
+    session = start.get("session", os.path.basename(path).split(".")[0])
+    # Version 1 traces have no namespace: the session default of load_session_configs
+    namespace = start.get("namespace", None if session == "default" else session)
+    try:
+        origin = datetime.datetime.fromisoformat(start["wall"]).timestamp()
+    except (KeyError, ValueError):
+        origin = 0.0
+    expected = {(session, event["job"]): event.get("response") for event in events if event["ev"] == "result"}
+    dispatches = [
+        {**event, "session": event.get("session", session), "namespace": namespace, "at": origin + event["t"]}
+        for event in events if event["ev"] == "dispatch"
+    ]
+    return dispatches, expected
+
+def replay_trace(paths, speed=0.0, allow_cmd=False, output=None):
+    """
+    Odtwarza zapis sesji (albo kilku sesji – lista plików): każdą przekazaną do wykonania
+    wiadomość podaje po kolei do process_incoming_message w przestrzeni nazw pamięci jej sesji
+    (w bieżącym katalogu roboczym – przy --replay jest to katalog tymczasowy z pustą pamięcią)
+    i porównuje odpowiedź z zapisaną. Wiadomości kilku sesji są przeplatane wg czasu zapisu.
+    speed=0 – bez czekania; inaczej odstępy między wiadomościami są skracane speed razy.
+    L:>CMD jest pomijane, chyba że allow_cmd. Zwraca podsumowanie (słownik).
+    """
+    paths = [paths] if isinstance(paths, str) else list(paths)
+    dispatches, expected = [], {}
+    for path in paths:
+        trace_dispatches, trace_expected = load_trace_dispatches(path)
+        dispatches.extend(trace_dispatches)
+        expected.update(trace_expected)
+    dispatches.sort(key=lambda event: event["at"])
+    out = open(output, "w", encoding="utf-8") if output else None
+    latencies = []
+    skipped = compared = matched = 0
+    first = dispatches[0]["at"] if dispatches else 0.0
+    started = time.monotonic()
+    try:
+        for event in dispatches:
+            if speed:
+                delay = (event["at"] - first) / speed - (time.monotonic() - started)
+                if delay > 0:
+                    time.sleep(delay)
+            if not allow_cmd and "L:>CMD" in event.get("prefixes", []):
+                skipped += 1
+                continue
+            handler_started = time.perf_counter()
+            job_context.namespace = event["namespace"] # The session's own memory, as in CommandExecutor._run
             try:
-                logging.info("Planowe odświeżenie strony po %d cyklach.", cycle_count)
-                driver_instance.refresh()
-                time.sleep(10) # Wait for page to load
-                # Re-send instruction message after refresh to ensure context
-                logging.info("Wysyłanie instrukcji po odświeżeniu strony.")
-                send_instruction_msg(driver_instance)
-                last_processed_messages = [] # Clear history after refresh
+                response = process_incoming_message(event["text"])
             except Exception as e:
-                logging.exception("Błąd przy planowym odświeżaniu strony: %s", e)
+                response = f"ERR:>LOG <_> Error: {e}"
+            finally:
+                job_context.namespace = None
+            latencies.append((time.perf_counter() - handler_started) * 1000)
+            key = (event["session"], event["job"])
+            match = None
+            if key in expected:
+                compared += 1
+                match = normalize_response(response) == normalize_response(expected[key])
+                matched += match
+            if out:
+                out.write(json.dumps({"session": event["session"], "job": event["job"], "prefixes": event.get("prefixes"),
+                                      "ms": round(latencies[-1], 3), "match": match, "expected": expected.get(key),
+                                      "actual": response}, ensure_ascii=False) + "\n")
+    finally:
+        if out:
+            out.close()
+    elapsed = time.monotonic() - started
+    recorded = dispatches[-1]["at"] - first if dispatches else 0.0
+    latencies.sort()
+    return {
+        "traces": paths,
+        "sessions": sorted({event["session"] for event in dispatches}),
+        "messages": len(dispatches),
+        "replayed": len(latencies),
+        "skipped_cmd": skipped,
+        "compared": compared,
+        "matched": matched,
+        "mismatched": compared - matched,
+        "seconds": round(elapsed, 3),
+        "recorded_seconds": round(recorded, 3),
+        "speedup": round(recorded / elapsed, 1) if elapsed > 0 else None,
+        "handler_ms": {
+            "p50": round(latencies[len(latencies) // 2], 3),
+            "p95": round(latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))], 3),
+            "max": round(latencies[-1], 3),
+        } if latencies else {},
+    }
 
 
 def server_loop():
     global driver # Ensure we're using the global driver variable
+    global session_manager
+    metrics_server = snapshot_stop = compaction_stop = None
     try:
-        driver = setup_driver() # Initialize or connect to Chrome
-        if driver is None:
-            logging.critical("Nie udało się zainicjować sterownika Chrome. Zamykanie.")
-            return
+        if METRICS_ENABLED:
+            metrics_server = start_metrics_server()
+            if METRICS_SNAPSHOT_INTERVAL:
+                snapshot_stop = start_metrics_snapshots()
+        if COMPACTION_INTERVAL:
+            compaction_stop = start_compaction()
+        configs = load_session_configs()
+        if any(config["transport"] == "selenium" for config in configs):
+            driver = setup_driver() # Initialize or connect to Chrome
+            if driver is None:
+                logging.critical("Nie udało się zainicjować sterownika Chrome. Zamykanie.")
+                return
+            logging.info("[LUNAFREYA] Połączono z sesją Chrome.")
 
-        logging.info("[LUNAFREYA] Połączono z sesją Chrome.")
-        navigate_to_chat(driver)
-
-        # Send initial messages
-        initial_greeting = "Cześć Luna! Serwer Promyka jest online i gotowy do komunikacji. Wysyłam instrukcje..."
-        send_message(driver, initial_greeting)
-        time.sleep(3) # Wait a bit before sending the long instruction
-        send_instruction_msg(driver)
-        
-        cycle_loop(driver)
+        # One process for every configured conversation, each with its own session
+        session_manager = SessionManager(configs, driver)
+        session_manager.start() # Open transports, send greetings and instructions
+        session_manager.run()
 
     except Exception as e:
         logging.exception("Krytyczny błąd w server_loop(): %s", e)
     finally:
+        if session_manager:
+            session_manager.shutdown()
+        if snapshot_stop:
+            snapshot_stop.set()
+        if compaction_stop:
+            compaction_stop.set()
+        if metrics_server:
+            metrics_server.shutdown()
+        for store in list(memory_stores.values()):
+            store.close()
         if driver:
             logging.info("Zamykanie sterownika Chrome.")
             driver.quit()
 
+def parse_args():
+    parser = argparse.ArgumentParser(description="Serwer Lunafreya – pętla czatu albo odtworzenie zapisu sesji.")
+    parser.add_argument("--replay", metavar="PLIK", nargs="+",
+                        help="odtwórz zapis sesji (logs/traces/*.trace.jsonl.gz; kilka plików – kilka sesji) zamiast łączyć się z czatem")
+    parser.add_argument("--workdir", help="katalog roboczy odtwarzania (memory/, state/, logs/); domyślnie nowy katalog tymczasowy")
+    parser.add_argument("--speed", type=float, default=0, help="przyspieszenie względem zapisu, np. 1000 (0 = jak najszybciej)")
+    parser.add_argument("--allow-cmd", action="store_true", help="wykonuj także L:>CMD (domyślnie pomijane)")
+    parser.add_argument("--output", help="plik JSONL z odpowiedziami oczekiwanymi i otrzymanymi")
+    return parser.parse_args()
+
+def run_replay(args):
+    """Odtwarza zapis w osobnym katalogu roboczym, żeby nie dotknąć prawdziwej pamięci."""
+    traces = [os.path.abspath(path) for path in args.replay]
+    output = os.path.abspath(args.output) if args.output else None
+    workdir = args.workdir or tempfile.mkdtemp(prefix="luna-replay-")
+    os.makedirs(workdir, exist_ok=True)
+    os.chdir(workdir) # All memory/state/log paths are relative to the working directory
+    logging.basicConfig(level=logging.WARNING, format=LOG_TEXT_FORMAT, datefmt=LOG_DATE_FORMAT)
+    ensure_directories()
+    try:
+        summary = replay_trace(traces, speed=args.speed, allow_cmd=args.allow_cmd, output=output)
+    finally:
+        for store in list(memory_stores.values()):
+            store.close()
+    summary["workdir"] = workdir
+    print(json.dumps(summary, ensure_ascii=False, indent=2))
+
 if __name__ == "__main__":
+    args = parse_args()
+    if args.replay:
+        run_replay(args)
+        raise SystemExit(0)
+
     ensure_directories() # Create necessary directories first
     setup_logging()      # Then set up logging
     
@@ -548,4 +1793,4 @@ if __name__ == "__main__":
     except Exception as e:
         logging.warning(f"Nie można automatycznie sprawdzić statusu Chrome: {e}")
 
-    server_loop()
+    server_loop()
\ No newline at end of file
@@ -0,0 +1,26 @@
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+import luna_storage
+import server
+
+
+@pytest.fixture
+def workdir(tmp_path, monkeypatch):
+    """Pusty katalog roboczy – server.py używa względnych ścieżek memory/, state/ i logs/."""
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(server, "TRACE_ENABLED", False)
+    yield tmp_path
+    for index in list(luna_storage.search_indexes.values()):
+        index.close()
+    luna_storage.search_indexes.clear()
+    for store in list(luna_storage.memory_stores.values()):
+        store.close()
+    luna_storage.memory_stores.clear()
+    luna_storage.memory_store = None
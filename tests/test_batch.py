@@ -0,0 +1,44 @@
+import threading
+import time
+
+import luna_executor
+import server
+
+
+def test_split_commands_on_mixed_prefixes():
+    message = "L:>P notatka\n  dalszy ciąg\nL:>CMD dir\n!PAMIETNIK! dzień\nL:>P druga"
+    assert luna_executor.split_commands(message) == ["L:>P notatka\n  dalszy ciąg", "L:>CMD dir", "!PAMIETNIK! dzień", "L:>P druga"]
+    assert luna_executor.split_commands("zwykły tekst\nL:>P nie polecenie") == ["zwykły tekst\nL:>P nie polecenie"]
+
+
+def test_mixed_batch_runs_memory_writes_in_parallel_and_the_rest_in_order(workdir, monkeypatch):
+    events, lock = [], threading.Lock()
+
+    def fake_command(command):
+        with lock:
+            events.append(("start", command))
+        time.sleep(0.1)
+        with lock:
+            events.append(("end", command))
+        return f"REQ:>STATUS - L:[notif] <_> ok {command}"
+
+    monkeypatch.setattr(server, "process_command", fake_command)
+    executor = luna_executor.CommandExecutor(server.process_incoming_message, namespace="batch")
+    try:
+        job = executor.submit("L:>P a\nL:>L b\nL:>CMD c\nL:>P d\n!PAMIETNIK! e")
+        assert job.prefix == luna_executor.BATCH_PREFIX
+        assert job.done.wait(5)
+    finally:
+        executor.shutdown()
+
+    position = {event: i for i, event in enumerate(events)}
+    # The two leading memory writes overlap ...
+    assert position[("start", "L:>P a")] < position[("end", "L:>L b")]
+    assert position[("start", "L:>L b")] < position[("end", "L:>P a")]
+    # ... L:>CMD waits for both, and the writes after it wait for L:>CMD
+    assert position[("start", "L:>CMD c")] > max(position[("end", "L:>P a")], position[("end", "L:>L b")])
+    assert min(position[("start", "L:>P d")], position[("start", "!PAMIETNIK! e")]) > position[("end", "L:>CMD c")]
+    assert job.response.splitlines() == [
+        "REQ:>STATUS - L:[notif] <_> Partia 5 poleceń:",
+        "[1/5] ok L:>P a", "[2/5] ok L:>L b", "[3/5] ok L:>CMD c", "[4/5] ok L:>P d", "[5/5] ok !PAMIETNIK! e",
+    ]
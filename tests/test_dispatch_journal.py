@@ -0,0 +1,53 @@
+import os
+import time
+
+import luna_storage
+import luna_transport
+import server
+
+
+def test_unfinished_dispatches_survive_a_crash(workdir):
+    path = str(workdir / "dispatch.jsonl")
+    journal = luna_storage.DispatchJournal(path)
+    journal.dispatched("turn-1", "L:>L pierwsza")
+    journal.dispatched("turn-2", "L:>L druga")
+    journal.finished("turn-1")
+    journal.journal.write('{"key": "turn-3", "te')  # torn line: the process died mid-write
+    journal.journal.flush()
+
+    reopened = luna_storage.DispatchJournal(path)
+    try:
+        assert reopened.unfinished() == [("turn-2", "L:>L druga")]
+    finally:
+        reopened.close()
+        journal.close()
+
+
+def test_session_resumes_job_interrupted_by_crash(workdir, monkeypatch):
+    handled = []
+    monkeypatch.setattr(server, "process_incoming_message", lambda message: handled.append(message) or "L:>L zrobione")
+    state_dir = luna_storage.namespace_paths("crash")[1]
+    os.makedirs(state_dir)
+    crashed = luna_storage.DispatchJournal(os.path.join(state_dir, os.path.basename(luna_storage.DISPATCH_JOURNAL_FILE)))
+    crashed.dispatched("turn-7", "L:>L zapisz to")  # accepted, but the process died before the reply
+    crashed.close()
+
+    session = server.ChatSession("crash", luna_transport.HttpTransport("http://127.0.0.1:9/"), namespace="crash")
+    try:
+        session.resume_unfinished()
+        assert "turn-7" in session.seen
+        deadline = time.monotonic() + 5
+        while not session.executor.results_ready.is_set() and time.monotonic() < deadline:
+            time.sleep(0.01)
+        session.post_ready(cycle_count=1)
+        assert handled == ["L:>L zapisz to"]
+        assert session.dispatches.unfinished() == []
+        assert len(session.outbox) == 1
+    finally:
+        session.close()
+
+    journal = luna_storage.DispatchJournal(session.dispatches.path)
+    try:
+        assert journal.unfinished() == []  # not replayed again on the next start
+    finally:
+        journal.close()
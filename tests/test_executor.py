@@ -0,0 +1,20 @@
+import time
+
+import luna_transport
+import server
+
+
+def test_finished_job_wakes_session_wait(workdir, monkeypatch):
+    monkeypatch.setattr(server, "PENDING_POLL_INTERVAL", 5)
+    monkeypatch.setattr(server, "process_incoming_message", lambda message: time.sleep(0.2) or "L:>L ok")
+    session = server.ChatSession("wake", luna_transport.HttpTransport("http://127.0.0.1:9/"), namespace="wake")
+    try:
+        job = session.executor.submit("L:>L test")
+        started = time.monotonic()
+        session.wait_for_activity(blocking=True)
+        assert time.monotonic() - started < 2  # woken by the job, not by PENDING_POLL_INTERVAL
+        assert job.done.is_set()
+        assert session.executor.pop_ready() == [job]
+        assert not session.executor.results_ready.is_set()
+    finally:
+        session.close()
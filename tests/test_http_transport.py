@@ -0,0 +1,42 @@
+import threading
+
+import pytest
+
+import fake_chat_server
+import luna_transport
+import server
+
+
+@pytest.fixture
+def chat_url():
+    httpd = fake_chat_server.make_server(port=0, script=["L:>L Pierwsza myśl.", "L:>L Druga myśl."])
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    host, port = httpd.server_address
+    yield f"http://{host}:{port}/v1/chat/completions"
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def run_once(url):
+    """Jedno uruchomienie serwera: wiadomość do Luny, jeden cykl; zwraca przekazane wiadomości."""
+    session = server.ChatSession("http-test", luna_transport.HttpTransport(url), namespace="http-test")
+    session.open(set())
+    dispatched = []
+    submit = session.executor.submit
+    def recording_submit(message):
+        dispatched.append(message)
+        return submit(message)
+    session.executor.submit = recording_submit
+    try:
+        assert session.transport.send("Cześć Luna!")
+        session.step(session.wait_for_activity(blocking=False))
+    finally:
+        session.close()
+    return dispatched
+
+
+def test_restart_dispatches_new_replies(workdir, chat_url):
+    assert run_once(chat_url) == ["L:>L Pierwsza myśl."]
+    # The seen journal survives the restart; the new run's replies must not match its keys
+    assert run_once(chat_url) == ["L:>L Druga myśl."]
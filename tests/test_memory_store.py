@@ -0,0 +1,85 @@
+import os
+
+import pytest
+
+import luna_storage
+
+CATEGORY = luna_storage.MEMORY_CATEGORIES[0]
+DAY = 86400
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    """Sterowany czas zapisu wpisów (MemoryStore.append bierze znacznik z time.time)."""
+    now = [1_700_000_000.0]
+    monkeypatch.setattr(luna_storage.time, "time", lambda: now[0])
+    return now
+
+
+def open_store(root, **kwargs):
+    return luna_storage.MemoryStore(str(root), categories=[CATEGORY], segment_max_bytes=64, **kwargs)
+
+
+def segment_files(root):
+    return sorted(os.listdir(os.path.join(str(root), CATEGORY, "segments")))
+
+
+def test_appends_roll_segments_and_survive_restart(workdir, clock):
+    store = open_store(workdir / "mem")
+    names = []
+    for i in range(6):
+        clock[0] += 60
+        names.append(store.append(CATEGORY, f"wpis numer {i} " + "x" * 40))
+    assert len({record[1] for record in store.entries[CATEGORY]}) == 6  # one entry per 64-byte segment
+    store.close()
+
+    store = open_store(workdir / "mem")
+    try:
+        assert store.names(CATEGORY) == names
+        assert store.read(CATEGORY, names[3]).startswith("wpis numer 3 ")
+        assert store.query(CATEGORY, since=clock[0] - 100) == names[-2:]
+        clock[0] += 60
+        assert store.append(CATEGORY, "po restarcie") not in names  # writes continue in the newest segment
+    finally:
+        store.close()
+
+
+def test_compaction_keeps_entries_readable_after_restart(workdir, clock):
+    store = open_store(workdir / "mem")
+    names = [store.append(CATEGORY, f"stary wpis {i} " + "y" * 50) for i in range(4)]
+    clock[0] += 30 * DAY
+    store.append(CATEGORY, "świeży wpis")
+
+    assert store.compact(CATEGORY, before=clock[0] - DAY) > 0
+    files = segment_files(workdir / "mem")
+    assert "00000001.log.gz" in files and "00000001.log" not in files
+    assert store.read(CATEGORY, names[0]).startswith("stary wpis 0 ")
+    store.close()
+
+    store = open_store(workdir / "mem")
+    try:
+        assert [store.read(CATEGORY, name)[:13] for name in names] == [f"stary wpis {i} " for i in range(4)]
+    finally:
+        store.close()
+
+
+def test_drop_before_frees_names_for_reuse(workdir, clock):
+    store = open_store(workdir / "mem")
+    old = store.append(CATEGORY, "wpis do usunięcia " + "z" * 50)
+    kept = store.append(CATEGORY, "wpis w bieżącym segmencie " + "z" * 50)
+    assert kept == f"{old}-2"
+
+    assert store.drop_before(CATEGORY, cutoff=clock[0] + 1) == [old]
+    assert store.read(CATEGORY, old) is None
+    reused = store.append(CATEGORY, "nowy wpis pod starą nazwą")
+    assert reused == old
+    assert "00000001.log" not in segment_files(workdir / "mem")
+    store.close()
+
+    store = open_store(workdir / "mem")
+    try:
+        assert sorted(store.names(CATEGORY)) == sorted([kept, old])
+        assert store.read(CATEGORY, old) == "nowy wpis pod starą nazwą"
+        assert store.read(CATEGORY, kept).startswith("wpis w bieżącym segmencie ")
+    finally:
+        store.close()
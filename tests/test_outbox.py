@@ -0,0 +1,98 @@
+import luna_transport
+import server
+
+
+class ChatPage:
+    """Minimalny WebDriver: tylko wiadomości wysłane przez serwer (LAST_USER_TURN_SCRIPT)."""
+
+    def __init__(self):
+        self.user_turns = []
+
+    def execute_script(self, script, *args):
+        assert script is luna_transport.LAST_USER_TURN_SCRIPT
+        return {"count": len(self.user_turns), "text": self.user_turns[-1] if self.user_turns else None}
+
+
+def make_transport(monkeypatch, page, failures):
+    """SeleniumTransport, którego send() zawodzi `failures` razy, nic nie wysyłając."""
+    monkeypatch.setattr(luna_transport, "load_selenium", lambda: None)
+    monkeypatch.setattr(server, "OUTBOX_RETRY_DELAY", 0)
+    transport = luna_transport.SeleniumTransport(page)
+    remaining = [failures]
+    def send(message):
+        if remaining[0]:
+            remaining[0] -= 1
+            return False
+        page.user_turns.append(message)
+        return True
+    transport.send = send
+    transport.wait_idle = transport.wait_ready = lambda timeout=None: None
+    return transport
+
+
+def test_failed_repeat_of_identical_status_is_resent(monkeypatch):
+    page = ChatPage()
+    page.user_turns.append("L:>L Aktywne")  # the same status posted in an earlier cycle
+    outbox = server.Outbox(make_transport(monkeypatch, page, failures=1))
+    outbox.put("L:>L Aktywne", mergeable=False)
+    assert outbox.flush()
+    assert page.user_turns == ["L:>L Aktywne", "L:>L Aktywne"]
+
+
+def test_post_that_landed_despite_error_is_not_duplicated(monkeypatch):
+    page = ChatPage()
+    transport = make_transport(monkeypatch, page, failures=0)
+    send = transport.send
+    def send_then_fail(message):
+        send(message)
+        return False  # delivered, but the composer reported an error
+    transport.send = send_then_fail
+    outbox = server.Outbox(transport)
+    outbox.put("L:>L Aktywne", mergeable=False)
+    assert outbox.flush()
+    assert page.user_turns == ["L:>L Aktywne"]
+
+
+class BusyChat(luna_transport.ChatTransport):
+    """Transport, w którym Luna „odpowiada”, dopóki busy_flag jest ustawione."""
+
+    def __init__(self):
+        self.busy_flag = False
+        self.sent = []
+
+    def send(self, message):
+        self.sent.append(message)
+        return True
+
+    def busy(self):
+        return self.busy_flag
+
+    def wait_idle(self, timeout=None):
+        raise AssertionError("flush(block=False) must not wait for Luna")
+
+    wait_ready = wait_idle
+
+    def wait_for_activity(self, timeout, wake=None):
+        return False
+
+    def new_turns(self, cursor):
+        return [], cursor
+
+
+def test_non_blocking_flush_defers_instead_of_waiting():
+    chat = BusyChat()
+    outbox = server.Outbox(chat)
+    outbox.put("x" * (server.MAX_CONTENT_LENGTH + 100), mergeable=False)  # two parts
+    outbox.put("L:>L Aktywne", mergeable=False)
+    chat.busy_flag = True
+    assert not outbox.flush(block=False)
+    assert chat.sent == [] and len(outbox) == 2
+    chat.busy_flag = False
+    assert not outbox.flush(block=False)
+    assert len(chat.sent) == 1  # one part per cycle
+    outbox.put("L:>P później", priority=server.OUTBOX_PRIORITY_ACK, mergeable=False)
+    assert not outbox.flush(block=False)
+    assert len(chat.sent) == 2 and "xxx" in chat.sent[1]  # the second part before any other post
+    assert not outbox.flush(block=False)
+    assert outbox.flush(block=False)
+    assert chat.sent[2:] == ["L:>L Aktywne", "L:>P później"]
@@ -0,0 +1,30 @@
+import luna_executor
+import luna_storage
+import server
+
+
+def record_session(name, text, response):
+    trace = server.TraceRecorder(name, name, directory="traces")
+    trace.record("dispatch", cycle=1, job=1, key=f"id:{name}-1", prefixes=[luna_executor.detect_prefix(text)], text=text)
+    trace.record("result", cycle=1, job=1, response=response, ms=1.0)
+    trace.close()
+    return trace.path
+
+
+def entries(namespace, category):
+    return list(luna_storage.get_memory_store(namespace).names(category))
+
+
+def test_replay_routes_turns_to_their_sessions(workdir):
+    paths = [
+        record_session("alpha", "L:>P Cześć od alfy", "REQ:>STATUS - L:[notif] <_> L:>P Wiadomość wysłana do Promyka."),
+        record_session("beta", "L:>L Myśl bety", "REQ:>STATUS - L:[notif] <_> L:>L Aktywne – Zapisane w pamięci."),
+    ]
+    summary = server.replay_trace(paths)
+    assert summary["sessions"] == ["alpha", "beta"]
+    # Both traces have a job #1: expected responses are keyed by session, so both are compared
+    assert (summary["compared"], summary["matched"]) == (2, 2)
+    assert len(entries("alpha", "wiadomosci_do_ciebie")) == 1
+    assert len(entries("beta", "rozmyslania")) == 1
+    assert entries("alpha", "rozmyslania") == []
+    assert entries(None, "wiadomosci_do_ciebie") == entries(None, "rozmyslania") == []
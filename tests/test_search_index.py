@@ -0,0 +1,66 @@
+import os
+
+import luna_storage
+
+
+def journal_lines(path):
+    with open(path, encoding="utf-8") as f:
+        return sum(1 for _ in f)
+
+
+def test_removed_document_is_purged_from_postings(workdir):
+    index = luna_storage.SearchIndex(str(workdir / "index.jsonl"))
+    index.add("memory/notes/a.txt", "kot ma alę")
+    index.add("memory/notes/b.txt", "pies szczeka")
+    index.remove("memory/notes/a.txt")
+
+    assert index.search("kot") == []
+    assert "kot" not in index.postings
+    assert "kot" not in index.sorted_terms
+    assert [doc for doc, _, _ in index.search("pies")] == ["memory/notes/b.txt"]
+    index.close()
+
+
+def test_compact_rewrites_journal_and_survives_reload(workdir):
+    path = str(workdir / "index.jsonl")
+    index = luna_storage.SearchIndex(path)
+    for i in range(5):
+        index.add(f"memory/notes/{i}.txt", f"wpis numer {i} o kotach")
+    index.add("memory/notes/0.txt", "nadpisany wpis o psach")
+    for i in (1, 2):
+        index.remove(f"memory/notes/{i}.txt")
+    assert index.dead_lines() == 5
+
+    assert index.compact() == 5
+    assert journal_lines(path) == 3
+    assert index.dead_lines() == 0
+    index.add("memory/notes/5.txt", "nowy wpis o kotach")
+    index.close()
+
+    reloaded = luna_storage.SearchIndex(path)
+    assert sorted(doc for doc, _, _ in reloaded.search("kotach")) == ["memory/notes/3.txt", "memory/notes/4.txt", "memory/notes/5.txt"]
+    assert [doc for doc, _, _ in reloaded.search("psach")] == ["memory/notes/0.txt"]
+    reloaded.close()
+
+
+def test_load_drops_documents_that_no_longer_exist(workdir, monkeypatch):
+    monkeypatch.setattr(luna_storage, "SEARCH_INDEX_COMPACT_LINES", 1)
+    store = luna_storage.get_memory_store()
+    category = luna_storage.MEMORY_CATEGORIES[0]
+    name = store.append(category, "stary wpis o żyrafach")
+    index = luna_storage.get_search_index()
+    assert index.search("żyrafach")
+    # The entry disappears while the index is closed (e.g. the journal outlived the store)
+    index.close()
+    luna_storage.search_indexes.clear()
+    store.close()
+    luna_storage.memory_stores.clear()
+    luna_storage.memory_store = None
+    for root, _, files in os.walk(os.path.join(luna_storage.MEMORY_ROOT, category)):
+        for filename in files:
+            os.remove(os.path.join(root, filename))
+
+    index = luna_storage.get_search_index()
+    assert index.search("żyrafach") == []
+    assert f"{luna_storage.MEMORY_ROOT}/{category}/{name}.txt" not in index
+    assert journal_lines(index.path) == 0
@@ -0,0 +1,59 @@
+import types
+
+import pytest
+
+import luna_metrics
+import luna_transport
+
+
+class Page:
+    """WebDriver, na którym działają tylko podane selektory CSS."""
+
+    def __init__(self, working):
+        self.working = set(working)
+
+    def find_element(self, by, selector):
+        if selector not in self.working:
+            raise LookupError(selector)
+        return selector
+
+
+@pytest.fixture
+def fresh_metrics(monkeypatch):
+    monkeypatch.setattr(luna_transport, "By", types.SimpleNamespace(CSS_SELECTOR="css selector"))
+    monkeypatch.setattr(luna_transport, "metrics", luna_metrics.Metrics())
+    return luna_transport.metrics
+
+
+def fallbacks(metrics, name):
+    return metrics.values.get(luna_metrics.Metrics._key("luna_selector_fallbacks_total", {"resolver": name}), 0)
+
+
+def test_fallback_from_cached_selector_is_counted(fresh_metrics):
+    resolver = luna_transport.SelectorResolver("composer", ["#a", "#b"])
+    assert resolver.find_element(Page({"#a", "#b"})) == "#a"
+    assert fallbacks(fresh_metrics, "composer") == 0
+    # The cached #a disappears: #b wins and the fallback is counted
+    assert resolver.find_element(Page({"#b"})) == "#b"
+    assert resolver.cached == "#b"
+    assert resolver.stats["misses"] == 2
+    assert fallbacks(fresh_metrics, "composer") == 1
+    assert resolver.find_element(Page({"#b"})) == "#b"
+    assert fallbacks(fresh_metrics, "composer") == 1
+
+
+def test_first_lookup_is_not_a_fallback(fresh_metrics):
+    resolver = luna_transport.SelectorResolver("composer", ["#a", "#b"])
+    assert resolver.find_element(Page({"#b"})) == "#b"
+    assert fallbacks(fresh_metrics, "composer") == 0
+
+
+def test_sessions_keep_their_own_selector_state(monkeypatch, fresh_metrics):
+    monkeypatch.setattr(luna_transport, "load_selenium", lambda: None)
+    first, second = luna_transport.SeleniumTransport(None), luna_transport.SeleniumTransport(None)
+    first.selectors.textarea.find_element(Page({"#prompt-textarea"}))
+    first.selectors.invalidate("stale element")
+    first.selectors.invalidate("stale element")
+    assert first.selectors.recent_stale_events() == 2
+    assert second.selectors.recent_stale_events() == 0
+    assert second.selectors.textarea.stats["probes"] == 0